@@ -7,31 +7,77 @@ LastEditTime: 2022-03-21 19:59:43
 '''
 
 
-from torch.utils.data import Dataset
+import glob
+import hashlib
+import json
+import math
+import os
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 import numpy as np
 import pickle
 
+from checkpoint import load_tensors, save_tensors
+
+def in_curriculum(rating, stage):
+    '''
+    Whether samples of this rating are trained on in the curriculum stage: the very positive and negative ones
+    in stage 1, the positive and negative ones in stage 2 and all of them in stage 3. Works on arrays too.
+    '''
+    if stage == 1:
+        return (rating < 2) | (rating > 4)
+    elif stage == 2:
+        return (rating < 3) | (rating > 3)
+    return rating == rating
+
 class MyDataset(Dataset):
-    def __init__(self, file_path, tokenizer, data_config, if_train=True):
+    def __init__(self, file_path, tokenizer, data_config, if_train=True, emb_dtype=np.float32):
+        '''
+        emb_dtype: dtype of the WenLan embeddings of the samples, the model computes in float32 anyway
+        If file_path is None, the dataset is empty and only used to featurize samples.
+        file_path is either a pickled list of samples or a deduplicated file written by dedup_embeddings().
+        '''
         super(MyDataset, self).__init__()
         self._filename = file_path
-        self.data = self.load_data(self._filename)
+        self.emb_table = None
+        self.data = self.load_data(self._filename) if file_path is not None else []
         self._tokenizer = tokenizer
         self._max_topic_length = data_config.topic_prompt_length
         self._max_sent_length = data_config.max_sent_length
         self._total_len = len(self.data)
         self.if_train = if_train
+        self._emb_dtype = emb_dtype
     
     def load_data(self, data_file):
         f = open(data_file, 'rb')
         data = pickle.load(f)
         f.close()
+        if isinstance(data, dict) and 'embeddings' in data: # deduplicated layout
+            self.load_embeddings(os.path.join(os.path.dirname(data_file), data['embeddings']))
+            data = data['samples']
         return data
 
+    def load_embeddings(self, path):
+        '''
+        Memory-map the embedding table the '*_emb' references of the samples point to.
+        '''
+        self.emb_table = load_tensors(path)[0]['embeddings'].numpy()
+
+    def embedding(self, value):
+        '''
+        An embedding of a sample: inline, or a row of the embedding table.
+        '''
+        return self.emb_table[value] if isinstance(value, (int, np.integer)) else value
+
     def __len__(self):
         return self._total_len
 
     def __getitem__(self, idx):
+        return self.featurize(self.data[idx])
+
+    def featurize(self, item):
         '''
         item.keys:
             'topic', 'topic_emb', 'lyrics', 'rating',
@@ -39,24 +85,24 @@ class MyDataset(Dataset):
             'img_0', 'img_0_emb', 'img_1', 'img_1_emb', 'img_2', 'img_2_emb', 'img_3', 'img_3_emb', 'img_4', 'img_4_emb',
             'r_0', 'r_0_emb', 'r_1', 'r_1_emb', 'r_2', 'r_2_emb', 'r_3', 'r_3_emb', 'r_4', 'r_4_emb'
         '''
-        topic_emb = self.data[idx]['topic_emb']
-        img_embs = [self.data[idx]['img_' + str(i) + '_emb'] for i in range(5)]
-        r_embs = [self.data[idx]['r_' + str(i) + '_emb'] for i in range(5)]
-        topic_ids, tpw_attention_mask, tpw_type_ids = self.convert_topic(self.data[idx]['topic'])
-        targets, attention_mask, type_ids = self.convert_lyrics2ids(self.data[idx]['lyrics']) # a list of list: [[sent1], [sent2], ...]
+        topic_emb = self.embedding(item['topic_emb'])
+        img_embs = [self.embedding(item['img_' + str(i) + '_emb']) for i in range(5)]
+        r_embs = [self.embedding(item['r_' + str(i) + '_emb']) for i in range(5)]
+        topic_ids, tpw_attention_mask, tpw_type_ids = self.convert_topic(item['topic'])
+        targets, attention_mask, type_ids = self.convert_lyrics2ids(item['lyrics']) # a list of list: [[sent1], [sent2], ...]
         batch = {
             'topic_ids': np.asarray(topic_ids),
             'tpw_attention_mask': np.asarray(tpw_attention_mask),
             'tpw_type_ids': np.asarray(tpw_type_ids),
-            'topic_emb': np.asarray(topic_emb),
-            'img_embs': np.asarray(img_embs),
-            'r_embs': np.asarray(r_embs),
+            'topic_emb': np.asarray(topic_emb, dtype=self._emb_dtype),
+            'img_embs': np.asarray(img_embs, dtype=self._emb_dtype),
+            'r_embs': np.asarray(r_embs, dtype=self._emb_dtype),
             'targets': np.asarray(targets),
             'attention_mask': np.asarray(attention_mask),
             'type_ids': np.asarray(type_ids)
         }
         if self.if_train:
-            batch['rating'] = self.data[idx]['rating']
+            batch['rating'] = item['rating']
         return batch
 
     def convert_topic(self, topic_words):
@@ -116,3 +162,264 @@ class MyDataset(Dataset):
         all_token_ids = self._tokenizer.convert_tokens_to_ids(all_tokens)
 
         return all_token_ids, attention_mask, type_ids
+
+
+def dedup_embeddings(data, emb_dtype=np.float32):
+    '''
+    Move the '*_emb' vectors of the samples of data into a table with one row per distinct vector,
+    addressed by the sha1 of its float32 bytes, and replace them in the samples by their row.
+    Returns:
+        samples: the samples with int references, table: [n_unique, emb_size] array, hashes: the hash of each row
+    '''
+    rows = {}
+    table = []
+    samples = []
+    for item in data:
+        sample = dict(item)
+        for key, value in item.items():
+            if not key.endswith('_emb'):
+                continue
+            value = np.asarray(value, dtype=np.float32)
+            digest = hashlib.sha1(value.tobytes()).hexdigest()
+            if digest not in rows:
+                rows[digest] = len(table)
+                table.append(value)
+            sample[key] = rows[digest]
+        samples.append(sample)
+    return samples, np.stack(table).astype(emb_dtype), list(rows)
+
+
+def save_dedup_data(samples, table, hashes, path):
+    '''
+    Write the output of dedup_embeddings() as the data file path, read by MyDataset, and the embedding table
+    next to it ('.emb.safetensors'), memory-mapped when loaded.
+    '''
+    table_path = os.path.splitext(path)[0] + ".emb.safetensors"
+    save_tensors({'embeddings': torch.from_numpy(table)}, table_path)
+    with open(path, 'wb') as f:
+        pickle.dump({'embeddings': os.path.basename(table_path), 'hashes': hashes, 'samples': samples}, f)
+    return table_path
+
+
+def build_shard_index(shard_dir, embeddings=None):
+    '''
+    Scan the '*.pkl' shards of shard_dir (each one a pickled list of samples, like a MyDataset file),
+    one at a time, and write their numbers of samples per rating to shard_dir/index.json.
+    embeddings: the embedding table of deduplicated samples, relative to shard_dir, kept from the last index if None
+    '''
+    index_path = os.path.join(shard_dir, "index.json")
+    if embeddings is None and os.path.exists(index_path):
+        with open(index_path, encoding="utf-8") as f:
+            embeddings = json.load(f).get('embeddings')
+    index = {'shards': []}
+    if embeddings is not None:
+        index['embeddings'] = embeddings
+    for path in sorted(glob.glob(os.path.join(shard_dir, "*.pkl"))):
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        ratings = {}
+        for item in data:
+            rating = str(item.get('rating'))
+            ratings[rating] = ratings.get(rating, 0) + 1
+        index['shards'].append({'file': os.path.basename(path), 'n_samples': len(data), 'ratings': ratings})
+        del data
+    with open(index_path, "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
+class ShardedDataset(IterableDataset):
+    def __init__(self, shard_dir, tokenizer, data_config, if_train=True, emb_dtype=np.float32, stage=None, \
+                 shuffle_buffer=1000, seed=42, rank=None, world_size=None, num_workers=0):
+        '''
+        Stream the samples of a directory of shards (see build_shard_index()) with the featurization of MyDataset,
+        holding one shard and the shuffle buffer in memory at a time, whatever the size of the corpus.
+        The shards are split between the DDP ranks and the DataLoader workers, or their samples if there are
+        fewer shards than ranks x workers, so that every sample is read once per epoch.
+        Args:
+            stage: int, only yield the samples of this curriculum stage (see in_curriculum()), all if None
+            shuffle_buffer: int, number of featurized samples of the shuffle buffer, 0 to keep the order of the shards
+            seed: int, the shard order and the buffer are shuffled with seed + epoch
+            rank, world_size: the DDP process, from torch.distributed if None
+            num_workers: int, number of workers of the DataLoader that reads it, for its length
+        '''
+        super(ShardedDataset, self).__init__()
+        self.shard_dir = shard_dir
+        self._featurizer = MyDataset(None, tokenizer, data_config, if_train, emb_dtype)
+        index_path = os.path.join(shard_dir, "index.json")
+        if os.path.exists(index_path):
+            with open(index_path, encoding="utf-8") as f:
+                self.index = json.load(f)
+        else:
+            self.index = build_shard_index(shard_dir)
+        if 'embeddings' in self.index:
+            self._featurizer.load_embeddings(os.path.join(shard_dir, self.index['embeddings']))
+        self.stage = stage
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        if rank is None:
+            rank, world_size = (dist.get_rank(), dist.get_world_size()) if dist.is_available() and dist.is_initialized() else (0, 1)
+        self.rank = rank
+        self.world_size = world_size
+        self.num_workers = num_workers
+        self.epoch = 0
+        self._n_iters = 0
+
+    def set_epoch(self, epoch):
+        '''
+        Reseed the shuffling for a new epoch. Persistent workers keep their copy of the dataset,
+        so every new iteration also moves to the next epoch by itself.
+        '''
+        self.epoch = epoch
+        self._n_iters = 0
+
+    def __len__(self):
+        '''
+        Number of samples of the stage that this rank reads in the next epoch, from the index.
+        '''
+        return sum(self.part_sizes())
+
+    def n_batches(self, batch_size, epoch=None):
+        '''
+        Number of batches of this rank in an epoch (the next one if None). Every worker ends with its own
+        partial batch, so there are up to num_workers - 1 more than len(DataLoader).
+        '''
+        return sum(math.ceil(n / batch_size) for n in self.part_sizes(epoch))
+
+    def part_sizes(self, epoch=None):
+        '''
+        Numbers of samples of the stage of the DataLoader workers of this rank in an epoch (the next one if None).
+        They are exact when the shards are split; when their samples are split, the index only holds
+        the ratings of whole shards, so the stage samples of each part are estimated.
+        '''
+        epoch = self.epoch + self._n_iters if epoch is None else epoch
+        num_workers = max(self.num_workers, 1)
+        shards = {shard['file']: shard for shard in self.index['shards']}
+        sizes = []
+        for worker_id in range(num_workers):
+            files, offset, stride = self._part(epoch, worker_id, num_workers)
+            n_samples = 0.0
+            for file in files:
+                shard = shards[file]
+                n_stage = sum(count for rating, count in shard['ratings'].items() \
+                              if self.stage is None or rating == 'None' or in_curriculum(float(rating), self.stage))
+                if shard['n_samples'] > 0:
+                    n_samples += n_stage * len(range(offset, shard['n_samples'], stride)) / shard['n_samples']
+            sizes.append(int(round(n_samples)))
+        return sizes
+
+    def _part(self, epoch, worker_id, num_workers):
+        '''
+        The shards of a worker of this rank in an epoch, and the offset and stride of its samples in each of them.
+        '''
+        # the same shard order in every process, then this part of it
+        files = [shard['file'] for shard in self.index['shards']]
+        files = [files[i] for i in np.random.RandomState(self.seed + epoch).permutation(len(files))]
+        n_parts = self.world_size * num_workers
+        part = self.rank * num_workers + worker_id
+        if len(files) >= n_parts:
+            return files[part::n_parts], 0, 1
+        return files, part, n_parts
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        epoch = self.epoch + self._n_iters
+        self._n_iters += 1
+        files, offset, stride = self._part(epoch, worker_id, num_workers)
+        part = self.rank * num_workers + worker_id
+        rng = np.random.RandomState((self.seed + epoch) * 10007 + part)
+
+        buffer = []
+        for file in files:
+            with open(os.path.join(self.shard_dir, file), 'rb') as f:
+                data = pickle.load(f)
+            for item in data[offset::stride]:
+                if self.stage is not None and not in_curriculum(item['rating'], self.stage):
+                    continue
+                sample = self._featurizer.featurize(item)
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+                if self.shuffle_buffer > 0:
+                    i = rng.randint(len(buffer))
+                    sample, buffer[i] = buffer[i], sample
+                yield sample
+            del data
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield sample
+
+
+class Collator(object):
+    def __init__(self, emb_dtype=torch.float32, id_dtype=torch.int32):
+        '''
+        collate_fn of the DataLoader for MyDataset: every field of the batch is written into one tensor allocated
+        with its final shape, in shared memory inside a worker, instead of stacking a tensor per sample.
+        The embeddings are stored as emb_dtype and the ids, masks and ratings as id_dtype (int16 fits any vocab
+        under 32768 ids), batch_to_device() casts the ids back to int64 on the device.
+        '''
+        self.emb_dtype = emb_dtype
+        self.id_dtype = id_dtype
+
+    def __call__(self, samples):
+        batch = {}
+        in_worker = get_worker_info() is not None
+        for key in samples[0]:
+            first = np.asarray(samples[0][key])
+            dtype = self.emb_dtype if np.issubdtype(first.dtype, np.floating) else self.id_dtype
+            buffer = torch.empty((len(samples),) + first.shape, dtype=dtype)
+            if in_worker: # sent to the main process without a copy
+                buffer.share_memory_()
+            array = buffer.numpy()
+            for i, sample in enumerate(samples):
+                array[i] = sample[key]
+            batch[key] = buffer
+        return batch
+
+
+def batch_to_device(batch, device, idxs=None):
+    '''
+    Move the samples idxs (all if None) of a collated batch to device, with the ids as int64.
+    The embeddings keep their dtype and are cast to float32 by the model on the device.
+    '''
+    res = {}
+    for key, value in batch.items():
+        value = value.to(device, non_blocking=True) # asynchronous from pinned memory
+        if idxs is not None:
+            value = value[idxs.to(device)]
+        res[key] = value if value.is_floating_point() else value.long()
+    return res
+
+
+def pack_batch(batch, data_config):
+    '''
+    Add the packed layout of the targets to a collated batch: the pad slots of the fixed 22-slot sentence layout
+    are dropped and the remaining tokens are moved to the left, so the decoder only runs on real tokens.
+    Each packed token keeps its slot in the fixed layout, which gives its GPT2 position and its two-sentence segment,
+    so the logits of the real tokens are the same as in the fixed layout.
+    Adds:
+        'packed_ids': [batch_size, packed_length], the non-pad target ids, 0 after the end
+        'packed_positions': [batch_size, packed_length], their slots in the fixed layout
+        'packed_segment_ids': [batch_size, packed_length], index of their two sentences in concat_output
+        'packed_type_ids', 'packed_attention_mask': [batch_size, packed_length]
+        'packed_labels': [batch_size, packed_length], the token of the next slot in the fixed layout (-100 to ignore)
+    '''
+    targets = batch['targets'].long()
+    keep = batch['attention_mask'] > 0
+    batch_size, max_length = targets.shape
+    slots = torch.arange(max_length, device=targets.device).expand(batch_size, max_length)
+    lengths = keep.sum(1)
+    packed_length = max(int(lengths.max()), 1)
+    # the kept slots in order, followed by the dropped ones
+    positions = torch.sort(slots + (~keep).long() * max_length, dim=1)[0][:, :packed_length] % max_length
+    valid = slots[:, :packed_length] < lengths[:, None]
+    next_targets = torch.cat([targets[:, 1:], targets.new_full((batch_size, 1), -100)], dim=1)
+    two_sents_length = (data_config.max_sent_length + 2) * 2 # 2 for [#START#] and [#EOS#]
+    batch['packed_ids'] = targets.gather(1, positions).masked_fill(~valid, 0)
+    batch['packed_positions'] = positions.masked_fill(~valid, 0)
+    batch['packed_segment_ids'] = batch['packed_positions'] // two_sents_length
+    batch['packed_type_ids'] = batch['type_ids'].long().gather(1, positions).masked_fill(~valid, 0)
+    batch['packed_attention_mask'] = valid.long()
+    batch['packed_labels'] = next_targets.gather(1, positions).masked_fill(~valid, -100)
+    return batch
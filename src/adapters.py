@@ -0,0 +1,136 @@
+import argparse
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from transformers import BertTokenizer
+
+from configs import model_cfgs as default_model_cfgs, data_config as mydata_config
+from model import MMTG, token_id2emb_as_safetensors
+from checkpoint import load_checkpoint, save_checkpoint, cpu_snapshot, share_weights
+from utils import strip_module_prefix
+
+
+class LoRAConv1D(nn.Module):
+    def __init__(self, base, r=8, alpha=16, dropout=0.0):
+        '''
+        A frozen GPT2 Conv1D (y = x W + b, W: [in_features, out_features]) with a trainable low-rank update
+        y += (x A^T B^T) * alpha / r (Hu et al., 2021). B starts at zero, so the wrapped layer starts as the base one.
+        '''
+        super(LoRAConv1D, self).__init__()
+        self.base = base
+        in_features, out_features = base.weight.shape
+        self.lora_A = nn.Parameter(base.weight.new_zeros(r, in_features))
+        self.lora_B = nn.Parameter(base.weight.new_zeros(out_features, r))
+        nn.init.kaiming_uniform_(self.lora_A, a=math.sqrt(5))
+        self.scaling = alpha / r
+        self.dropout = nn.Dropout(dropout)
+
+    def forward(self, x):
+        return self.base(x) + F.linear(F.linear(self.dropout(x), self.lora_A), self.lora_B) * self.scaling
+
+    def merge(self):
+        '''
+        The base layer with the low-rank update folded into its weight.
+        '''
+        with torch.no_grad():
+            self.base.weight += (self.lora_B @ self.lora_A).t() * self.scaling
+        return self.base
+
+
+def freeze_decoder(model, lora_r=0, lora_alpha=16, lora_dropout=0.0, lora_targets=("attn.c_attn",)):
+    '''
+    Freeze the GPT2 of the decoder of model (an MMTG); the encoder, the attention layers and the projectors stay trainable.
+    With lora_r > 0, the layers lora_targets of every GPT2 block (e.g. 'attn.c_attn', 'attn.c_proj', 'mlp.c_fc')
+    get trainable low-rank adapters.
+    '''
+    mmtg = model.module if isinstance(model, nn.DataParallel) else model
+    for param in mmtg.decoder.gpt2.parameters():
+        param.requires_grad = False
+    if lora_r > 0:
+        for block in mmtg.decoder.gpt2.transformer.h:
+            for target in lora_targets:
+                parent_name, _, name = target.rpartition('.')
+                parent = block.get_submodule(parent_name) if parent_name else block
+                setattr(parent, name, LoRAConv1D(getattr(parent, name), lora_r, lora_alpha, lora_dropout))
+    return model
+
+
+def merge_lora(model):
+    '''
+    Fold every LoRAConv1D of model back into a plain Conv1D, so that the state dict has the keys of a full MMTG.
+    '''
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, LoRAConv1D):
+                setattr(module, name, child.merge())
+    return model
+
+
+def build_from_delta(state_dict, model_cfgs, data_config, vocab_size):
+    '''
+    The MMTG of a checkpoint saved by train.py --freeze_decoder: the base decoder given by model_cfgs
+    (GPT2_NAME and GPT2_PATH), the trained weights of state_dict on top and the adapters merged.
+    '''
+    model = MMTG(model_cfgs, data_config, vocab_size, train_flag=True) # loads the base decoder
+    freeze_decoder(model, **model_cfgs['PEFT'])
+    state_dict = strip_module_prefix(state_dict)
+    missing, unexpected = model.load_state_dict(state_dict, strict=False)
+    trainable = {name for name, param in model.named_parameters() if param.requires_grad}
+    missing = [key for key in missing if key in trainable] # the frozen weights come from the base decoder
+    if missing or unexpected:
+        raise RuntimeError("Error(s) in loading the delta: missing keys %s, unexpected keys %s" % (missing, unexpected))
+    merge_lora(model)
+    model.train_flag = False
+    return model
+
+
+def load_model(path, tokenizer, data_config, share=False):
+    '''
+    The MMTG of a checkpoint of any format on the CPU, in predicting mode, and the model configs of this full model:
+    GPT2 built from its config (GPT2_NAME None, GPT2_PATH '') with the vocabulary size of the checkpoint.
+    A delta checkpoint of train.py --freeze_decoder is built on its base decoder with the adapters merged.
+    share: point the parameters at the tensors of a memory-mapped '.safetensors' checkpoint instead of copying them
+        (see checkpoint.share_weights()), and memory-map the token embedding table too
+    '''
+    state_dict, model_cfgs = load_checkpoint(path)
+    if model_cfgs is not None and model_cfgs.get('PEFT'):
+        if share:
+            raise ValueError("Sharing the weights needs a full checkpoint, merge %s with adapters.py first" % path)
+        model = build_from_delta(state_dict, model_cfgs, data_config, len(tokenizer.vocab))
+        model_cfgs = {key: value for key, value in model_cfgs.items() if key != 'PEFT'}
+    else:
+        model_cfgs = dict(model_cfgs or default_model_cfgs, GPT2_NAME=None, \
+                          GPT2_VOCAB_SIZE=state_dict['decoder.gpt2.transformer.wte.weight'].size(0))
+        token_emb_path = model_cfgs.get('TOKEN_EMB_PATH', "./vocab/token_id2emb_dict.pkl")
+        if share and token_emb_path is not None:
+            model_cfgs['TOKEN_EMB_PATH'] = token_id2emb_as_safetensors(token_emb_path, data_config.wenlan_emb_size)
+        model = MMTG(model_cfgs, data_config, len(tokenizer.vocab), False)
+        if share:
+            share_weights(model, state_dict) # the parameters stay views of the mapped file
+        else:
+            model.load_state_dict(state_dict)
+    model_cfgs = dict(model_cfgs, GPT2_NAME=None, GPT2_PATH='', GPT2_VOCAB_SIZE=model.decoder.gpt2.config.vocab_size)
+    return model, model_cfgs
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--delta_path", default="", type=str, help="Checkpoint saved by train.py --freeze_decoder")
+    parser.add_argument("--output", default="", type=str, help="Full checkpoint with the adapters merged, '.pth' or '.safetensors'")
+    parser.add_argument("--tokenizer_path", default="./vocab/vocab.txt", type=str, help="词表路径")
+    args = parser.parse_args()
+
+    state_dict, model_cfgs = load_checkpoint(args.delta_path)
+    if not model_cfgs or not model_cfgs.get('PEFT'):
+        raise ValueError("%s is not a checkpoint of train.py --freeze_decoder" % args.delta_path)
+    tokenizer = BertTokenizer.from_pretrained(args.tokenizer_path)
+    model = build_from_delta(state_dict, model_cfgs, mydata_config(), len(tokenizer.vocab))
+    model_cfgs = {key: value for key, value in model_cfgs.items() if key != 'PEFT'}
+    save_checkpoint(cpu_snapshot(model.state_dict()), args.output, model_cfgs)
+    print("Merged %d trained tensors of %s into the full checkpoint %s." % (len(state_dict), args.delta_path, args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import argparse
+import re
+import time
+
+import torch
+from transformers import AdamW
+
+from configs import model_cfgs, data_config as mydata_config
+from loss import MyLoss, FusedLoss
+from benchmark import build_model, make_batch
+from utils import rss_mb, reset_peak_rss
+
+
+def memory_budget_mb(device):
+    '''
+    90% of the memory of the GPU, or of the memory this process uses plus what the host has available.
+    '''
+    if device.type == "cuda":
+        return torch.cuda.get_device_properties(device).total_memory / 1024 ** 2 * 0.9
+    with open("/proc/meminfo") as f:
+        available = next(int(line.split()[1]) for line in f if line.startswith("MemAvailable:")) / 1024
+    return (rss_mb() + available) * 0.9
+
+
+def probe(fn, device, baseline_mb=None, iters=2):
+    '''
+    Run fn once to warm up, then iters times.
+    On CPU the peak is baseline_mb (the RSS of the model and the optimizer, the current RSS if None) plus the growth
+    of the RSS during the probe, so that memory kept from an earlier probe does not count.
+    Returns:
+        peak memory in MB (CUDA allocated, or process RSS on CPU), mean latency in seconds, None if it ran out of memory
+        (only CUDA raises it, on CPU the kernel kills the process instead)
+    '''
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+    start_rss = rss_mb()
+    baseline_mb = start_rss if baseline_mb is None else baseline_mb
+    reset_peak_rss()
+    try:
+        fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        t1 = time.perf_counter()
+        for _ in range(iters):
+            fn()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+    except RuntimeError as e:
+        if "out of memory" not in str(e):
+            raise
+        return None
+    latency = (time.perf_counter() - t1) / iters
+    peak = torch.cuda.max_memory_allocated() / 1024 ** 2 if device.type == "cuda" \
+        else baseline_mb + rss_mb("VmHWM") - start_rss
+    return peak, latency
+
+
+def sweep(name, make_fn, device, budget, max_batch_size, baseline_mb=None):
+    '''
+    Probe make_fn(batch_size) at batch sizes 1, 2, 4, ... until it runs out of memory, goes over budget,
+    or the next size is predicted to go over budget from the growth of the last two.
+    Returns:
+        a list of {'batch_size', 'peak_mb', 'samples_per_sec'} within budget
+    '''
+    results = []
+    batch_size = 1
+    while batch_size <= max_batch_size:
+        res = probe(make_fn(batch_size), device, baseline_mb)
+        if res is None:
+            print("%-10s bs=%-5d out of memory" % (name, batch_size))
+            break
+        peak, latency = res
+        print("%-10s bs=%-5d peak %9.1f MB  %8.2f samples/s" % (name, batch_size, peak, batch_size / latency))
+        if peak > budget:
+            break
+        results.append({'batch_size': batch_size, 'peak_mb': peak, 'samples_per_sec': batch_size / latency})
+        if len(results) >= 2 and peak + 2 * (peak - results[-2]['peak_mb']) > budget:
+            break
+        batch_size *= 2
+    return results
+
+
+def best(results):
+    '''
+    The batch size of the highest throughput, the smaller one on a tie within 5%.
+    '''
+    if not results:
+        return None
+    top = max(r['samples_per_sec'] for r in results)
+    return min(r['batch_size'] for r in results if r['samples_per_sec'] >= top * 0.95)
+
+
+def write_arg(path, name, value):
+    '''
+    Set '--name value' (or the flag '--name' if value is True) in a shell script like train.sh,
+    adding the option after the first line if it is missing.
+    '''
+    script = open(path, encoding="utf-8").read()
+    pattern = r"(--%s)([ \t]+)([^\s\\]+)" % re.escape(name)
+    if value is not True and re.search(pattern, script):
+        script = re.sub(pattern, lambda m: m.group(1) + m.group(2) + str(value), script)
+    elif not re.search(r"--%s(?![\w-])" % re.escape(name), script):
+        option = "--%s" % name if value is True else "--%s %s" % (name, value)
+        command, _, rest = script.partition("\n")
+        script = "%s\n    %s \\\n%s" % (command, option, rest)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(script)
+
+
+def read_arg(path, name, default):
+    match = re.search(r"--%s\s+(\S+)" % re.escape(name), open(path, encoding="utf-8").read())
+    return type(default)(match.group(1)) if match else default
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", type=str, help="cpu or cuda")
+    parser.add_argument("--memory_budget_mb", default=0, type=float, \
+                        help="Memory budget, 90%% of the device or host memory if 0. On CPU keep it under the host memory: running out of it kills the process")
+    parser.add_argument("--max_batch_size", default=256, type=int, help="Largest batch size probed")
+    parser.add_argument("--fused_loss", action="store_true", help="Probe training with FusedLoss, as train.py --fused_loss")
+    parser.add_argument("--train_sh", default="train.sh", type=str, help="Training script to update")
+    parser.add_argument("--generate_sh", default="generate.sh", type=str, help="Generation script to update")
+    parser.add_argument("--write", action="store_true", help="Write the recommended settings into the scripts")
+    parser.add_argument("--seed", default=42, type=int, help="Random seed")
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    budget = args.memory_budget_mb or memory_budget_mb(device)
+    config = mydata_config()
+    seq_length = config.max_seq_length + 1 # with [SEP]
+    model = build_model(device)
+    vocab_size = model.decoder.gpt2.config.vocab_size
+    optimizer = AdamW(model.parameters(), lr=1e-5) # its states count in the peak, as in train.py
+    criterion = FusedLoss(config, model_cfgs) if args.fused_loss else MyLoss(config, model_cfgs)
+    eval_criterion = MyLoss(config, model_cfgs)
+    baseline = rss_mb() # the model and the optimizer, the CPU peaks are measured from it
+    print("Memory budget %.1f MB on %s, %d target positions, vocab size %d." % (budget, args.device, seq_length, vocab_size))
+
+    def train_step(batch_size):
+        batch = make_batch(batch_size, seq_length, vocab_size, device)
+
+        def fn():
+            model.train()
+            _, kl_loss, outputs = model(batch, return_hidden=args.fused_loss)
+            if args.fused_loss:
+                loss = criterion(outputs, model.decoder.gpt2.lm_head.weight, batch['targets'], batch['rating'], 3)
+            else:
+                loss = criterion(outputs, batch['targets'], batch['rating'], 3)
+            (loss.mean() + kl_loss).backward()
+            optimizer.step()
+            optimizer.zero_grad()
+        return fn
+
+    def eval_step(batch_size):
+        batch = make_batch(batch_size, seq_length, vocab_size, device)
+
+        def fn():
+            model.eval()
+            with torch.no_grad():
+                _, _, outputs = model(batch)
+                eval_criterion(outputs, batch['targets'], batch['rating'], 3)
+        return fn
+
+    def generation_step(batch_size):
+        # one step of --share_prefix sampling on top of a cache of all the target positions
+        batch = make_batch(1, seq_length - 1, vocab_size, device)
+        model.eval()
+        with torch.no_grad():
+            concat_output, _ = model.encode(batch)
+            past, attention_mask = model.decoder.prefill_prompt(batch['topic_ids'], \
+                batch['tpw_attention_mask'], batch['tpw_type_ids'])
+            _, past, attention_mask = model.decoder.step(concat_output, batch['targets'], 0, attention_mask, past)
+        ids = batch['targets'][:, -1:].expand(batch_size, -1)
+
+        def fn():
+            with torch.no_grad():
+                model.decoder.step(concat_output.expand(batch_size, -1, -1), ids, seq_length - 1, \
+                    attention_mask.expand(batch_size, -1), model.decoder.expand_cache(past, batch_size))
+        return fn
+
+    train_step(1)() # the AdamW states are created by the first step and kept by the later ones
+    train = sweep("train", train_step, device, budget, args.max_batch_size, \
+                  rss_mb() if device.type == "cpu" else baseline)
+    optimizer.state.clear()
+    evaluation = sweep("eval", eval_step, device, budget, args.max_batch_size, baseline)
+    generation = sweep("generate", generation_step, device, budget, args.max_batch_size, baseline)
+
+    train_bs, eval_bs, generate_rows = best(train), best(evaluation), best(generation)
+    if train_bs is None or eval_bs is None:
+        print("Even a batch of 1 does not fit in %.1f MB." % budget)
+        return
+    # the stage 1 loaders of train.py load 2 * batch_size samples, which DataParallel splits over device_ids
+    n_devices = len(read_arg(args.train_sh, "device_ids", "0").split(",")) if device.type == "cuda" else 1
+    batch_size = max(train_bs * n_devices // 2, 1)
+    val_batch_size = max(eval_bs * n_devices // 2, 1)
+    print("\nRecommended: train.sh --batch_size %d --val_batch_size %d (stage 1 loads twice as many, over %d device(s))" % \
+        (batch_size, val_batch_size, n_devices))
+    n_samples = read_arg(args.generate_sh, "n_samples", 10)
+    max_rows = max(r['batch_size'] for r in generation) if generation else 0
+    share_prefix = max_rows >= n_samples
+    if share_prefix:
+        print("Recommended: generate.sh --share_prefix (%d samples per experience fit, up to %d rows, best throughput at %d)" % \
+            (n_samples, max_rows, generate_rows))
+    else:
+        print("%d samples per experience do not fit as one batch (up to %d rows), keep sequential sampling in generate.sh" % \
+            (n_samples, max_rows))
+    if args.write:
+        write_arg(args.train_sh, "batch_size", batch_size)
+        write_arg(args.train_sh, "val_batch_size", val_batch_size)
+        if share_prefix:
+            write_arg(args.generate_sh, "share_prefix", True)
+        print("Updated %s%s." % (args.train_sh, " and " + args.generate_sh if share_prefix else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+
+import numpy as np
+import torch
+from transformers import BertTokenizer
+
+from configs import model_cfgs, data_config
+from model import MMTG, GPT2_DraftDecoder
+from adapters import load_model
+from loss import MyLoss, FusedLoss
+from generate import sampling_probs, sample_sequence, speculative_sample_sequence, load_draft
+from shortlist import Shortlist, SPECIAL_TOKENS
+from utils import rss_mb, reset_peak_rss
+
+
+def build_model(device, encoder_type=None):
+    '''
+    MMTG of configs.py and config/model_config.json with random weights, built without any download.
+    encoder_type: the type of the image and text encoders (RNN, LSTM, GRU or TRM), the one of configs.py if None
+    '''
+    cfgs = dict(model_cfgs, GPT2_PATH='', GPT2_NAME=None, TOKEN_EMB_PATH=None)
+    if encoder_type is not None:
+        cfgs.update({name: dict(model_cfgs[name], type=encoder_type) for name in ('image', 'text')})
+    model = MMTG(cfgs, data_config(), vocab_size=None, train_flag=True)
+    torch.nn.init.normal_(model.decoder.token_id2emb)
+    return model.to(device)
+
+
+def make_batch(batch_size, seq_length, vocab_size, device):
+    '''
+    A synthetic batch in the layout of MyDataset with seq_length target tokens.
+    '''
+    config = data_config()
+    sent_len = config.max_sent_length + 2
+    targets = torch.randint(105, vocab_size, (batch_size, seq_length))
+    positions = torch.arange(seq_length)
+    targets[:, positions % sent_len == 0] = 1 # [#START#]
+    targets[:, positions % sent_len == sent_len - 1] = 2 # [#EOS#]
+    batch = {
+        'topic_ids': torch.randint(105, vocab_size, (batch_size, config.topic_prompt_length)),
+        'tpw_attention_mask': torch.ones(batch_size, config.topic_prompt_length, dtype=torch.long),
+        'tpw_type_ids': torch.ones(batch_size, config.topic_prompt_length, dtype=torch.long),
+        'topic_emb': torch.randn(batch_size, config.wenlan_emb_size),
+        'img_embs': torch.randn(batch_size, model_cfgs['seq_len'], config.wenlan_emb_size),
+        'r_embs': torch.randn(batch_size, model_cfgs['seq_len'], config.wenlan_emb_size),
+        'targets': targets,
+        'attention_mask': torch.ones(batch_size, seq_length, dtype=torch.long),
+        'type_ids': torch.randint(0, 6, (batch_size, seq_length)),
+        'rating': torch.randint(1, 6, (batch_size,))
+    }
+    return {k: v.to(device) for k, v in batch.items()}
+
+
+def timeit(fn, warmup, iters, device):
+    '''
+    Run fn warmup + iters times and return the latencies of the last iters runs in ms.
+    '''
+    def sync():
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    for _ in range(iters):
+        sync()
+        t1 = time.perf_counter()
+        fn()
+        sync()
+        latencies.append((time.perf_counter() - t1) * 1000)
+    return latencies
+
+
+def components(model, tokenizer, batch, device, draft=None, stats=None):
+    '''
+    The benchmarked callables on a batch, name -> fn.
+    The generation components decode the first experience of the batch, 'speculative_sample' with draft,
+    and add its proposed and accepted draft tokens to stats.
+    '''
+    config = data_config()
+    criterion = MyLoss(config, model_cfgs)
+    fused_criterion = FusedLoss(config, model_cfgs)
+    encoder_batch = {'topic': batch['topic_emb'], \
+                     'image': batch['img_embs'].transpose(0, 1), \
+                     'text': batch['r_embs'].transpose(0, 1)}
+    with torch.no_grad():
+        topic_output, image_output, text_output = model.encoder(encoder_batch)
+        img_inner_output, _ = model.img_inner_atten_layer(image_output.transpose(0, 1))
+        text_inner_output, _ = model.text_inner_atten_layer(text_output.transpose(0, 1))
+        concat_output, _ = model.encode(batch)
+        vocab_size = model.decoder.gpt2.config.vocab_size
+        logits = torch.randn(batch['targets'].size(0), config.topic_prompt_length + batch['targets'].size(1), vocab_size, device=device)
+        # a prefix of the targets as the past of one sampling step
+        _, past, attention_mask = model.decoder.prefill(concat_output, batch['targets'][:, :-1], \
+            batch['topic_ids'], batch['tpw_attention_mask'], batch['tpw_type_ids'])
+    token_counts = torch.zeros(batch['targets'].size(0), vocab_size, device=device)
+    token_counts.scatter_add_(1, batch['targets'], torch.ones_like(batch['targets'], dtype=token_counts.dtype))
+    last_pos = batch['targets'].size(1) - 1
+    # a quarter of the vocabulary stands for a shortlist of the training tokens
+    shortlist = Shortlist(list(range(0, vocab_size, 4)) + tokenizer.convert_tokens_to_ids(SPECIAL_TOKENS), vocab_size).to(device)
+    shortlist_counts = token_counts[:, shortlist.ids]
+    model.decoder.set_shortlist(shortlist.ids)
+    shortlist_weight = model.decoder.shortlist_weight # set for the timed step only, the other components use the full head
+    model.decoder.set_shortlist(None)
+    # the first experience with only the opening [#START#], as generate.py starts from it
+    start_input = {k: v[0, :1].tolist() if k == 'targets' else v[0].tolist() for k, v in batch.items()}
+    seq_length = batch['targets'].size(1)
+
+    def sample(next_token_logits):
+        probs = sampling_probs(next_token_logits, token_counts, tokenizer, 1.1, 10, 0.7, 1.5)
+        return torch.multinomial(probs, num_samples=1)
+
+    def sample_shortlist(next_token_logits):
+        probs = sampling_probs(next_token_logits, shortlist_counts, tokenizer, 1.1, 10, 0.7, 1.5, shortlist)
+        return shortlist.ids[torch.multinomial(probs, num_samples=1)]
+
+    def decoder_inputs():
+        input_embs = torch.cat([model.decoder.token_id2emb[batch['topic_ids']], \
+            model.decoder.embed_targets(concat_output, batch['targets'])], dim=1)
+        model.decoder.project(input_embs)
+        torch.cat([batch['tpw_type_ids'], model.decoder.inference_type_ids(batch['targets'])], dim=1)
+        torch.cat([batch['tpw_attention_mask'], (batch['targets'] != 0).long()], dim=1)
+
+    def sample_step():
+        model.train_flag = False
+        _, _, outputs = model(batch)
+        model.train_flag = True
+        sample(outputs[:, -1, :])
+
+    def sample_step_cached():
+        outputs, _, _ = model.decoder.step(concat_output, batch['targets'][:, -1:], last_pos, attention_mask, past)
+        sample(outputs[:, -1, :])
+
+    def sample_step_shortlist():
+        model.decoder.shortlist_weight = shortlist_weight
+        outputs, _, _ = model.decoder.step(concat_output, batch['targets'][:, -1:], last_pos, attention_mask, past)
+        model.decoder.shortlist_weight = None
+        sample_shortlist(outputs[:, -1, :])
+
+    def generate():
+        model.train_flag = False
+        sample_sequence(model, dict(start_input), seq_length - 1, tokenizer, 1.1, 10, 0.7, 1.5, device)
+        model.train_flag = True
+
+    def generate_speculative():
+        speculative_sample_sequence(model, draft, start_input, seq_length, tokenizer, 1.1, 10, 0.7, 1.5, \
+            device=device, stats=stats)
+
+    def train_step():
+        model.train()
+        _, kl_loss, outputs = model(batch)
+        loss = criterion(outputs, batch['targets'], batch['rating'], 3) + kl_loss
+        loss.backward()
+        model.zero_grad()
+        model.eval()
+
+    def train_step_fused():
+        model.train()
+        _, kl_loss, hidden_states = model(batch, return_hidden=True)
+        loss = fused_criterion(hidden_states, model.decoder.gpt2.lm_head.weight, batch['targets'], batch['rating'], 3) + kl_loss
+        loss.backward()
+        model.zero_grad()
+        model.eval()
+
+    return {
+        'encoder': (False, lambda: model.encoder(encoder_batch)),
+        'alpha_attention': (False, lambda: model.img_inner_atten_layer(image_output.transpose(0, 1))),
+        'beta_attention': (False, lambda: model.mm_atten_layer(topic_output, \
+            img_inner_output.transpose(0, 1), text_inner_output.transpose(0, 1))),
+        'decoder_inputs': (True, decoder_inputs),
+        'mmtg_forward': (True, lambda: model(batch)),
+        'loss': (True, lambda: criterion(logits, batch['targets'], batch['rating'], 3)),
+        'sample_step': (True, sample_step),
+        'sample_step_cached': (True, sample_step_cached),
+        'sample_step_shortlist': (True, sample_step_shortlist),
+        'train_step': (True, train_step),
+        'train_step_fused': (True, train_step_fused),
+        'sample_sequence': (True, generate),
+        'speculative_sample': (True, generate_speculative),
+    }
+
+
+# decode one experience whatever the batch size
+GENERATION_COMPONENTS = ('sample_sequence', 'speculative_sample')
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    '''
+    Print the latency of each result relative to the same entry of a previous run.
+    '''
+    baseline = json.load(open(baseline_path, encoding="utf-8"))
+    old = {(r['component'], r['batch_size'], r['seq_length']): r for r in baseline['results']}
+    print("\n%-20s %5s %7s %12s %12s %8s" % ("component", "bs", "seq_len", "old p50 ms", "new p50 ms", "ratio"))
+    for r in results:
+        key = (r['component'], r['batch_size'], r['seq_length'])
+        if key in old:
+            print("%-20s %5d %7s %12.2f %12.2f %8.2f" % (r['component'], r['batch_size'], r['seq_length'], \
+                old[key]['latency_ms']['p50'], r['latency_ms']['p50'], r['latency_ms']['p50'] / old[key]['latency_ms']['p50']))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_sizes", default="1,8,32", type=str, help="Comma separated batch sizes")
+    parser.add_argument("--seq_lengths", default="44,110,221", type=str, help="Comma separated numbers of target tokens")
+    parser.add_argument("--components", default="", type=str, help="Comma separated components to run, all but %s by default" % \
+                        " and ".join(GENERATION_COMPONENTS))
+    parser.add_argument("--warmup", default=2, type=int, help="Warmup iterations")
+    parser.add_argument("--iters", default=10, type=int, help="Timed iterations")
+    parser.add_argument("--threads", default=0, type=int, help="torch intra-op threads, 0 to keep the default")
+    parser.add_argument("--encoder_type", default="", type=str, help="RNN, LSTM, GRU or TRM image and text encoders, the type of configs.py if empty")
+    parser.add_argument("--model_path", default="", type=str, help="Checkpoint to benchmark instead of the random weights, e.g. for the draft acceptance rate")
+    parser.add_argument("--draft_layers", default=2, type=int, help="Number of GPT2 blocks of the draft decoder of speculative_sample")
+    parser.add_argument("--draft_path", default="", type=str, help="Optional checkpoint of a trained draft decoder, as generate.py --draft_path")
+    parser.add_argument("--device", default="cpu", type=str, help="cpu or cuda")
+    parser.add_argument("--seed", default=42, type=int, help="Random seed")
+    parser.add_argument("--output", default="", type=str, help="Write the results to this json file")
+    parser.add_argument("--compare", default="", type=str, help="A previous json output to compare with")
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    tokenizer = BertTokenizer.from_pretrained("./vocab/vocab.txt")
+    if args.model_path:
+        model, _ = load_model(args.model_path, tokenizer, data_config())
+        model.train_flag = True # as build_model()
+        model.to(device)
+    else:
+        model = build_model(device, args.encoder_type or None)
+    model.eval()
+    draft = GPT2_DraftDecoder(model.decoder, args.draft_layers)
+    if args.draft_path:
+        load_draft(draft, args.draft_path)
+    draft.to(device).eval()
+    vocab_size = model.decoder.gpt2.config.vocab_size
+    batch_sizes = [int(item) for item in args.batch_sizes.split(",")]
+    seq_lengths = [int(item) for item in args.seq_lengths.split(",")]
+    selected = args.components.split(",") if args.components else None
+    stats = {}
+
+    results = []
+    for batch_size in batch_sizes:
+        for i, seq_length in enumerate(seq_lengths):
+            batch = make_batch(batch_size, seq_length, vocab_size, device)
+            for name, (uses_seq, fn) in components(model, tokenizer, batch, device, draft, stats).items():
+                if name not in selected if selected is not None else name in GENERATION_COMPONENTS:
+                    continue
+                if not uses_seq and i > 0: # does not depend on the target length
+                    continue
+                if name in GENERATION_COMPONENTS and batch_size > 1:
+                    continue
+                stats.clear()
+                baseline_rss = rss_mb()
+                reset_peak_rss()
+                if device.type == "cuda":
+                    torch.cuda.reset_peak_memory_stats()
+                if name.startswith('train_step'):
+                    latencies = timeit(fn, args.warmup, args.iters, device)
+                else:
+                    with torch.no_grad():
+                        latencies = timeit(fn, args.warmup, args.iters, device)
+                record = {
+                    'component': name,
+                    'batch_size': batch_size,
+                    'seq_length': seq_length if uses_seq else None,
+                    'latency_ms': {
+                        'mean': float(np.mean(latencies)),
+                        'p50': float(np.percentile(latencies, 50)),
+                        'p90': float(np.percentile(latencies, 90)),
+                        'min': float(np.min(latencies))
+                    },
+                    'samples_per_sec': batch_size / (np.mean(latencies) / 1000),
+                    'peak_rss_mb': rss_mb("VmHWM"),
+                    'rss_delta_mb': rss_mb("VmHWM") - baseline_rss
+                }
+                if uses_seq:
+                    record['tokens_per_sec'] = batch_size * seq_length / (np.mean(latencies) / 1000)
+                if stats.get('proposed'):
+                    record['acceptance_rate'] = stats['accepted'] / stats['proposed']
+                if device.type == "cuda":
+                    record['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 1024 ** 2
+                results.append(record)
+                line = "%-20s bs=%-4d seq_len=%-5s p50=%9.2f ms  %10.1f samples/s  peak RSS %8.1f MB" % \
+                    (name, batch_size, record['seq_length'], record['latency_ms']['p50'], record['samples_per_sec'], record['peak_rss_mb'])
+                if name in GENERATION_COMPONENTS:
+                    line += "  %8.1f tokens/s" % record['tokens_per_sec']
+                if 'acceptance_rate' in record:
+                    line += "  acceptance %.3f" % record['acceptance_rate']
+                print(line)
+
+    if args.output:
+        output = {
+            'meta': {
+                'git_revision': git_revision(),
+                'torch': torch.__version__,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'device': args.device,
+                'threads': torch.get_num_threads(),
+                'encoder_type': args.encoder_type or model_cfgs['image']['type'],
+                'model_path': args.model_path or None,
+                'draft_layers': args.draft_layers,
+                'draft_path': args.draft_path or None,
+                'warmup': args.warmup,
+                'iters': args.iters
+            },
+            'results': results
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+        print("Results saved to {}".format(args.output))
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
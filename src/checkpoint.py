@@ -0,0 +1,209 @@
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+import torch
+
+from utils import strip_module_prefix
+
+
+# The layout is the one of safetensors: an 8-byte little-endian header size, a json header of
+# {name: {'dtype', 'shape', 'data_offsets'}} and the raw little-endian tensor bytes.
+# It is written and memory-mapped with numpy only, so safetensors does not need to be installed.
+DTYPES = {
+    torch.float32: ('F32', np.float32),
+    torch.float16: ('F16', np.float16),
+    torch.float64: ('F64', np.float64),
+    torch.bfloat16: ('BF16', np.int16), # numpy has no bfloat16, the bits are kept as int16
+    torch.int64: ('I64', np.int64),
+    torch.int32: ('I32', np.int32),
+    torch.int16: ('I16', np.int16),
+    torch.int8: ('I8', np.int8),
+    torch.uint8: ('U8', np.uint8),
+    torch.bool: ('BOOL', np.bool_),
+}
+NAME2DTYPE = {name: (torch_dtype, np_dtype) for torch_dtype, (name, np_dtype) in DTYPES.items()}
+
+
+def cpu_snapshot(state_dict, fp16=False):
+    '''
+    Copy a state dict to CPU without the DataParallel prefix, optionally with float32 tensors as float16.
+    The copy is independent from the training weights, so it can be written while training goes on.
+    '''
+    snapshot = {}
+    for key, value in strip_module_prefix(state_dict).items():
+        value = value.detach()
+        if fp16 and value.dtype == torch.float32:
+            value = value.half()
+        snapshot[key] = value.to("cpu", copy=True).contiguous()
+    return snapshot
+
+
+def trainable_state_dict(module):
+    '''
+    The entries of the state dict of module that are trainable parameters, e.g. the delta of a model with a frozen decoder.
+    '''
+    names = {name for name, param in module.named_parameters() if param.requires_grad}
+    return {key: value for key, value in module.state_dict().items() if key in names}
+
+
+def save_tensors(tensors, path, metadata=None):
+    '''
+    Write a dict of CPU tensors to path in the safetensors layout, through a temporary file.
+    Args:
+        metadata: dict of str -> str stored in the header
+    '''
+    header = {}
+    offset = 0
+    for key, value in tensors.items():
+        nbytes = value.numel() * value.element_size()
+        header[key] = {'dtype': DTYPES[value.dtype][0], 'shape': list(value.shape), 'data_offsets': [offset, offset + nbytes]}
+        offset += nbytes
+    if metadata:
+        header['__metadata__'] = metadata
+    header = json.dumps(header, separators=(',', ':')).encode("utf-8")
+    header += b' ' * (-len(header) % 8)
+    tmp_path = path + ".tmp%d" % os.getpid() # processes may write the same file at once
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for value in tensors.values():
+            if value.dtype == torch.bfloat16:
+                value = value.view(torch.int16)
+            f.write(value.numpy().tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_tensors(path, mmap=True):
+    '''
+    Read a file written by save_tensors(). With mmap, the tensors are copy-on-write views of the mapped file,
+    so nothing is read until it is used and the pages are shared with the page cache.
+    Returns:
+        tensors: dict of str -> tensor, metadata: dict of str -> str
+    '''
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size).decode("utf-8"))
+    metadata = header.pop('__metadata__', {})
+    start = 8 + header_size
+    if mmap:
+        buffer = np.memmap(path, dtype=np.uint8, mode="c")
+    else:
+        buffer = np.fromfile(path, dtype=np.uint8)
+    tensors = {}
+    for key, info in header.items():
+        torch_dtype, np_dtype = NAME2DTYPE[info['dtype']]
+        begin, end = info['data_offsets']
+        array = buffer[start + begin:start + end].view(np_dtype).reshape(info['shape'])
+        tensor = torch.from_numpy(array)
+        if torch_dtype == torch.bfloat16:
+            tensor = tensor.view(torch.bfloat16)
+        tensors[key] = tensor
+    return tensors, metadata
+
+
+def save_checkpoint(state_dict, path, model_cfgs, args=None):
+    '''
+    Save a CPU state dict as path. A '.pth' path keeps the torch.save format of train.py,
+    any other path is written in the safetensors layout with model_cfgs and args in the header.
+    '''
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    if path.endswith(".pth"):
+        torch.save({'model': state_dict, 'args': args, 'model_cfgs': model_cfgs}, path)
+        return
+    metadata = {'format': 'mmtg', 'model_cfgs': json.dumps(model_cfgs)}
+    if args is not None:
+        metadata['args'] = json.dumps(vars(args), default=str)
+    save_tensors(state_dict, path, metadata)
+
+
+def load_checkpoint(path, mmap=True):
+    '''
+    Load a checkpoint of either format.
+    Returns:
+        state_dict without the DataParallel prefix, model_cfgs (None if not stored)
+    '''
+    if path.endswith(".pth"):
+        checkpoint = torch.load(path, map_location="cpu")
+        return strip_module_prefix(checkpoint['model']), checkpoint.get('model_cfgs')
+    state_dict, metadata = load_tensors(path, mmap=mmap)
+    model_cfgs = json.loads(metadata['model_cfgs']) if 'model_cfgs' in metadata else None
+    return state_dict, model_cfgs
+
+
+def as_safetensors(path):
+    '''
+    A memory-mappable version of the checkpoint at path: path itself, or for a '.pth' checkpoint
+    a '.safetensors' file next to it, converted on first use.
+    '''
+    if not path.endswith(".pth"):
+        return path
+    out_path = path[:-len(".pth")] + ".safetensors"
+    if not os.path.exists(out_path) or os.path.getmtime(out_path) < os.path.getmtime(path):
+        state_dict, model_cfgs = load_checkpoint(path)
+        save_checkpoint(state_dict, out_path, model_cfgs)
+    return out_path
+
+
+def share_weights(module, state_dict):
+    '''
+    Point the parameters and buffers of module at the tensors of state_dict instead of copying them,
+    like load_state_dict(strict=True) otherwise. With a state dict from load_tensors(path, mmap=True),
+    all processes that load the same file map the same physical pages, and a process only pays for its activations.
+    A tensor of another dtype than the module's (e.g. a float16 checkpoint) is cast, which makes a private copy.
+    '''
+    state_dict = strip_module_prefix(state_dict)
+    own_state = module.state_dict(keep_vars=True)
+    missing = [key for key in own_state if key not in state_dict]
+    unexpected = [key for key in state_dict if key not in own_state]
+    if missing or unexpected:
+        raise RuntimeError("Error(s) in sharing state_dict: missing keys %s, unexpected keys %s" % (missing, unexpected))
+    for key, tensor in own_state.items():
+        value = state_dict[key]
+        if value.shape != tensor.shape:
+            raise RuntimeError("Size mismatch for %s: %s in the checkpoint, %s in the model" % \
+                               (key, tuple(value.shape), tuple(tensor.shape)))
+        tensor.data = value.to(tensor.dtype)
+
+
+class AsyncCheckpointer(object):
+    def __init__(self, fp16=False, trainable_only=False):
+        '''
+        Save checkpoints in a background thread. save() only takes a CPU snapshot of the weights
+        and returns; at most one write is in flight, a new save() waits for the previous one.
+        Args:
+            fp16: bool, store the float32 weights as float16
+            trainable_only: bool, only store the trainable parameters (see trainable_state_dict())
+        '''
+        self.fp16 = fp16
+        self.trainable_only = trainable_only
+        self._thread = None
+        self._error = None
+
+    def save(self, model, path, model_cfgs, args=None):
+        self.wait()
+        state_dict = trainable_state_dict(model) if self.trainable_only else model.state_dict()
+        snapshot = cpu_snapshot(state_dict, fp16=self.fp16)
+
+        def write():
+            try:
+                save_checkpoint(snapshot, path, model_cfgs, args)
+            except Exception as e:
+                self._error = e
+
+        self._thread = threading.Thread(target=write, daemon=True)
+        self._thread.start()
+
+    def wait(self):
+        '''
+        Block until the pending write is done, and raise its error if it failed.
+        '''
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
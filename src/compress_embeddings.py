@@ -0,0 +1,262 @@
+import argparse
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from transformers import BertTokenizer
+
+from configs import data_config as mydata_config
+from model import MMTG
+from MyDataset import MyDataset, batch_to_device, save_dedup_data
+from loss import MyLoss
+from checkpoint import save_checkpoint, save_tensors, load_tensors, cpu_snapshot
+from adapters import load_model
+from prune import batch_loss
+
+
+def input_layers(cfgs):
+    '''
+    (modality, weight, bias) of the layers of the encoder that read the WenLan embeddings, see MultiModalEncoder:
+    topic_fc, the first layer of the RNNs or the input projection of the TRM encoders.
+    '''
+    layers = [('topic', 'encoder.topic_fc.weight', 'encoder.topic_fc.bias')]
+    for name, module in (('image', 'rnns_image'), ('text', 'rnns_text')):
+        if cfgs[name]['type'] == 'TRM':
+            layers.append((name, 'encoder.%s.input_fc.weight' % module, 'encoder.%s.input_fc.bias' % module))
+        else:
+            layers.append((name, 'encoder.%s.weight_ih_l0' % module, 'encoder.%s.bias_ih_l0' % module))
+    return layers
+
+
+def embedding_refs(dataset):
+    '''
+    (sample index, key) of every '*_emb' of the samples of a MyDataset.
+    '''
+    return [(i, key) for i, item in enumerate(dataset.data) for key in item if key.endswith('_emb')]
+
+
+def fit_pca(dataset, dim, max_vectors=200000, seed=42, chunk_size=4096):
+    '''
+    Fit a PCA of the WenLan embeddings of the samples of dataset, on at most max_vectors of them drawn at random.
+    Returns:
+        mean: [emb_size], components: [emb_size, dim] (orthonormal columns), the fraction of variance kept by the dim components
+    '''
+    refs = embedding_refs(dataset)
+    if len(refs) > max_vectors:
+        rng = np.random.RandomState(seed)
+        refs = [refs[i] for i in sorted(rng.choice(len(refs), max_vectors, replace=False))]
+    total, cov = None, None
+    for start in range(0, len(refs), chunk_size):
+        x = torch.from_numpy(np.stack([np.asarray(dataset.embedding(dataset.data[i][key]), dtype=np.float64) \
+                                       for i, key in refs[start:start + chunk_size]]))
+        total = x.sum(0) if total is None else total + x.sum(0)
+        cov = x.T @ x if cov is None else cov + x.T @ x
+    mean = total / len(refs)
+    cov = cov / len(refs) - torch.outer(mean, mean)
+    eigvals, eigvecs = torch.linalg.eigh(cov) # ascending
+    eigvals, eigvecs = eigvals.flip(0).clamp(min=0), eigvecs.flip(1)
+    kept = (eigvals[:dim].sum() / eigvals.sum()).item()
+    return mean.float(), eigvecs[:, :dim].float().contiguous(), kept
+
+
+def save_projection(mean, components, path):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    save_tensors({'mean': mean, 'components': components}, path, {'dim': str(components.size(1))})
+
+
+def load_projection(path):
+    tensors = load_tensors(path, mmap=False)[0]
+    return tensors['mean'], tensors['components']
+
+
+def project(x, mean, components):
+    '''
+    The coordinates of embeddings x ([..., emb_size] array) in the PCA basis, as float32.
+    '''
+    x = torch.as_tensor(np.asarray(x, dtype=np.float32))
+    return ((x - mean) @ components).numpy()
+
+
+def reconstruction_error(dataset, mean, components, max_vectors=20000, seed=42):
+    '''
+    Relative squared error ||x - x_hat||^2 / ||x - mean||^2 and mean cosine similarity of x and x_hat
+    of at most max_vectors embeddings of dataset, x_hat being the reconstruction from the PCA coordinates.
+    '''
+    refs = embedding_refs(dataset)
+    if len(refs) > max_vectors:
+        rng = np.random.RandomState(seed)
+        refs = [refs[i] for i in rng.choice(len(refs), max_vectors, replace=False)]
+    x = torch.from_numpy(np.stack([np.asarray(dataset.embedding(dataset.data[i][key]), dtype=np.float32) for i, key in refs]))
+    x_hat = (x - mean) @ components @ components.T + mean
+    error = ((x - x_hat) ** 2).sum() / ((x - mean) ** 2).sum()
+    cosine = torch.nn.functional.cosine_similarity(x, x_hat, dim=1).mean()
+    return error.item(), cosine.item()
+
+
+def data_files(data_path):
+    '''
+    data_path and the embedding table of a deduplicated data file.
+    '''
+    data = pickle.load(open(data_path, "rb"))
+    if isinstance(data, dict) and 'embeddings' in data:
+        return [data_path, os.path.join(os.path.dirname(data_path), data['embeddings'])]
+    return [data_path]
+
+
+def compress_data(data_path, output, mean, components, emb_dtype=np.float32):
+    '''
+    Write the data file data_path with the '*_emb' vectors replaced by their PCA coordinates, in the same layout:
+    a pickled list of samples, or a deduplicated file whose embedding table is projected instead.
+    Returns:
+        the paths written
+    '''
+    data = pickle.load(open(data_path, "rb"))
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    if isinstance(data, dict) and 'embeddings' in data: # deduplicated layout, the references are kept
+        table_path = os.path.join(os.path.dirname(data_path), data['embeddings'])
+        table = load_tensors(table_path)[0]['embeddings'].float().numpy()
+        table = project(table, mean, components)
+        hashes = [hashlib.sha1(row.tobytes()).hexdigest() for row in table]
+        return [output, save_dedup_data(data['samples'], table.astype(emb_dtype), hashes, output)]
+    samples = []
+    for item in data:
+        sample = dict(item)
+        for key, value in item.items():
+            if key.endswith('_emb'):
+                sample[key] = project(value, mean, components).astype(emb_dtype)
+        samples.append(sample)
+    with open(output, 'wb') as f:
+        pickle.dump(samples, f)
+    return [output]
+
+
+def fold_projection(state_dict, cfgs, mean, components):
+    '''
+    Fold the PCA into the input layers of the encoder: W x + b = W (mean + C z) + b = (W C) z + (b + W mean)
+    for the coordinates z of x, so the folded layers on z compute what the original ones computed on the
+    reconstruction of x. Only the first layer of the RNNs reads the inputs.
+    Returns:
+        the folded state dict (the other tensors are shared)
+    '''
+    state_dict = dict(state_dict)
+    for _, weight, bias in input_layers(cfgs):
+        w = state_dict[weight].float()
+        state_dict[weight] = (w @ components).to(state_dict[weight].dtype)
+        state_dict[bias] = (state_dict[bias].float() + w @ mean).to(state_dict[bias].dtype)
+    return state_dict
+
+
+def build(state_dict, cfgs, tokenizer, data_config, device):
+    model = MMTG(cfgs, data_config, len(tokenizer.vocab), False)
+    model.load_state_dict(state_dict)
+    return model.to(device).eval()
+
+
+def val_loss(model, data_path, tokenizer, data_config, criterion, stage, batch_size, n_batches, device):
+    '''
+    The mean MyLoss objective of train.py on the first n_batches batches of data_path (all if 0).
+    '''
+    model.train_flag = True # the teacher-forced decoder of train.py
+    losses = []
+    with torch.no_grad():
+        for batch in DataLoader(MyDataset(data_path, tokenizer, data_config), batch_size=batch_size, shuffle=False):
+            if n_batches and len(losses) == n_batches:
+                break
+            losses.append(batch_loss(model, batch_to_device(batch, device), criterion, stage).mean().item())
+    model.train_flag = False
+    return sum(losses) / max(len(losses), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--train_data_path", default="", type=str, help="Data the PCA is fitted on, compressed too")
+    parser.add_argument("--val_data_path", default="", type=str, help="Val data of the report, compressed too")
+    parser.add_argument("--data_paths", default="", type=str, help="Comma separated more data files to compress, e.g. the test data")
+    parser.add_argument("--output_dir", default="./data/pca", type=str, help="Directory of the compressed data files, with the same names")
+    parser.add_argument("--dim", default=256, type=int, help="Number of PCA components")
+    parser.add_argument("--max_fit_vectors", default=200000, type=int, help="Number of embeddings the PCA is fitted on at most")
+    parser.add_argument("--projection_path", default="", type=str, \
+                        help="Apply this projection of an earlier run instead of fitting one, or write the fitted one here (output_dir/projection.safetensors if empty)")
+    parser.add_argument("--emb_dtype", default="float32", choices=["float32", "float16"], help="dtype of the compressed embeddings")
+    parser.add_argument("--model_path", default="", type=str, help="Checkpoint whose encoder input layers are folded with the projection")
+    parser.add_argument("--output_model", default="", type=str, help="Folded checkpoint, next to the data files if empty")
+    parser.add_argument("--tokenizer_path", default="./vocab/vocab.txt", type=str, help="词表路径")
+    parser.add_argument("--stage", default=3, type=int, help="Curriculum stage of the MyLoss objective of the report")
+    parser.add_argument("--batch_size", default=8, type=int, help="Batch size of the report")
+    parser.add_argument("--n_batches", default=0, type=int, help="Number of val batches of the report, all if 0")
+    parser.add_argument("--seed", default=42, type=int, help="Random seed")
+    parser.add_argument("--report", default="", type=str, help="Write the report to this json file")
+    args = parser.parse_args()
+    if not args.train_data_path and not (args.projection_path and os.path.exists(args.projection_path)):
+        parser.error("--train_data_path is needed to fit the PCA, unless --projection_path is an existing projection")
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    data_config = mydata_config()
+    tokenizer = BertTokenizer.from_pretrained(args.tokenizer_path)
+    train_data = MyDataset(args.train_data_path, tokenizer, data_config, False) if args.train_data_path else None
+    report = {}
+    if args.projection_path and os.path.exists(args.projection_path):
+        mean, components = load_projection(args.projection_path)
+        print("Projection to %d dims loaded from %s." % (components.size(1), args.projection_path))
+    else:
+        mean, components, kept = fit_pca(train_data, args.dim, args.max_fit_vectors, args.seed)
+        args.projection_path = args.projection_path or os.path.join(args.output_dir, "projection.safetensors")
+        save_projection(mean, components, args.projection_path)
+        report['explained_variance'] = kept
+        print("PCA to %d dims fitted on %s, %.2f%% of the variance kept, saved to %s." % (args.dim, \
+            args.train_data_path, kept * 100, args.projection_path))
+    report['dim'] = components.size(1)
+    report['projection_path'] = args.projection_path
+
+    paths = []
+    for path in [args.train_data_path, args.val_data_path] + args.data_paths.split(","):
+        if path and path not in paths:
+            paths.append(path)
+    compressed = {}
+    report['data'] = {}
+    for path in paths:
+        compressed[path] = os.path.join(args.output_dir, os.path.basename(path))
+        written = compress_data(path, compressed[path], mean, components, np.dtype(args.emb_dtype))
+        error, cosine = reconstruction_error(MyDataset(path, tokenizer, data_config, False), mean, components, seed=args.seed)
+        old_size = sum(os.path.getsize(p) for p in data_files(path))
+        new_size = sum(os.path.getsize(p) for p in written)
+        report['data'][path] = {'output': written, 'relative_error': error, 'cosine': cosine, \
+                                'size_mb': old_size / 1024 ** 2, 'compressed_size_mb': new_size / 1024 ** 2}
+        print("%s -> %s: relative reconstruction error %.4f, cosine %.4f, %.1f MB -> %.1f MB." % (path, \
+            compressed[path], error, cosine, old_size / 1024 ** 2, new_size / 1024 ** 2))
+
+    if args.model_path:
+        model, ckpt_cfgs = load_model(args.model_path, tokenizer, data_config)
+        state_dict = cpu_snapshot(model.state_dict())
+        dim = components.size(1)
+        folded_cfgs = dict(ckpt_cfgs)
+        for name, _, _ in input_layers(ckpt_cfgs):
+            folded_cfgs[name] = dict(ckpt_cfgs[name], input_dim=dim)
+        folded = fold_projection(state_dict, ckpt_cfgs, mean, components)
+        output_model = args.output_model or os.path.join(args.output_dir, "model_pca%d.safetensors" % dim)
+        save_checkpoint(cpu_snapshot(folded), output_model, folded_cfgs)
+        print("Folded checkpoint saved to %s." % output_model)
+        if args.val_data_path:
+            criterion = MyLoss(data_config, ckpt_cfgs)
+            base = val_loss(model.to(device).eval(), args.val_data_path, \
+                            tokenizer, data_config, criterion, args.stage, args.batch_size, args.n_batches, device)
+            loss = val_loss(build(folded, folded_cfgs, tokenizer, data_config, device), compressed[args.val_data_path], \
+                            tokenizer, data_config, criterion, args.stage, args.batch_size, args.n_batches, device)
+            report.update({'val_loss': base, 'compressed_val_loss': loss})
+            print("Val loss %.4f on the original embeddings, %.4f on the compressed ones (%+.4f)." % (base, loss, loss - base))
+
+    if args.report:
+        os.makedirs(os.path.dirname(os.path.abspath(args.report)), exist_ok=True)
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print("Report saved to {}".format(args.report))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,7 @@ LastEditTime: 2022-08-10 19:18:19
 # input_dim: [int], input dimension
 # hidden_dim: [int], hidden dimension
 # num_layers: [int], number of layers
+# attention_heads, ff_dim, causal: [int], [int], [bool], optional for TRM, 4, 2 * hidden_dim and True by default
 model_cfgs = {
     'seq_len': 5, # 10 lyrics sentences = seq_len * 2
     'topic': {
@@ -37,9 +38,20 @@ model_cfgs = {
         'attention_dim': 1
     },
     'GPT2_PATH': './pretrained/GPT2_lyrics_ckpt_epoch00.ckpt',
+    'GPT2_NAME': 'uer/gpt2-chinese-cluecorpussmall', # None to build GPT2 from GPT2_CONFIG only
+    'GPT2_CONFIG': 'config/model_config.json',
+    'TOKEN_EMB_PATH': './vocab/token_id2emb_dict.pkl', # None for an all-zero table (benchmarks)
     'dropout': 0.1
 }
 
+# The smaller MMTG distilled from the full one by distill.py.
+# The hidden dims of topic, image, text and SELF_ATT can also be narrowed (e.g. 256) together.
+student_model_cfgs = dict(model_cfgs, **{
+    'GPT2_PATH': '', # initialized from the teacher instead
+    'GPT2_NAME': None,
+    'GPT2_CONFIG': 'config/student_model_config.json'
+})
+
 class data_config():
     def __init__(self):
         self.topic_prompt_length = 15
@@ -0,0 +1,34 @@
+import argparse
+import os
+import pickle
+import time
+
+import numpy as np
+
+from MyDataset import dedup_embeddings, save_dedup_data
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", default="", type=str, help="A data pickle of MyDataset with inline embeddings")
+    parser.add_argument("--output", default="", type=str, help="Deduplicated data file, the table is written next to it as '.emb.safetensors'")
+    parser.add_argument("--emb_dtype", default="float32", choices=["float32", "float16"], help="dtype of the embedding table")
+    args = parser.parse_args()
+
+    t1 = time.time()
+    data = pickle.load(open(args.data_path, "rb"))
+    load_time = time.time() - t1
+    samples, table, hashes = dedup_embeddings(data, np.dtype(args.emb_dtype))
+    n_refs = sum(1 for item in data for key in item if key.endswith('_emb'))
+    if os.path.dirname(args.output):
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    table_path = save_dedup_data(samples, table, hashes, args.output)
+    print("%d samples, %d embeddings, %d unique (reuse rate %.2f)." % (len(data), n_refs, len(table), 1 - len(table) / max(n_refs, 1)))
+    old_size = os.path.getsize(args.data_path)
+    new_size = os.path.getsize(args.output) + os.path.getsize(table_path)
+    print("%.1f MB -> %.1f MB (%s and %s), loaded in %.2fs before." % (old_size / 1024 ** 2, new_size / 1024 ** 2, \
+        args.output, table_path, load_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+import argparse
+import logging
+import os
+import random
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+from tqdm import tqdm
+from transformers import AdamW, BertTokenizer, get_linear_schedule_with_warmup
+
+from configs import student_model_cfgs, data_config
+from model import MMTG
+from MyDataset import MyDataset, batch_to_device
+from utils import *
+from loss import MyLoss, DistillLoss
+from training import curriculum_stage, stage_indices, stage_loaders, training_steps, compute_loss, teacher_logits, evaluate
+from checkpoint import AsyncCheckpointer
+from adapters import load_model
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--device_ids", default="0", type=str, help="GPU device ids")
+parser.add_argument("--batch_size", default=32, type=int, help="Batch size")
+parser.add_argument("--val_batch_size", default=32, type=int, help="Eval batch size")
+parser.add_argument("--epochs", default=5, type=int, help="Number of epochs")
+parser.add_argument("--lr", default=1e-04, type=float, help="Learning rate")
+parser.add_argument("--curriculums", default="[1,3]", type=str, help="Curriculum rate")
+parser.add_argument("--seed", default=42, type=int, help="Random seed")
+parser.add_argument("--num_workers", default=0, type=int, help="Number of workers")
+parser.add_argument("--log_interval", default=100, type=int, help="Log interval")
+parser.add_argument("--val_interval_ratio", default=0.2, type=float, help="Eval once every interval ratio of training data")
+parser.add_argument("--train_data_path", default="", type=str, help="Train data path")
+parser.add_argument("--val_data_path", default="", type=str, help="Val data path")
+parser.add_argument("--teacher_path", default="", type=str, help="Checkpoint of the teacher MMTG saved by train.py")
+parser.add_argument("--no_init_from_teacher", action='store_true', help="Train the student from scratch")
+parser.add_argument("--save_model", action='store_true', help="Save model")
+parser.add_argument("--save_path", default="", type=str, help="Save directory")
+parser.add_argument("--ckpt_format", default="safetensors", choices=["safetensors", "pth"], \
+                    help="safetensors: prefix-free tensors that generate.py memory-maps, pth: the torch.save format")
+parser.add_argument("--ckpt_fp16", action='store_true', help="Store the float32 weights of the checkpoints as float16")
+parser.add_argument("--log_path", default="", type=str, help="Log directory")
+parser.add_argument("--alpha", default=0, type=float, help="Factor of KLDivLoss.")
+parser.add_argument("--kd_weight", default=1.0, type=float, help="Factor of the distillation loss on the teacher logits.")
+parser.add_argument("--kd_temperature", default=2.0, type=float, help="Softmax temperature of the distillation loss.")
+
+args = parser.parse_args()
+batch_size = args.batch_size
+val_batch_size = args.val_batch_size
+curriculums = eval(args.curriculums)
+data_config = data_config()
+print(args, student_model_cfgs)
+logging.basicConfig(filename=args.log_path,
+                    level=logging.INFO,
+                    format="%(asctime)s - %(name)s - %(levelname)-2s - %(filename)-8s : %(lineno)s line - %(message)s",
+                    datefmt="%Y-%m-%d %H:%M:%S")
+logger = logging.getLogger(__name__)
+logger.info(args)
+tokenizer = BertTokenizer.from_pretrained("./vocab/vocab.txt")
+checkpointer = AsyncCheckpointer(fp16=args.ckpt_fp16)
+
+devices = eval('['+args.device_ids+']')
+multi_gpu = False
+if torch.cuda.is_available():
+    device = torch.device("cuda")
+    print('There are %d GPU(s) available.' % torch.cuda.device_count())
+    print('We will use the GPU:', torch.cuda.get_device_name())
+    if torch.cuda.device_count() > 1:
+        print("Let's use", torch.cuda.device_count(), "GPUs!")
+        multi_gpu = True
+else:
+    print('No GPU available, using the CPU instead.')
+    device = torch.device("cpu")
+
+
+def set_seed(seed: int):
+    """
+    Helper function for reproducible behavior to set the seed in ``random``, ``numpy`` and ``torch``.
+
+    Args:
+        seed (:obj:`int`): The seed to set.
+    """
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    torch.cuda.manual_seed_all(seed)
+    torch.backends.cudnn.deterministic = True
+    torch.backends.cudnn.benchmark = True
+
+
+def init_from_teacher(student, teacher):
+    '''
+    Copy the teacher weights into the student wherever the shapes match.
+    The student GPT2 blocks take the teacher blocks evenly spaced over the depth,
+    and the token embeddings take the first rows if the teacher vocabulary is larger.
+    Returns the number of copied tensors.
+    '''
+    n_student_layer = student.decoder.gpt2.config.n_layer
+    n_teacher_layer = teacher.decoder.gpt2.config.n_layer
+    layer_map = [round(i * (n_teacher_layer - 1) / max(n_student_layer - 1, 1)) for i in range(n_student_layer)]
+    teacher_state = teacher.state_dict()
+    student_state = student.state_dict()
+    n_copied = 0
+    for key in student_state:
+        teacher_key = key
+        if key.startswith('decoder.gpt2.transformer.h.'):
+            parts = key.split('.')
+            parts[4] = str(layer_map[int(parts[4])])
+            teacher_key = '.'.join(parts)
+        if teacher_key not in teacher_state:
+            continue
+        value = teacher_state[teacher_key]
+        target = student_state[key]
+        if value.dim() > 0 and value.shape[1:] == target.shape[1:] and value.size(0) > target.size(0):
+            value = value[:target.size(0)]
+        if value.shape == target.shape:
+            student_state[key] = value.clone()
+            n_copied += 1
+    student.load_state_dict(student_state)
+    return n_copied
+
+
+def main():
+
+    print("Loading data...")
+    train_data = MyDataset(args.train_data_path, tokenizer, data_config)
+    valid_data = MyDataset(args.val_data_path, tokenizer, data_config)
+    print("Data loaded.")
+
+    print("Loading teacher model...")
+    teacher, _ = load_model(args.teacher_path, tokenizer, data_config)
+    teacher.train_flag = True # the decoder layout of train.py
+    for param in teacher.parameters():
+        param.requires_grad = False
+    print("Teacher model loaded.")
+
+    student = MMTG(student_model_cfgs, data_config, len(tokenizer.vocab), train_flag=True)
+    if not args.no_init_from_teacher:
+        n_copied = init_from_teacher(student, teacher)
+        logger.info('* %d tensors initialized from the teacher' % n_copied)
+
+    n_params = sum([p.numel() for p in student.parameters() if p.requires_grad])
+    n_teacher_params = sum([p.numel() for p in teacher.parameters()])
+    print('* number of parameters: %d (teacher: %d)' % (n_params, n_teacher_params))
+    logger.info('* number of parameters: %d (teacher: %d)' % (n_params, n_teacher_params))
+
+    if multi_gpu:
+        student = nn.DataParallel(student, device_ids=devices)
+        teacher = nn.DataParallel(teacher, device_ids=devices)
+    student.to(device)
+    teacher.to(device)
+    teacher.eval()
+
+    res = train(student, teacher, train_data, valid_data)
+
+    return res
+
+
+def train(model, teacher, train_data, valid_data):
+
+    print("Now lr is ", args.lr, "Now batch_size is ", args.batch_size)
+    logger.info('Now lr is %s, batch_size is %s.' % (args.lr, args.batch_size))
+
+    ### The same curriculum stages as train.py
+    train_datasets = stage_loaders(train_data, batch_size, num_workers=args.num_workers)
+    valid_datasets = stage_loaders(valid_data, val_batch_size, num_workers=args.num_workers)
+
+    optimizer = AdamW(model.parameters(), lr=args.lr)
+    n_training_steps = training_steps(train_datasets, curriculums, args.epochs)
+    print('Total training steps:', n_training_steps)
+    logger.info('* number of training steps: %d' % n_training_steps) # number of training steps
+    one_epoch_steps = len(train_datasets[0])
+
+    # warmup and decay the learning rate
+    scheduler = get_linear_schedule_with_warmup(optimizer,
+                                                num_warmup_steps = int(one_epoch_steps * 0.1),
+                                                num_training_steps = n_training_steps)
+
+    criterion = MyLoss(data_config, student_model_cfgs)
+    kd_criterion = DistillLoss(data_config, args.kd_temperature)
+    teacher_val_losses = {} # the teacher val loss of each stage, computed once
+    best_val_loss = float("inf")
+    global_steps = 0
+    stage = 0 # curriculum stage
+    for epoch in range(args.epochs):
+        t1 = time.time()
+        torch.cuda.empty_cache()
+        print("\nEpoch ", epoch + 1, "/", args.epochs)
+        logger.info("Epoch " + str(epoch + 1) + "/" + str(args.epochs))
+        stage = curriculum_stage(epoch, curriculums)
+        epoch_iterator = tqdm(enumerate(train_datasets[stage-1]),
+                                desc="%s: %d/%d Epochs >> Steps" % ("Distill", epoch + 1, args.epochs),
+                                total=len(train_datasets[stage-1]),
+                                bar_format="{l_bar}{r_bar}")
+        if stage not in teacher_val_losses:
+            teacher_val_losses[stage], _, _ = evaluate(teacher, valid_datasets[stage-1], stage, criterion, device, args.alpha)
+            logger.info("Stage %d, Teacher Val. Loss: %.4f" % (stage, teacher_val_losses[stage]))
+
+        avg_loss = 0.0
+        model.train()
+        for step, batch in epoch_iterator:
+            idxs = stage_indices(batch['rating'], stage)
+            if len(idxs) == 0:
+                continue
+            batch = batch_to_device(batch, device, idxs)
+            ratings = batch['rating'].to(device)
+            with torch.no_grad():
+                teacher_outputs = teacher_logits(teacher, batch)
+            loss, kl_loss, outputs = compute_loss(model, batch, ratings, stage, criterion)
+            kd_loss = kd_criterion(outputs, teacher_outputs, batch['attention_mask'])
+            total_loss = loss.mean() + args.alpha * kl_loss.mean() + args.kd_weight * kd_loss
+            total_loss.backward()
+            nn.utils.clip_grad_norm_(model.parameters(), 1.0)  # clip gradient
+            optimizer.step()
+            scheduler.step()
+            model.zero_grad()
+            for param_group in optimizer.param_groups:
+                args.lr = param_group['lr']
+            epoch_iterator.set_postfix(lr=args.lr, loss=total_loss.item(), kd=kd_loss.item())
+            global_steps += 1
+            if step > 0 and (step + 1) % int(len(train_datasets[stage-1]) * args.val_interval_ratio) == 0:
+                val_loss, _, val_kd_loss = evaluate(model, valid_datasets[stage-1], stage, criterion, device, args.alpha, \
+                                                    teacher=teacher, kd_criterion=kd_criterion)
+                logger.info("Epoch: %d, Step: %d/%d, Val. Loss: %.4f (teacher: %.4f), Val. KD Loss: %.4f" % \
+                    (epoch + 1, step + 1, len(train_datasets[stage-1]), val_loss, teacher_val_losses[stage], val_kd_loss))
+                print(" Epoch: %d, Step: %d/%d, Val. Loss: %.4f (teacher: %.4f), Val. KD Loss: %.4f" % \
+                    (epoch + 1, step + 1, len(train_datasets[stage-1]), val_loss, teacher_val_losses[stage], val_kd_loss))
+                # Save model
+                if val_loss < best_val_loss:
+                    best_val_loss = val_loss
+                    if args.save_model:
+                        save_model(model, f"best_val_model.{args.ckpt_format}")
+                        logger.info("Epoch: %d, Step: %d, Saving Model to \'%s\'." % (epoch + 1, step, args.save_path))
+                model.train()
+            avg_loss += loss.item()
+            if step > 0 and (step + 1) % args.log_interval == 0:
+                logger.info("Epoch: %d, Step: %d/%d, Average loss: %.6f" % (epoch + 1, step + 1, len(train_datasets[stage-1]), avg_loss / (step + 1)))
+        # End of epoch
+        val_loss, _, val_kd_loss = evaluate(model, valid_datasets[stage-1], stage, criterion, device, args.alpha, \
+                                            teacher=teacher, kd_criterion=kd_criterion)
+        logger.info("End eval of epoch %d. Val. Loss: %.4f (teacher: %.4f), Val. KD Loss: %.4f" % \
+            (epoch + 1, val_loss, teacher_val_losses[stage], val_kd_loss))
+        print("End eval of epoch %d. Val. Loss: %.4f (teacher: %.4f), Val. KD Loss: %.4f" % \
+            (epoch + 1, val_loss, teacher_val_losses[stage], val_kd_loss))
+        model.train()
+        logger.info("Average loss: %.4f  Elapsed time: %s" % (avg_loss / (len(train_datasets[stage-1]) + 1), format_time(time.time()-t1)))
+        print("Average loss: %.4f  Elapsed time: %s" % (avg_loss / (len(train_datasets[stage-1]) + 1), format_time(time.time()-t1)))
+        if args.save_model:
+            save_model(model, f"epoch_{epoch + 1}.{args.ckpt_format}")
+            logger.info("Epoch: %d, Saving Model to \'%s\'." % (epoch + 1, args.save_path))
+
+    checkpointer.wait()
+    logger.info("Distillation finished.")
+    print("Distillation finished.")
+
+    return val_loss
+
+
+def save_model(model, filename):
+    '''
+    Save the student in the background in the same format as train.py, so that generate.py can load it.
+    '''
+    checkpointer.save(model, os.path.join(args.save_path, filename), student_model_cfgs, args)
+    print("Saving Model to \'%s\'." % os.path.join(args.save_path, filename))
+
+
+if __name__ == "__main__":
+
+    time_begin = time.time()
+    set_seed(args.seed)
+
+    main()
+
+    time_end = time.time()
+    print("Finished!\nTotal time: %s" % format_time(time_end - time_begin))
@@ -10,7 +10,9 @@ LastEditTime: 2022-08-10 19:19:16
 import argparse
 import math
 import os
+import threading
 import time as t
+from collections import OrderedDict
 
 import numpy as np
 import torch
@@ -20,10 +22,16 @@ from torch.utils.data import DataLoader
 from tqdm import tqdm, trange
 from transformers import BertTokenizer
 
-from configs import model_cfgs, data_config as mydata_config
-from model import MMTG
+from configs import data_config as mydata_config
+from model import GPT2_DraftDecoder
 from MyDataset import MyDataset
 from utils import *
+from profiler import StageProfiler
+from telemetry import GenerationTelemetry
+from checkpoint import load_checkpoint, as_safetensors
+from shortlist import load_shortlist
+from adapters import load_model
+from scoring import score_ids
 
 
 def _is_word(word):
@@ -103,7 +111,8 @@ def sample_sequence(
     top_k=30,
     top_p=0.0,
     repitition_penalty=1.0,
-    device="cpu"
+    device="cpu",
+    shortlist=None
 ):
     inputs = start_input
     for k, v in inputs.items():
@@ -128,14 +137,17 @@ def sample_sequence(
                 # import pdb; pdb.set_trace()
                 if id in [0, 102]: # skip punctuation
                     continue
-                next_token_logits[id] /= repitition_penalty
+                next_token_logits[to_columns(id, shortlist)] /= repitition_penalty
             next_token_logits = next_token_logits / temperature
-            next_token_logits[tokenizer.convert_tokens_to_ids("[#START#]")] = -float("Inf")
-            next_token_logits[tokenizer.convert_tokens_to_ids("[#EOS#]")] = -float("Inf")
-            next_token_logits[tokenizer.convert_tokens_to_ids("[UNK]")] = -float("Inf")
-            next_token_logits[tokenizer.convert_tokens_to_ids("[SEP]")] = -float("Inf")
+            next_token_logits[to_columns(tokenizer.convert_tokens_to_ids("[#START#]"), shortlist)] = -float("Inf")
+            next_token_logits[to_columns(tokenizer.convert_tokens_to_ids("[#EOS#]"), shortlist)] = -float("Inf")
+            next_token_logits[to_columns(tokenizer.convert_tokens_to_ids("[UNK]"), shortlist)] = -float("Inf")
+            next_token_logits[to_columns(tokenizer.convert_tokens_to_ids("[SEP]"), shortlist)] = -float("Inf")
             if generated[0][-1] == 0:
                 next_token = torch.tensor([0]).to(generated.device).unsqueeze(0)
+            elif shortlist is not None: # the shortlist only holds ids of vocab.txt
+                filtered_logits = top_k_top_p_filtering(next_token_logits, top_k=top_k, top_p=top_p)
+                next_token = shortlist.ids[torch.multinomial(F.softmax(filtered_logits, dim=-1), num_samples=1)].unsqueeze(0)
             else:
                 filtered_logits = top_k_top_p_filtering(next_token_logits, top_k=top_k, top_p=top_p)[:13317]
                 next_token = torch.multinomial(F.softmax(filtered_logits, dim=-1), num_samples=1).unsqueeze(0)
@@ -146,6 +158,419 @@ def sample_sequence(
 
 
 
+def to_columns(ids, shortlist=None):
+    '''
+    The logit columns of vocabulary ids: the ids themselves with the full head, their positions in the shortlist otherwise.
+    '''
+    return ids if shortlist is None else shortlist.index[ids]
+
+
+def to_model_inputs(start_input, device):
+    '''
+    A batch of one on device from an unbatched dataset item, leaving start_input untouched.
+    '''
+    inputs = {}
+    for k, v in start_input.items():
+        if k in ['targets', 'topic_ids', 'tpw_attention_mask', 'tpw_type_ids']:
+            inputs[k] = torch.tensor(v, dtype=torch.long, device=device).unsqueeze(0)
+        else:
+            inputs[k] = torch.tensor(v, dtype=torch.float32, device=device).unsqueeze(0)
+    return inputs
+
+
+def sampling_probs(
+    logits,
+    token_counts,
+    tokenizer,
+    temperature=1.0,
+    top_k=30,
+    top_p=0.0,
+    repitition_penalty=1.0,
+    shortlist=None
+):
+    '''
+    Batched version of the logits processing of sample_sequence: repetition penalty, temperature,
+    the banned special tokens and top-k/top-p filtering. Returns the distribution to sample from.
+    Args:
+        logits: [batch_size, vocab_size]
+        token_counts: [batch_size, vocab_size], occurrences of each id in the generated ids
+        shortlist: with a shortlisted head, logits, token_counts and the result are over its columns
+    '''
+    token_counts = token_counts.clone()
+    token_counts[:, to_columns([tokenizer.pad_token_id, tokenizer.convert_tokens_to_ids("[SEP]")], shortlist)] = 0 # skip punctuation
+    logits = logits / repitition_penalty ** token_counts
+    logits = logits / temperature
+    for token in ["[#START#]", "[#EOS#]", "[UNK]", "[SEP]"]:
+        logits[:, to_columns(tokenizer.convert_tokens_to_ids(token), shortlist)] = -float("Inf")
+    top_k = min(top_k, logits.size(-1))
+    if top_k > 0:
+        logits = logits.masked_fill(logits < torch.topk(logits, top_k)[0][..., -1, None], -float("Inf"))
+    if top_p > 0.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+        sorted_indices_to_remove = cumulative_probs > top_p
+        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+        sorted_indices_to_remove[..., 0] = 0
+        indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+        logits = logits.masked_fill(indices_to_remove, -float("Inf"))
+    return F.softmax(logits, dim=-1)
+
+
+def forced_token(pos, last_token, sent_len, tokenizer):
+    '''
+    The token of target position pos if the sentence layout fixes it, else None:
+    [#EOS#] and [#START#] at the slot boundaries, and [PAD] once a sentence started padding.
+    '''
+    if pos % sent_len == sent_len - 1:
+        return tokenizer.convert_tokens_to_ids("[#EOS#]")
+    if pos % sent_len == 0:
+        return tokenizer.convert_tokens_to_ids("[#START#]")
+    if last_token == tokenizer.pad_token_id:
+        return tokenizer.pad_token_id
+    return None
+
+
+def speculative_sample_sequence(
+    model,
+    draft,
+    start_input,
+    length,
+    tokenizer,
+    temperature=1.0,
+    top_k=30,
+    top_p=0.0,
+    repitition_penalty=1.0,
+    num_draft_tokens=4,
+    device="cpu",
+    shortlist=None,
+    stats=None
+):
+    '''
+    Speculative sampling (Leviathan et al., 2023). The draft decoder proposes up to num_draft_tokens tokens,
+    the full decoder scores all of them in one forward pass, each proposal is accepted with probability
+    min(1, p / q) and the first rejected one is resampled from max(0, p - q). Both distributions go through
+    sampling_probs(), so the result follows the same distribution as sample_sequence.
+    stats: optional dict, the numbers of sampled draft proposals and of accepted ones are added to its
+        'proposed' and 'accepted' keys
+    '''
+    mmtg = model.module if isinstance(model, nn.DataParallel) else model
+    inputs = to_model_inputs(start_input, device)
+    sent_len = mmtg.data_config['max_sent_length'] + 2
+    vocab_size = mmtg.decoder.gpt2.config.vocab_size if shortlist is None else len(shortlist)
+
+    def probs(logits, token_counts):
+        return sampling_probs(logits.unsqueeze(0), token_counts.unsqueeze(0), tokenizer, \
+            temperature, top_k, top_p, repitition_penalty, shortlist)[0]
+
+    def sample(probs):
+        column = torch.multinomial(probs, num_samples=1)
+        return (column if shortlist is None else shortlist.ids[column]).item()
+
+    with torch.no_grad():
+        concat_output, _ = mmtg.encode(inputs)
+        generated = inputs['targets'][0].tolist()
+        token_counts = torch.zeros(vocab_size, device=device)
+        for token in generated:
+            token_counts[to_columns(token, shortlist)] += 1
+        # both caches hold the prompt and generated[:n_fed], the last generated token is always pending
+        no_targets = inputs['targets'][:, :0]
+        _, past, attention_mask = mmtg.decoder.prefill(concat_output, no_targets, \
+            inputs['topic_ids'], inputs['tpw_attention_mask'], inputs['tpw_type_ids'])
+        _, draft_past, draft_attention_mask = draft.prefill(concat_output, no_targets, \
+            inputs['topic_ids'], inputs['tpw_attention_mask'], inputs['tpw_type_ids'])
+        prompt_length = attention_mask.size(1)
+        n_fed, n_draft_fed = 0, 0
+
+        while len(generated) < length:
+            # draft proposes
+            proposals, draft_probs = [], []
+            draft_counts = token_counts.clone()
+            for j in range(min(num_draft_tokens, length - len(generated))):
+                sequence = generated + proposals
+                token = forced_token(len(sequence), sequence[-1], sent_len, tokenizer)
+                q = None
+                if token is None:
+                    ids = torch.tensor([sequence[n_draft_fed:]], dtype=torch.long, device=device)
+                    logits, draft_past, draft_attention_mask = draft.step(concat_output, ids, n_draft_fed, \
+                        draft_attention_mask, draft_past)
+                    n_draft_fed = len(sequence)
+                    q = probs(logits[0, -1], draft_counts)
+                    token = sample(q)
+                proposals.append(token)
+                draft_probs.append(q)
+                draft_counts[to_columns(token, shortlist)] += 1
+
+            # full decoder verifies
+            ids = torch.tensor([(generated + proposals)[n_fed:]], dtype=torch.long, device=device)
+            logits, past, attention_mask = mmtg.decoder.step(concat_output, ids, n_fed, attention_mask, past)
+            n_old = len(generated)
+            rejected = False
+            for token, q in zip(proposals, draft_probs):
+                if q is not None:
+                    p = probs(logits[0, len(generated) - 1 - n_fed], token_counts)
+                    column = to_columns(token, shortlist)
+                    if torch.rand(1).item() >= (p[column] / q[column]).item():
+                        residual = (p - q).clamp(min=0)
+                        residual = residual / residual.sum() if residual.sum() > 0 else p
+                        token = sample(residual)
+                        rejected = True
+                generated.append(token)
+                token_counts[to_columns(token, shortlist)] += 1
+                if rejected:
+                    break
+            n_accepted = len(generated) - n_old - int(rejected)
+            if stats is not None:
+                stats['proposed'] = stats.get('proposed', 0) + sum(q is not None for q in draft_probs)
+                stats['accepted'] = stats.get('accepted', 0) + \
+                    sum(q is not None for q in draft_probs[:n_accepted])
+            if not rejected and len(generated) < length: # one more token from the full decoder for free
+                token = forced_token(len(generated), generated[-1], sent_len, tokenizer)
+                if token is None:
+                    p = probs(logits[0, len(generated) - 1 - n_fed], token_counts)
+                    token = sample(p)
+                generated.append(token)
+                token_counts[to_columns(token, shortlist)] += 1
+
+            # drop the rejected positions from the caches
+            n_fed = min(n_fed + ids.size(1), len(generated) - 1)
+            n_draft_fed = min(n_draft_fed, n_old + n_accepted)
+            past = mmtg.decoder.truncate_cache(past, prompt_length + n_fed)
+            attention_mask = attention_mask[:, :prompt_length + n_fed]
+            draft_past = draft.truncate_cache(draft_past, prompt_length + n_draft_fed)
+            draft_attention_mask = draft_attention_mask[:, :prompt_length + n_draft_fed]
+    return generated
+
+
+def load_draft(draft, path):
+    '''
+    Load the GPT2 weights of the draft decoder from a checkpoint of either format: the decoder of a
+    distill.py student, or a GPT2 state dict without prefix.
+    '''
+    state_dict, _ = load_checkpoint(path)
+    prefix = 'decoder.gpt2.'
+    if any(key.startswith(prefix) for key in state_dict):
+        state_dict = {key[len(prefix):]: value for key, value in state_dict.items() if key.startswith(prefix)}
+    n_layer = len({key.split('.')[2] for key in state_dict if key.startswith('transformer.h.')})
+    if n_layer != draft.config.n_layer:
+        raise ValueError("%s has %d GPT2 blocks, the draft decoder %d (--draft_layers)" % (path, n_layer, draft.config.n_layer))
+    draft.gpt2.load_state_dict(state_dict)
+    return draft
+
+
+class PromptCache(object):
+    def __init__(self, decoder, max_entries=64):
+        '''
+        Key/value caches of the topic prompts, computed once per distinct topic by GPT2_Decoder.prefill_prompt()
+        and reused by every experience with the same topic ids. The least recently used entry is dropped beyond max_entries
+        (an entry of the 12-layer GPT2 is about 1 MB).
+        It can be shared by generation threads.
+        '''
+        self.decoder = decoder
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, topic_ids, tpw_att_mask, tpw_type_ids):
+        '''
+        Returns:
+            past_key_values, attention_mask of the prompt, with one row
+        '''
+        key = (tuple(topic_ids[0].tolist()), tuple(tpw_att_mask[0].tolist()), tuple(tpw_type_ids[0].tolist()))
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+        value = self.decoder.prefill_prompt(topic_ids, tpw_att_mask, tpw_type_ids)
+        with self._lock:
+            self.entries[key] = value
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return value
+
+
+def shared_prefix_sample(
+    model,
+    start_input,
+    length,
+    tokenizer,
+    num_samples=10,
+    temperature=1.0,
+    top_k=30,
+    top_p=0.0,
+    repitition_penalty=1.0,
+    device="cpu",
+    shortlist=None,
+    prompt_cache=None,
+    on_step=None
+):
+    '''
+    num_samples samples of one experience decoded as one batch, with the logits processing of sampling_probs().
+    The encoder runs once, the key/value cache of the prompt comes from prompt_cache (or is computed once) and
+    the given targets are decoded once on top of it; the num_samples rows share this prefix as views and only
+    the positions they sample are stored per row.
+    on_step, if given, is called with (pos, generated) once the ids of target position pos are known.
+    Returns:
+        a list of num_samples lists of ids
+    '''
+    mmtg = model.module if isinstance(model, nn.DataParallel) else model
+    inputs = to_model_inputs(start_input, device)
+    sent_len = mmtg.data_config['max_sent_length'] + 2
+    pad_id = tokenizer.pad_token_id
+
+    with torch.no_grad():
+        concat_output, _ = mmtg.encode(inputs)
+        if prompt_cache is not None:
+            past, attention_mask = prompt_cache.get(inputs['topic_ids'], inputs['tpw_attention_mask'], inputs['tpw_type_ids'])
+        else:
+            past, attention_mask = mmtg.decoder.prefill_prompt(inputs['topic_ids'], inputs['tpw_attention_mask'], inputs['tpw_type_ids'])
+        logits, past, attention_mask = mmtg.decoder.step(concat_output, inputs['targets'], 0, attention_mask, past)
+        # all the rows start from the same prefix
+        past = mmtg.decoder.expand_cache(past, num_samples)
+        attention_mask = attention_mask.expand(num_samples, -1)
+        concat_output = concat_output.expand(num_samples, -1, -1)
+        next_token_logits = logits[:, -1, :].float().expand(num_samples, -1)
+
+        generated = inputs['targets'].expand(num_samples, -1)
+        token_counts = torch.zeros(num_samples, next_token_logits.size(-1), device=device)
+        token_counts.scatter_add_(1, to_columns(generated, shortlist), torch.ones_like(generated, dtype=token_counts.dtype))
+
+        for pos in range(generated.size(1), length):
+            token = forced_token(pos, None, sent_len, tokenizer)
+            if token is not None:
+                next_tokens = torch.full((num_samples,), token, dtype=torch.long, device=device)
+            else:
+                probs = sampling_probs(next_token_logits, token_counts, tokenizer, \
+                    temperature, top_k, top_p, repitition_penalty, shortlist)
+                next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+                if shortlist is not None:
+                    next_tokens = shortlist.ids[next_tokens]
+                # a sentence that emitted [PAD] keeps padding
+                next_tokens = next_tokens.masked_fill(generated[:, -1] == pad_id, pad_id)
+            generated = torch.cat((generated, next_tokens.unsqueeze(1)), dim=-1)
+            token_counts[torch.arange(num_samples, device=device), to_columns(next_tokens, shortlist)] += 1
+            if on_step is not None:
+                on_step(pos, generated)
+            if pos == length - 1:
+                break
+            logits, past, attention_mask = mmtg.decoder.step(concat_output, next_tokens.unsqueeze(1), pos, attention_mask, past)
+            next_token_logits = logits[:, -1, :].float()
+    return generated.tolist()
+
+
+def beam_search(
+    model,
+    start_input,
+    length,
+    tokenizer,
+    num_beams=5,
+    length_penalty=1.0,
+    repitition_penalty=1.0,
+    num_return_sequences=1,
+    device="cpu",
+    shortlist=None
+):
+    '''
+    Batched beam search over the fixed sentence layout: [#START#] and [#EOS#] are forced at the slot boundaries
+    and a sentence keeps padding once it emitted [PAD]. The encoder runs once and all beams share its output and
+    the key/value cache of the prompt. Beams are ranked by the sum of log-probs of the tokens they chose divided by
+    (number of chosen tokens) ** length_penalty, so the forced slots and the pad runs do not count.
+    Returns:
+        a list of num_return_sequences lists of ids, the best first
+    '''
+    mmtg = model.module if isinstance(model, nn.DataParallel) else model
+    inputs = to_model_inputs(start_input, device)
+    sent_len = mmtg.data_config['max_sent_length'] + 2
+    start_id = tokenizer.convert_tokens_to_ids("[#START#]")
+    eos_id = tokenizer.convert_tokens_to_ids("[#EOS#]")
+    banned_ids = to_columns([start_id, eos_id, tokenizer.convert_tokens_to_ids("[UNK]"), \
+                             tokenizer.convert_tokens_to_ids("[SEP]")], shortlist)
+    no_penalty_ids = to_columns([tokenizer.pad_token_id, tokenizer.convert_tokens_to_ids("[SEP]")], shortlist) # skip punctuation
+    pad_column = to_columns(tokenizer.pad_token_id, shortlist)
+
+    with torch.no_grad():
+        concat_output, _ = mmtg.encode(inputs)
+        logits, past, attention_mask = mmtg.decoder.prefill(concat_output, inputs['targets'], \
+            inputs['topic_ids'], inputs['tpw_attention_mask'], inputs['tpw_type_ids'])
+        # all the beams start from the same prompt
+        share_idx = torch.zeros(num_beams, dtype=torch.long, device=device)
+        concat_output = concat_output[share_idx]
+        past = mmtg.decoder.reorder_cache(past, share_idx)
+        attention_mask = attention_mask[share_idx]
+        next_token_logits = logits[share_idx, -1, :]
+        vocab_size = next_token_logits.size(-1)
+
+        generated = inputs['targets'][share_idx]
+        token_counts = torch.zeros(num_beams, vocab_size, device=device)
+        token_counts.scatter_add_(1, to_columns(generated, shortlist), torch.ones_like(generated, dtype=token_counts.dtype))
+        sum_logprobs = torch.zeros(num_beams, device=device)
+        sum_logprobs[1:] = -float("Inf") # only one distinct beam at the beginning
+        n_chosen = torch.zeros(num_beams, device=device)
+
+        for pos in range(generated.size(1), length):
+            if pos % sent_len == sent_len - 1: # add [#EOS#]
+                next_tokens = torch.full((num_beams,), eos_id, dtype=torch.long, device=device)
+            elif pos % sent_len == 0: # add [#START#]
+                next_tokens = torch.full((num_beams,), start_id, dtype=torch.long, device=device)
+            else:
+                token_counts[:, no_penalty_ids] = 0
+                next_token_logits = next_token_logits / repitition_penalty ** token_counts
+                next_token_logits[:, banned_ids] = -float("Inf")
+                log_probs = F.log_softmax(next_token_logits, dim=-1)
+                # a sentence that emitted [PAD] keeps padding for free
+                is_padding = generated[:, -1] == tokenizer.pad_token_id
+                log_probs[is_padding] = -float("Inf")
+                log_probs[is_padding, pad_column] = 0.0
+                cand_logprobs = sum_logprobs.unsqueeze(1) + log_probs
+                cand_lengths = n_chosen + (~is_padding).float()
+                cand_scores = cand_logprobs / cand_lengths.unsqueeze(1) ** length_penalty
+                top_idx = torch.topk(cand_scores.view(-1), num_beams)[1]
+                beam_idx = torch.div(top_idx, vocab_size, rounding_mode='floor')
+                next_tokens = top_idx % vocab_size
+                if shortlist is not None:
+                    next_tokens = shortlist.ids[next_tokens]
+                sum_logprobs = cand_logprobs.view(-1)[top_idx]
+                n_chosen = cand_lengths[beam_idx]
+                generated = generated[beam_idx]
+                token_counts = token_counts[beam_idx]
+                attention_mask = attention_mask[beam_idx]
+                past = mmtg.decoder.reorder_cache(past, beam_idx)
+            generated = torch.cat((generated, next_tokens.unsqueeze(1)), dim=-1)
+            token_counts[torch.arange(num_beams, device=device), to_columns(next_tokens, shortlist)] += 1
+            if pos == length - 1:
+                break
+            logits, past, attention_mask = mmtg.decoder.step(concat_output, next_tokens.unsqueeze(1), pos, attention_mask, past)
+            next_token_logits = logits[:, -1, :]
+
+        scores = sum_logprobs / n_chosen.clamp(min=1) ** length_penalty
+        order = torch.argsort(scores, descending=True)[:num_return_sequences]
+        generated = generated[order].tolist()
+    return generated
+
+
+def ids_to_lyrics(tokenizer, preds):
+    '''
+    Convert the generated ids to a line of lyrics, the sentences joined by '，'.
+    '''
+    preds = [tokenizer.convert_ids_to_tokens(line) for line in preds]
+    all_idx_of_eos = [i for i,v in enumerate(preds) if v=='[#EOS#]']
+    if len(all_idx_of_eos) >= 10 and '[SEP]' not in preds[:all_idx_of_eos[-1]]:
+        eos_idx = all_idx_of_eos[9]
+        preds = preds[:eos_idx+1] + ['[SEP]']
+    elif '[SEP]' in preds:
+        sep_idx = preds.index('[SEP]')
+        preds = preds[:sep_idx+1]
+    else:
+        preds = preds + ['[SEP]']
+    tmp = ''.join(preds).replace('[SEP]', '').replace('[PAD]', '').replace('[#START#]', '').replace('[#EOS#]', '，')
+    while tmp[-1] == '，':
+        tmp = tmp[:-1]
+    return tmp
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--device_ids", default="0,1", type=str, help="GPU device ids")
@@ -163,6 +588,29 @@ def main():
     parser.add_argument("--n_samples", default=10, type=int, required=False, help="生成的样本数量")
     parser.add_argument("--save_samples", action="store_true", help="保存产生的样本")
     parser.add_argument("--save_samples_path", default="", type=str, required=False, help="保存样本的路径")
+    parser.add_argument("--decode_strategy", default="sample", type=str, choices=["sample", "beam"], help="Top-k/top-p sampling or beam search")
+    parser.add_argument("--num_beams", default=5, type=int, required=False, help="Beam size of beam search")
+    parser.add_argument("--length_penalty", default=1.0, type=float, required=False, help="Exponent of the length normalization of beam search")
+    parser.add_argument("--num_return_beams", default=1, type=int, required=False, help="Number of beams written for each sample")
+    parser.add_argument("--draft_layers", default=0, type=int, required=False, help="Number of GPT2 blocks of the draft decoder for speculative sampling, 0 to disable")
+    parser.add_argument("--draft_path", default="", type=str, required=False, help="Optional checkpoint of a trained draft decoder, e.g. a distill.py student with --draft_layers GPT2 blocks")
+    parser.add_argument("--profile", default=os.environ.get("MMTG_PROFILE", ""), type=str, required=False, \
+                        help="Record the time and memory of each model stage to PROFILE.trace.json and PROFILE.summary.json")
+    parser.add_argument("--num_draft_tokens", default=4, type=int, required=False, help="Number of tokens proposed by the draft decoder at a time")
+    parser.add_argument("--share_weights", action="store_true", \
+                        help="CPU generation: map the weights and the token embedding table read-only from disk, so that the generation processes of a host share them")
+    parser.add_argument("--share_prefix", action="store_true", \
+                        help="Sample the n_samples of an experience as one batch on a key/value cache of the prompt that is computed once per topic")
+    parser.add_argument("--prompt_cache_size", default=64, type=int, required=False, \
+                        help="Number of topic prompts whose key/value cache --share_prefix keeps")
+    parser.add_argument("--shortlist_path", default="", type=str, required=False, \
+                        help="Restrict the LM head to the tokens of a shortlist written by shortlist.py, the full head if empty")
+    parser.add_argument("--telemetry_path", default="", type=str, required=False, \
+                        help="Write the cost of every decoding call and the percentiles of the run to this jsonl file")
+    parser.add_argument("--rerank", action="store_true", \
+                        help="Sort the samples of each experience by their teacher-forced log-likelihood per token")
+    parser.add_argument("--rerank_keep", default=0, type=int, required=False, help="Write only the best rerank_keep samples, all if 0")
+    parser.add_argument("--rerank_batch_size", default=32, type=int, required=False, help="Samples scored at a time by the rerank")
     
     data_config = mydata_config()
     args = parser.parse_args()
@@ -185,13 +633,43 @@ def main():
     tokenizer = BertTokenizer.from_pretrained(args.tokenizer_path)
     
     # load model
-    checkpoint = torch.load(args.model_path)
-    model = MMTG(model_cfgs, len(tokenizer.vocab), False) # predicting mode
+    # safetensors checkpoints are memory-mapped; every weight comes from the checkpoint,
+    # so GPT2 is built from its config instead of loading the pre-trained weights first
+    model_path = as_safetensors(args.model_path) if args.share_weights else args.model_path
+    model, ckpt_cfgs = load_model(model_path, tokenizer, data_config, share=args.share_weights) # predicting mode
+    shortlist = None
+    if args.shortlist_path:
+        shortlist = load_shortlist(args.shortlist_path, tokenizer, ckpt_cfgs['GPT2_VOCAB_SIZE'])
+        model.decoder.set_shortlist(shortlist.ids)
+        shortlist.to(device)
+        print("LM head restricted to a shortlist of %d / %d tokens." % (len(shortlist), ckpt_cfgs['GPT2_VOCAB_SIZE']))
     model.to(device)
     model = nn.DataParallel(model, device_ids=device_ids)
-    model.load_state_dict(checkpoint['model'])
+    model.eval()
     print("Loaded model from {}".format(args.model_path))
 
+    draft = None
+    if args.draft_layers > 0:
+        draft = GPT2_DraftDecoder(model.module.decoder, args.draft_layers)
+        if args.draft_path:
+            load_draft(draft, args.draft_path)
+        if shortlist is not None:
+            draft.set_shortlist(shortlist.ids)
+        draft.to(device)
+        draft.eval()
+        print("Speculative sampling with a %d-layer draft decoder." % args.draft_layers)
+
+    profiler = StageProfiler().attach(model) if args.profile else None
+    telemetry = None
+    if args.telemetry_path:
+        params = {'temperature': temperature, 'top_k': topk, 'top_p': topp, 'repetition_penalty': repetition_penalty, \
+                  'n_samples': n_samples, 'length': length, 'decode_strategy': args.decode_strategy, \
+                  'num_beams': args.num_beams, 'draft_layers': args.draft_layers, 'share_prefix': args.share_prefix, \
+                  'shortlist': len(shortlist) if shortlist is not None else None}
+        telemetry = GenerationTelemetry(args.telemetry_path, params, data_config.max_sent_length + 2, \
+            [tokenizer.pad_token_id, tokenizer.sep_token_id]).attach(model, draft)
+    prompt_cache = PromptCache(model.module.decoder, args.prompt_cache_size) if args.share_prefix else None
+
     print("Loading data...")
     test_data_file = args.data_path
     test_data = MyDataset(test_data_file, tokenizer, data_config, False)
@@ -203,37 +681,99 @@ def main():
     while 1:
         f1 = open(args.save_samples_path, "w", encoding="utf-8")
         for idx in trange(0,len(test_dataset.dataset),1):
-            n_preds = []
-            for _ in range(n_samples):
+            n_ids = []
+            if args.decode_strategy == "beam":
                 encoded = [tokenizer.convert_tokens_to_ids('[#START#]')] # Input [#START#] token
                 start_input = test_dataset.dataset[idx]
                 start_input['targets'] = np.asarray(encoded)
-                preds = sample_sequence(
+                if telemetry is not None:
+                    telemetry.begin(idx=idx, strategy="beam")
+                all_preds = beam_search(
                     model,
                     start_input,
                     length=length,
                     tokenizer=tokenizer,
+                    num_beams=args.num_beams,
+                    length_penalty=args.length_penalty,
+                    repitition_penalty=repetition_penalty,
+                    num_return_sequences=args.num_return_beams,
+                    device=device,
+                    shortlist=shortlist,
+                )
+                if telemetry is not None:
+                    telemetry.end(all_preds)
+                n_ids += all_preds
+            elif prompt_cache is not None and draft is None:
+                encoded = [tokenizer.convert_tokens_to_ids('[#START#]')] # Input [#START#] token
+                start_input = test_dataset.dataset[idx]
+                start_input['targets'] = np.asarray(encoded)
+                if telemetry is not None:
+                    telemetry.begin(prompt_cache, idx=idx, strategy="share_prefix")
+                all_preds = shared_prefix_sample(
+                    model,
+                    start_input,
+                    length=length,
+                    tokenizer=tokenizer,
+                    num_samples=n_samples,
                     temperature=temperature,
                     top_k=topk,
                     top_p=topp,
                     repitition_penalty=repetition_penalty,
                     device=device,
+                    shortlist=shortlist,
+                    prompt_cache=prompt_cache,
                 )
-                preds = [tokenizer.convert_ids_to_tokens(line) for line in preds]
-                all_idx_of_eos = [i for i,v in enumerate(preds) if v=='[#EOS#]']
-                if len(all_idx_of_eos) >= 10 and '[SEP]' not in preds[:all_idx_of_eos[-1]]:
-                    eos_idx = all_idx_of_eos[9]
-                    preds = preds[:eos_idx+1] + ['[SEP]']
-                elif '[SEP]' in preds:
-                    sep_idx = preds.index('[SEP]')
-                    preds = preds[:sep_idx+1]
-                else:
-                    preds = preds + ['[SEP]']
-                tmp = ''.join(preds).replace('[SEP]', '').replace('[PAD]', '').replace('[#START#]', '').replace('[#EOS#]', '，')
-                while tmp[-1] == '，':
-                    tmp = tmp[:-1]
-                n_preds += [tmp]
+                if telemetry is not None:
+                    telemetry.end(all_preds, prompt_cache=prompt_cache)
+                n_ids += all_preds
+            else:
+                for _ in range(n_samples):
+                    encoded = [tokenizer.convert_tokens_to_ids('[#START#]')] # Input [#START#] token
+                    start_input = test_dataset.dataset[idx]
+                    start_input['targets'] = np.asarray(encoded)
+                    if telemetry is not None:
+                        telemetry.begin(idx=idx, strategy="speculative" if draft is not None else "sample")
+                    if draft is not None:
+                        preds = speculative_sample_sequence(
+                            model,
+                            draft,
+                            start_input,
+                            length=length,
+                            tokenizer=tokenizer,
+                            temperature=temperature,
+                            top_k=topk,
+                            top_p=topp,
+                            repitition_penalty=repetition_penalty,
+                            num_draft_tokens=args.num_draft_tokens,
+                            device=device,
+                            shortlist=shortlist,
+                        )
+                    else:
+                        preds = sample_sequence(
+                            model,
+                            start_input,
+                            length=length,
+                            tokenizer=tokenizer,
+                            temperature=temperature,
+                            top_k=topk,
+                            top_p=topp,
+                            repitition_penalty=repetition_penalty,
+                            device=device,
+                            shortlist=shortlist,
+                        )
+                    if telemetry is not None:
+                        telemetry.end([preds])
+                    n_ids += [preds]
                 
+            if args.rerank:
+                # best teacher-forced log-likelihood per token first
+                scores = score_ids(model, [test_dataset.dataset[idx]], [n_ids], tokenizer, data_config, device, \
+                                   args.rerank_batch_size)[0]['mean_logprob']
+                n_ids = [n_ids[i] for i in scores.argsort(descending=True).tolist()]
+                if args.rerank_keep > 0:
+                    n_ids = n_ids[:args.rerank_keep]
+            n_preds = [ids_to_lyrics(tokenizer, preds) for preds in n_ids]
+
             label = test_dataset.dataset[idx]['targets']
             label_tokens = tokenizer.convert_ids_to_tokens(label)
             sep_idx = label_tokens.index('[SEP]')
@@ -241,6 +781,18 @@ def main():
             for j in range(len(n_preds)):
                 f1.write(n_preds[j]+'\n')
         f1.close()
+        if prompt_cache is not None:
+            print("Prompt cache: %d hits, %d misses." % (prompt_cache.hits, prompt_cache.misses))
+        if profiler is not None:
+            print("Profile saved to %s and %s." % profiler.export(args.profile))
+            if profiler.missing():
+                print("Warning: no time recorded for the stages %s." % ", ".join(profiler.missing()))
+        if telemetry is not None:
+            summary = telemetry.close()
+            if summary['calls'] > 0:
+                print("Telemetry saved to %s: %d calls, %.1f tokens/s, p50/p90/p99 %.1f/%.1f/%.1f ms per call." % \
+                    (args.telemetry_path, summary['calls'], summary['run_tokens_per_sec'], summary['total_ms']['p50'], \
+                     summary['total_ms']['p90'], summary['total_ms']['p99']))
         break
         
 
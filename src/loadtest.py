@@ -0,0 +1,235 @@
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import threading
+import time
+
+import numpy as np
+import torch
+from transformers import BertTokenizer
+
+from configs import data_config as mydata_config
+from MyDataset import MyDataset
+from adapters import load_model
+from benchmark import build_model, git_revision
+from generate import PromptCache, shared_prefix_sample
+from shortlist import load_shortlist
+from telemetry import sampled_tokens
+from utils import rss_mb, reset_peak_rss
+
+
+def synthetic_items(n, n_topics, tokenizer, data_config, seed=42):
+    '''
+    n experiences in the format of the test pickle with random embeddings, drawn from n_topics distinct topic strings.
+    '''
+    rng = np.random.RandomState(seed)
+    chars = [token for token in tokenizer.vocab if len(token) == 1 and '一' <= token <= '鿿']
+    topics = [''.join(rng.choice(chars, 4)) for _ in range(n_topics)]
+    items = []
+    for i in range(n):
+        item = {'topic': topics[rng.randint(n_topics)], 'lyrics': [''] * 10, \
+                'topic_emb': rng.randn(data_config.wenlan_emb_size).astype(np.float32)}
+        for j in range(5):
+            item['img_%d_emb' % j] = rng.randn(data_config.wenlan_emb_size).astype(np.float32)
+            item['r_%d_emb' % j] = rng.randn(data_config.wenlan_emb_size).astype(np.float32)
+        items.append(item)
+    return items
+
+
+def percentiles(values):
+    if not values:
+        return None
+    return {'p50': float(np.percentile(values, 50)), 'p90': float(np.percentile(values, 90)), \
+            'p99': float(np.percentile(values, 99)), 'mean': float(np.mean(values))}
+
+
+def run_load(model, tokenizer, featurizer, items, config, args, device, shortlist=None):
+    '''
+    Replay args.requests requests drawn from items against shared_prefix_sample() with config['concurrency'] threads.
+    With an arrival rate, the requests arrive as a Poisson process (open loop) and their latency includes
+    the time they waited for a free thread; without, each thread sends its next request when the last one is done (closed loop).
+    Returns:
+        the record of the run
+    '''
+    torch.set_num_threads(config['threads'])
+    mmtg = model.module if isinstance(model, torch.nn.DataParallel) else model
+    prompt_cache = PromptCache(mmtg.decoder) if config['prompt_cache'] else None
+    sent_len = mmtg.data_config['max_sent_length'] + 2
+    if config['precision'] == "fp32":
+        autocast = contextlib.nullcontext
+    else:
+        dtype = torch.bfloat16 if config['precision'] == "bf16" else torch.float16
+        autocast = lambda: torch.autocast(device_type=device.type, dtype=dtype)
+    rng = np.random.RandomState(args.seed)
+    order = rng.randint(len(items), size=args.requests)
+    arrivals = np.cumsum(rng.exponential(1 / args.arrival_rate, size=args.requests)) if args.arrival_rate > 0 else None
+    records = []
+    lock = threading.Lock()
+    next_request = [0]
+
+    def serve():
+        while True:
+            with lock:
+                i = next_request[0]
+                if i >= args.requests:
+                    return
+                next_request[0] += 1
+            if arrivals is not None:
+                arrival = start + arrivals[i]
+                time.sleep(max(arrival - time.perf_counter(), 0))
+            else:
+                arrival = time.perf_counter()
+            start_input = featurizer.featurize(items[order[i]])
+            start_input['targets'] = np.asarray([tokenizer.convert_tokens_to_ids('[#START#]')])
+            begin = time.perf_counter()
+            first_sentence = []
+
+            def on_step(pos, generated):
+                if pos == sent_len - 1:
+                    first_sentence.append(time.perf_counter())
+
+            with autocast():
+                preds = shared_prefix_sample(model, start_input, length=args.length, tokenizer=tokenizer, \
+                    num_samples=config['n_samples'], temperature=args.temperature, top_k=args.topk, top_p=args.topp, \
+                    repitition_penalty=args.repetition_penalty, device=device, shortlist=shortlist, \
+                    prompt_cache=prompt_cache, on_step=on_step)
+            end = time.perf_counter()
+            with lock:
+                records.append({'latency': end - arrival, 'queue': begin - arrival, \
+                                'ttfs': first_sentence[0] - arrival if first_sentence else None, \
+                                'tokens': sampled_tokens(preds, sent_len=sent_len)})
+
+    baseline_rss = rss_mb()
+    reset_peak_rss()
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=serve, daemon=True) for _ in range(config['concurrency'])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    n_tokens = sum(r['tokens'] for r in records)
+    record = dict(config)
+    record.update({
+        'requests': args.requests,
+        'arrival_rate': args.arrival_rate,
+        'wall_sec': wall,
+        'latency_ms': percentiles([r['latency'] * 1000 for r in records]),
+        'queue_ms': percentiles([r['queue'] * 1000 for r in records]),
+        'ttfs_ms': percentiles([r['ttfs'] * 1000 for r in records if r['ttfs'] is not None]),
+        'requests_per_sec': args.requests / wall,
+        'tokens_per_sec': n_tokens / wall,
+        'peak_rss_mb': rss_mb("VmHWM"),
+        'rss_delta_mb': rss_mb("VmHWM") - baseline_rss
+    })
+    if prompt_cache is not None:
+        record['prompt_cache_hits'] = prompt_cache.hits
+        record['prompt_cache_misses'] = prompt_cache.misses
+    if device.type == "cuda":
+        record['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 1024 ** 2
+    return record
+
+
+def report(results):
+    '''
+    Print one line per configuration, with the throughput relative to the first one.
+    '''
+    print("\n%-4s %-4s %-7s %-5s %-4s %10s %10s %10s %10s %10s %8s %10s" % ("bs", "thr", "prec", "cache", "conc", \
+        "p50 ms", "p90 ms", "p99 ms", "ttfs p50", "tokens/s", "ratio", "peak MB"))
+    for r in results:
+        print("%-4d %-4d %-7s %-5d %-4d %10.1f %10.1f %10.1f %10.1f %10.1f %8.2f %10.1f" % (r['n_samples'], r['threads'], \
+            r['precision'], r['prompt_cache'], r['concurrency'], r['latency_ms']['p50'], r['latency_ms']['p90'], \
+            r['latency_ms']['p99'], r['ttfs_ms']['p50'] if r['ttfs_ms'] else float('nan'), r['tokens_per_sec'], \
+            r['tokens_per_sec'] / results[0]['tokens_per_sec'], r['peak_rss_mb']))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", default="", type=str, help="Checkpoint to serve, random weights from configs.py if empty")
+    parser.add_argument("--data_path", default="", type=str, help="Test pickle the requests are drawn from, synthetic experiences if empty")
+    parser.add_argument("--tokenizer_path", default="./vocab/vocab.txt", type=str, help="词表路径")
+    parser.add_argument("--n_synthetic", default=100, type=int, help="Number of synthetic experiences")
+    parser.add_argument("--n_topics", default=20, type=int, help="Number of distinct topics of the synthetic experiences")
+    parser.add_argument("--requests", default=20, type=int, help="Number of requests per configuration")
+    parser.add_argument("--arrival_rate", default=0.0, type=float, help="Requests per second of an open-loop Poisson arrival, 0 for a closed loop")
+    parser.add_argument("--length", default=0, type=int, help="Number of target positions per sample, max_seq_length if 0")
+    parser.add_argument("--temperature", default=1.1, type=float, help="生成温度")
+    parser.add_argument("--topk", default=10, type=int, help="最高几选一")
+    parser.add_argument("--topp", default=0.7, type=float, help="最高积累概率")
+    parser.add_argument("--repetition_penalty", default=1.5, type=float)
+    parser.add_argument("--shortlist_path", default="", type=str, help="Restrict the LM head to a shortlist written by shortlist.py")
+    parser.add_argument("--n_samples", default="10", type=str, help="Comma separated numbers of samples per request (the batch size)")
+    parser.add_argument("--threads", default="0", type=str, help="Comma separated torch intra-op thread counts, 0 for the default")
+    parser.add_argument("--precisions", default="fp32", type=str, help="Comma separated precisions: fp32, bf16 or fp16 (autocast)")
+    parser.add_argument("--prompt_cache", default="1", type=str, help="Comma separated 0/1, reuse the key/value cache of the prompts")
+    parser.add_argument("--concurrency", default="1", type=str, help="Comma separated numbers of generation threads")
+    parser.add_argument("--device", default="cpu", type=str, help="cpu or cuda")
+    parser.add_argument("--seed", default=42, type=int, help="Random seed")
+    parser.add_argument("--output", default="", type=str, help="Write the results to this json file")
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    device = torch.device(args.device)
+    data_config = mydata_config()
+    args.length = args.length or data_config.max_seq_length
+    tokenizer = BertTokenizer.from_pretrained(args.tokenizer_path)
+    if args.model_path:
+        model, _ = load_model(args.model_path, tokenizer, data_config)
+        model = model.to(device).eval()
+    else:
+        model = build_model(device).eval() # the random weights of the benchmark
+    shortlist = None
+    if args.shortlist_path:
+        shortlist = load_shortlist(args.shortlist_path, tokenizer, model.decoder.gpt2.config.vocab_size).to(device)
+        model.decoder.set_shortlist(shortlist.ids)
+    featurizer = MyDataset(args.data_path or None, tokenizer, data_config, False)
+    if args.data_path:
+        items = featurizer.data
+    else:
+        items = synthetic_items(args.n_synthetic, args.n_topics, tokenizer, data_config, args.seed)
+
+    default_threads = torch.get_num_threads()
+    grid = itertools.product([int(x) for x in args.n_samples.split(",")], \
+                             [int(x) or default_threads for x in args.threads.split(",")], \
+                             args.precisions.split(","), [int(x) for x in args.prompt_cache.split(",")], \
+                             [int(x) for x in args.concurrency.split(",")])
+    results = []
+    for n_samples, threads, precision, prompt_cache, concurrency in grid:
+        config = {'n_samples': n_samples, 'threads': threads, 'precision': precision, \
+                  'prompt_cache': prompt_cache, 'concurrency': concurrency}
+        record = run_load(model, tokenizer, featurizer, items, config, args, device, shortlist)
+        results.append(record)
+        print("%s: p50 %.1f ms, p99 %.1f ms, %.1f tokens/s, %.2f requests/s, peak RSS %.1f MB" % (config, \
+            record['latency_ms']['p50'], record['latency_ms']['p99'], record['tokens_per_sec'], \
+            record['requests_per_sec'], record['peak_rss_mb']))
+    report(results)
+
+    if args.output:
+        output = {
+            'meta': {
+                'git_revision': git_revision(),
+                'torch': torch.__version__,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'device': args.device,
+                'model_path': args.model_path or None,
+                'data_path': args.data_path or None,
+                'length': args.length,
+                'arrival_rate': args.arrival_rate
+            },
+            'results': results
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(output, f, indent=2)
+        print("Results saved to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 # class MyNLLLoss(torch.nn.Module):
 #     def __init__(self):
@@ -72,4 +74,125 @@ class MyLoss(torch.nn.Module):
             p = 1/torch.exp(_loss)
             loss[i] += torch.sum(- y * torch.log(p + NEAR_0) - (1 - y) * torch.log(1 - p + NEAR_0))
         return torch.mean(loss)
-         
\ No newline at end of file
+         
+
+class PackedLoss(torch.nn.Module):
+    def __init__(self, data_config, model_cfgs):
+        '''
+        MyLoss on the packed layout of MyDataset.pack_batch(). The cross entropy of each sample is averaged
+        over its real tokens only, as the pad slots are not in the packed layout.
+        '''
+        super(PackedLoss, self).__init__()
+        self._max_topic_len = data_config.topic_prompt_length
+
+    def forward(self, outputs, labels, ratings, stage):
+        '''
+        Args:
+            outputs: (batch_size, topic_prompt_length + packed_length, vocab_size)
+            labels: (batch_size, packed_length), batch['packed_labels']
+            ratings: (batch_size)
+        '''
+        logits = outputs[:, self._max_topic_len:, :]
+        token_loss = F.cross_entropy(logits.reshape(-1, logits.size(-1)), labels.reshape(-1), \
+                                     ignore_index=-100, reduction='none').view(labels.shape)
+        _loss = token_loss.sum(1) / (labels != -100).sum(1).clamp(min=1)
+        return rating_loss(_loss, ratings, stage)
+
+
+def rating_loss(_loss, ratings, stage):
+    '''
+    The loss of MyLoss from the mean cross entropy of each sample: the negative log likelihood of the rating label
+    (positive or not for the stage) with the probability p = exp(-cross entropy).
+    '''
+    NEAR_0 = 1e-10
+    if stage == 1:
+        y = (ratings > 4).float()
+    else:
+        y = (ratings > 3).float()
+    p = torch.exp(-_loss)
+    loss = - y * torch.log(p + NEAR_0) - (1 - y) * torch.log(1 - p + NEAR_0)
+    return torch.mean(loss)
+
+
+def _chunk_cross_entropy(hidden, weight, labels):
+    return F.cross_entropy(F.linear(hidden, weight).float(), labels, reduction='none')
+
+
+def chunked_cross_entropy(hidden, weight, labels, chunk_size=1024):
+    '''
+    Cross entropy of the LM head logits hidden @ weight.T, computed chunk_size positions at a time
+    and only at the positions whose label is not -100. With gradients, each chunk is recomputed in the backward pass,
+    so at most one chunk of logits is held in memory.
+    Args:
+        hidden: (batch_size, length, n_embd)
+        weight: (vocab_size, n_embd)
+        labels: (batch_size, length)
+    Returns:
+        (batch_size, length), 0 where labels is -100
+    '''
+    flat_hidden = hidden.reshape(-1, hidden.size(-1))
+    flat_labels = labels.reshape(-1).long()
+    idxs = torch.nonzero(flat_labels != -100, as_tuple=False).squeeze(1)
+    grad = torch.is_grad_enabled() and (hidden.requires_grad or weight.requires_grad)
+    chunks = []
+    for start in range(0, idxs.numel(), chunk_size):
+        chunk_idxs = idxs[start:start + chunk_size]
+        args = (flat_hidden[chunk_idxs], weight, flat_labels[chunk_idxs])
+        chunks.append(checkpoint(_chunk_cross_entropy, *args) if grad else _chunk_cross_entropy(*args))
+    token_loss = flat_hidden.new_zeros(flat_labels.numel(), dtype=torch.float32)
+    if chunks:
+        token_loss = token_loss.index_put((idxs,), torch.cat(chunks))
+    return token_loss.view(labels.shape)
+
+
+class FusedLoss(torch.nn.Module):
+    def __init__(self, data_config, model_cfgs, chunk_size=1024, packed=False):
+        '''
+        MyLoss (or PackedLoss if packed) from the last hidden states of GPT2 instead of its logits:
+        the LM head and the cross entropy are only computed at the target positions, in chunks of chunk_size positions,
+        so the full [batch_size, length, vocab_size] logits are never built.
+        '''
+        super(FusedLoss, self).__init__()
+        self._max_topic_len = data_config.topic_prompt_length
+        self.chunk_size = chunk_size
+        self.packed = packed
+
+    def forward(self, hidden_states, lm_head_weight, targets, ratings, stage):
+        '''
+        Args:
+            hidden_states: (batch_size, topic_prompt_length + length, n_embd), from MMTG.forward(batch, return_hidden=True)
+            lm_head_weight: (vocab_size, n_embd), the weight of decoder.gpt2.lm_head
+            targets: (batch_size, length), batch['targets'], or batch['packed_labels'] if packed
+            ratings: (batch_size)
+        '''
+        if self.packed:
+            hidden, labels = hidden_states[:, self._max_topic_len:], targets
+        else:
+            hidden, labels = hidden_states[:, self._max_topic_len:-1], targets[:, 1:]
+        token_loss = chunked_cross_entropy(hidden, lm_head_weight, labels, self.chunk_size)
+        _loss = token_loss.sum(1) / (labels != -100).sum(1).clamp(min=1)
+        return rating_loss(_loss, ratings, stage)
+
+
+class DistillLoss(torch.nn.Module):
+    def __init__(self, data_config, temperature=2.0):
+        super(DistillLoss, self).__init__()
+        self._max_topic_len = data_config.topic_prompt_length
+        self.temperature = temperature
+
+    def forward(self, outputs, teacher_outputs, attention_mask):
+        '''
+        KL divergence between the softened teacher and student distributions on the non-pad target positions.
+        Args:
+            outputs: (batch_size, topic_prompt_length + max_seq_length + 1, vocab_size)
+            teacher_outputs: (batch_size, topic_prompt_length + max_seq_length + 1, teacher_vocab_size)
+            attention_mask: (batch_size, max_seq_length + 1)
+        '''
+        vocab_size = outputs.size(-1)
+        shift_logits = outputs[:, self._max_topic_len:-1, :] / self.temperature
+        shift_teacher_logits = teacher_outputs[:, self._max_topic_len:-1, :vocab_size] / self.temperature
+        mask = attention_mask[:, 1:].float()
+
+        kl = F.kl_div(F.log_softmax(shift_logits, dim=-1), F.log_softmax(shift_teacher_logits, dim=-1), \
+                      reduction='none', log_target=True).sum(-1)
+        return torch.sum(kl * mask) / mask.sum().clamp(min=1) * self.temperature ** 2
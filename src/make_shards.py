@@ -0,0 +1,32 @@
+import argparse
+import os
+import pickle
+
+from MyDataset import build_shard_index
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", default="", type=str, help="A data pickle of MyDataset to split into shards, none to only index output_dir")
+    parser.add_argument("--output_dir", default="", type=str, help="Directory of the shards")
+    parser.add_argument("--shard_size", default=10000, type=int, help="Number of samples per shard")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    embeddings = None
+    if args.data_path:
+        data = pickle.load(open(args.data_path, "rb"))
+        if isinstance(data, dict) and 'embeddings' in data: # deduplicated, the shards keep the references to its table
+            embeddings = os.path.relpath(os.path.join(os.path.dirname(args.data_path), data['embeddings']), args.output_dir)
+            data = data['samples']
+        for i, start in enumerate(range(0, len(data), args.shard_size)):
+            with open(os.path.join(args.output_dir, "shard_%05d.pkl" % i), "wb") as f:
+                pickle.dump(data[start:start + args.shard_size], f)
+        print("Split %d samples of %s into %d shards." % (len(data), args.data_path, i + 1))
+    index = build_shard_index(args.output_dir, embeddings)
+    print("Indexed %d shards, %d samples in %s." % (len(index['shards']), \
+        sum(shard['n_samples'] for shard in index['shards']), os.path.join(args.output_dir, "index.json")))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,16 +11,76 @@ import torch
 import torch.nn as nn
 import torch.nn.init as init
 from scipy import stats
+import copy
 import random
 import math
+import os
 import pickle
 import numpy as np
 
 from transformers import GPT2LMHeadModel, GPT2Config
 from configs import data_config
+from checkpoint import load_tensors, save_tensors
 
 
 
+class TransformerStepEncoder(nn.Module):
+    def __init__(self, input_dim, hidden_dim, num_layers, attention_heads=4, ff_dim=None, dropout=0.1, causal=True):
+        '''
+        The 'TRM' type of the image and text encoders: a linear projection of the inputs, sinusoidal position
+        encodings of the steps and a transformer encoder, all the steps at once instead of one after the other.
+        With causal, each step only attends to itself and the steps before it, as the state of a RNN.
+        Called like nn.GRU on [seq_len, batch_size, input_dim].
+        '''
+        super(TransformerStepEncoder, self).__init__()
+        self.hidden_dim = hidden_dim
+        self.causal = causal
+        self.input_fc = nn.Linear(input_dim, hidden_dim)
+        self.dropout = nn.Dropout(dropout)
+        layer = nn.TransformerEncoderLayer(hidden_dim, attention_heads, ff_dim or hidden_dim * 2, dropout)
+        self.layers = nn.TransformerEncoder(layer, num_layers)
+
+    def position_encoding(self, seq_len, device):
+        positions = torch.arange(seq_len, dtype=torch.float32, device=device).unsqueeze(1)
+        freqs = torch.exp(torch.arange(0, self.hidden_dim, 2, dtype=torch.float32, device=device) \
+                          * (-math.log(10000.0) / self.hidden_dim))
+        encoding = torch.zeros(seq_len, self.hidden_dim, device=device)
+        encoding[:, 0::2] = torch.sin(positions * freqs)
+        encoding[:, 1::2] = torch.cos(positions * freqs)
+        return encoding.unsqueeze(1) # [seq_len, 1, hidden_dim]
+
+    def forward(self, x):
+        '''
+        Args:
+            x: [seq_len, batch_size, input_dim]
+        Returns:
+            output: [seq_len, batch_size, hidden_dim], hidden: [1, batch_size, hidden_dim], the output of the last step
+        '''
+        seq_len = x.size(0)
+        h = self.dropout(self.input_fc(x) + self.position_encoding(seq_len, x.device))
+        # -inf above the diagonal: a step does not attend to the later ones
+        mask = torch.triu(torch.full((seq_len, seq_len), float('-inf'), device=x.device), 1) if self.causal else None
+        output = self.layers(h, mask=mask)
+        return output, output[-1:]
+
+
+def step_encoder(cfgs, dropout_rate):
+    '''
+    The multi-layer RNN, LSTM, GRU or transformer (TRM) over the image or text steps of the modality configs cfgs.
+    '''
+    if cfgs['type'] == 'RNN':
+        return nn.RNN(cfgs['input_dim'], cfgs['hidden_dim'], \
+                      num_layers=cfgs['num_layers'], nonlinearity = "relu", dropout=dropout_rate)
+    elif cfgs['type'] == 'LSTM':
+        return nn.LSTM(cfgs['input_dim'], cfgs['hidden_dim'], num_layers=cfgs['num_layers'], dropout=dropout_rate)
+    elif cfgs['type'] == 'GRU':
+        return nn.GRU(cfgs['input_dim'], cfgs['hidden_dim'], num_layers=cfgs['num_layers'], dropout=dropout_rate)
+    elif cfgs['type'] == 'TRM':
+        return TransformerStepEncoder(cfgs['input_dim'], cfgs['hidden_dim'], cfgs['num_layers'], \
+            cfgs.get('attention_heads', 4), cfgs.get('ff_dim'), dropout_rate, cfgs.get('causal', True))
+    raise ValueError("Unknown encoder type %s, expected RNN, LSTM, GRU or TRM" % cfgs['type'])
+
+
 class MultiModalEncoder(nn.Module):
     def __init__(self, model_cfgs):
         super(MultiModalEncoder, self).__init__()
@@ -37,27 +97,10 @@ class MultiModalEncoder(nn.Module):
             "The hidden dim of topic, image and text must be equal."
         # for topic mlp
         self.topic_fc = nn.Linear(self.topic_input_dim, self.topic_hidden_dim)
-        # for image multi-layer rnns
-        if model_cfgs['image']['type'] == 'RNN':
-            self.rnns_image = nn.RNN(self.image_input_dim, self.image_hidden_dim, \
-                                    num_layers=self.image_num_layers, nonlinearity = "relu", dropout=self.dropout_rate)
-        elif model_cfgs['image']['type'] == 'LSTM':
-            self.rnns_image = nn.LSTM(self.image_input_dim, self.image_hidden_dim, \
-                                    num_layers=self.image_num_layers, dropout=self.dropout_rate)
-        elif model_cfgs['image']['type'] == 'GRU':
-            self.rnns_image = nn.GRU(self.image_input_dim, self.image_hidden_dim, \
-                                    num_layers=self.image_num_layers, dropout=self.dropout_rate)
-        # for text multi-layer rnns
-        if model_cfgs['text']['type'] == 'RNN':
-            self.rnns_text = nn.RNN(self.text_input_dim, self.text_hidden_dim, \
-                                    num_layers=self.text_num_layers, nonlinearity = "relu", dropout=self.dropout_rate)
-        elif model_cfgs['text']['type'] == 'LSTM':
-            self.rnns_text = nn.LSTM(self.text_input_dim, self.text_hidden_dim, \
-                                    num_layers=self.text_num_layers, dropout=self.dropout_rate)
-        elif model_cfgs['text']['type'] == 'GRU':
-            self.rnns_text = nn.GRU(self.text_input_dim, self.text_hidden_dim, \
-                                    num_layers=self.text_num_layers, dropout=self.dropout_rate)
-        
+        # for image and text multi-layer rnns or transformers
+        self.rnns_image = step_encoder(model_cfgs['image'], self.dropout_rate)
+        self.rnns_text = step_encoder(model_cfgs['text'], self.dropout_rate)
+
         self.init_weights()
 
     def forward(self, encoder_batch):
@@ -67,8 +110,9 @@ class MultiModalEncoder(nn.Module):
                             'image': [seq_len, batch_size, input_dim]
                             'text': [seq_len, batch_size, input_dim]}
         '''
-        self.rnns_image.flatten_parameters()
-        self.rnns_text.flatten_parameters()
+        for rnns in (self.rnns_image, self.rnns_text):
+            if isinstance(rnns, nn.RNNBase):
+                rnns.flatten_parameters()
         # Inputs
         x_topic = encoder_batch['topic']
         x_image = encoder_batch['image']
@@ -82,10 +126,12 @@ class MultiModalEncoder(nn.Module):
 
     def init_weights(self):
         init.xavier_normal_(self.topic_fc.weight)
-        init.xavier_normal_(self.rnns_image.weight_ih_l0)
-        init.orthogonal_(self.rnns_image.weight_hh_l0)
-        init.xavier_normal_(self.rnns_text.weight_ih_l0)
-        init.orthogonal_(self.rnns_text.weight_hh_l0)
+        for rnns in (self.rnns_image, self.rnns_text):
+            if isinstance(rnns, nn.RNNBase):
+                init.xavier_normal_(rnns.weight_ih_l0)
+                init.orthogonal_(rnns.weight_hh_l0)
+            else:
+                init.xavier_normal_(rnns.input_fc.weight)
 
 
 class InnerModalAttentionLayer(nn.Module):
@@ -130,10 +176,11 @@ class InnerModalAttentionLayer(nn.Module):
         x = x.contiguous().view(*new_x_shape)
         return x.permute(0, 2, 1, 3).contiguous()
 
-    def forward(self, input):
+    def forward(self, input, return_probs=False):
         '''
         Args:
             input: [batch_size, seq_len, attention_dim]
+            return_probs: also return the attention probs [batch_size, attention_heads, seq_len, seq_len]
         '''
         mixed_query_layer = self.query(input)
         mixed_key_layer = self.key(input)
@@ -158,6 +205,8 @@ class InnerModalAttentionLayer(nn.Module):
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
         context_layer = context_layer.contiguous().view(*new_context_layer_shape)
         
+        if return_probs:
+            return context_layer, kldivloss.mean(), attention_probs
         return context_layer, kldivloss.mean()
 
 
@@ -178,49 +227,165 @@ class MultiModalAttentionLayer(nn.Module):
             ])
         self.out_linear = nn.Linear(self.att_input_dim, 2048)
 
-    def forward(self, topic_output, image_output, text_output):
+    def forward(self, topic_output, image_output, text_output, return_weights=False):
         '''
         Args:
             topic_output: [1, batch_size, hidden_dim]
             image_output, text_output: [seq_len, batch_size, hidden_dim]
+            return_weights: also return the weights of the topic, the image and the text [batch_size, seq_len, 3]
         '''
         batch_size = image_output.size(1)
         device = image_output.device
         # Attention
         atten_outputs = torch.zeros(self.seq_len, batch_size, 2048).to(device)
+        weights = []
         for i in range(self.seq_len):
             topic_att = self.att_matrices[i](topic_output).transpose(0, 1)
             image_att = self.att_matrices[i](image_output[i,:,:].unsqueeze(0)).transpose(0, 1)
             text_att = self.att_matrices[i](text_output[i,:,:].unsqueeze(0)).transpose(0, 1)
             atten = nn.Softmax(dim=-1)(torch.cat([topic_att, image_att, text_att], dim=1).permute(0,2,1))
+            weights.append(atten.mean(1))
             output = torch.bmm(
                 atten, torch.cat([topic_output.transpose(0, 1), image_output[i,:,:].unsqueeze(0).transpose(0, 1), \
                         text_output[i,:,:].unsqueeze(0).transpose(0, 1)], dim=1))
             atten_out = self.out_linear(output)
             atten_outputs[i,:,:] = atten_out.transpose(0, 1)
         
+        if return_weights:
+            return atten_outputs, torch.stack(weights, dim=1)
         return atten_outputs
 
 
+def stack_token_id2emb(token_id2emb, emb_size):
+    '''
+    Stack the dict of token id -> WenLan embedding into a [max id + 1, emb_size] table, zeros for the missing ids.
+    '''
+    table = torch.zeros(max(token_id2emb.keys()) + 1, emb_size, dtype=torch.float32)
+    for _id, emb in token_id2emb.items():
+        table[_id] = torch.tensor(emb, dtype=torch.float32)
+    return table
+
+
+def token_id2emb_as_safetensors(path, emb_size):
+    '''
+    The stacked table of the token id -> WenLan embedding pickle at path, as a '.safetensors' file next to it
+    that GPT2_Decoder memory-maps. It is written on first use.
+    '''
+    out_path = os.path.splitext(path)[0] + ".safetensors"
+    if not os.path.exists(out_path) or os.path.getmtime(out_path) < os.path.getmtime(path):
+        save_tensors({'token_id2emb': stack_token_id2emb(pickle.load(open(path, "rb")), emb_size)}, out_path)
+    return out_path
+
+
 class GPT2_Decoder(nn.Module):
     def __init__(
         self,
         data_config,
         model_name="uer/gpt2-chinese-cluecorpussmall",
-        config_path="config/model_config.json"
+        config_path="config/model_config.json",
+        token_emb_path="./vocab/token_id2emb_dict.pkl",
+        vocab_size=None
     ):
+        '''
+        If model_name is None, GPT2 is built from config_path with random weights,
+        with vocab_size (if not None) in place of the vocab size of the config.
+        '''
         super(GPT2_Decoder, self).__init__()
         self.data_config = data_config
         self.config = GPT2Config.from_json_file(config_path)
-        self.token_id2emb = self.load_token_id2emb("./vocab/token_id2emb_dict.pkl")
+        # the heads removed by prune.py, pruned again when GPT2 is built (the json keys are str)
+        self.config.pruned_heads = {int(layer): heads for layer, heads in self.config.pruned_heads.items()}
+        if model_name is None and vocab_size is not None:
+            self.config.vocab_size = vocab_size
+        self.register_buffer("token_id2emb", self.load_token_id2emb(token_emb_path), persistent=False)
         self.projector_layer1 = nn.Linear(2048, 512)
         self.tanh = nn.Tanh()
-        self.projector_layer2 = nn.Linear(512, 768)
-        self.gpt2 = GPT2LMHeadModel.from_pretrained(model_name)
+        self.projector_layer2 = nn.Linear(512, self.config.n_embd)
+        if model_name is not None:
+            self.gpt2 = GPT2LMHeadModel.from_pretrained(model_name)
+        else:
+            self.gpt2 = GPT2LMHeadModel(self.config)
+        self.register_buffer("shortlist_weight", None, persistent=False)
 
     def load_token_id2emb(self, path):
-        token_id2emb = pickle.load(open(path, "rb"))
-        return token_id2emb
+        '''
+        Load the dict of token id -> WenLan embedding and stack it into a [vocab_size, wenlan_emb_size] table,
+        so that the lookup is a single indexing op on the device of the model.
+        A '.safetensors' path written by token_id2emb_as_safetensors() is memory-mapped instead.
+        If path is None, the table is left as zeros to be filled by the caller.
+        '''
+        if path is None:
+            return torch.zeros(self.config.vocab_size, self.data_config['wenlan_emb_size'], dtype=torch.float32)
+        if path.endswith(".safetensors"):
+            table = load_tensors(path)[0]['token_id2emb']
+        else:
+            table = stack_token_id2emb(pickle.load(open(path, "rb")), self.data_config['wenlan_emb_size'])
+        if table.size(0) < self.config.vocab_size:
+            table = torch.cat([table, table.new_zeros(self.config.vocab_size - table.size(0), table.size(1))])
+        return table
+
+    def embed_targets(self, concat_output, input_ids, start_pos=0, segment_ids=None):
+        '''
+        WenLan embeddings of the target ids, each two sentences added with their multi-modal condition.
+        Args:
+            concat_output: [batch_size, seq_len, wenlan_emb_size]
+            input_ids: [batch_size, n], the ids at target positions start_pos ... start_pos + n - 1
+            segment_ids: [batch_size, n], the two sentences of each id for a packed layout, instead of start_pos
+        '''
+        seq_len = concat_output.size(1)
+        input_embs = self.token_id2emb[input_ids.long()]
+        if segment_ids is None:
+            two_sents_length = (self.data_config['max_sent_length'] + 2) * 2 # 2 for [#START#] and [#EOS#]
+            segments = torch.arange(start_pos, start_pos + input_ids.size(1), device=input_ids.device) // two_sents_length
+            in_segment = (segments < seq_len).to(input_embs.dtype)
+            condition = concat_output[:, segments.clamp(max=seq_len - 1)] * in_segment[None, :, None]
+        else:
+            in_segment = (segment_ids < seq_len).to(input_embs.dtype)
+            condition = concat_output.gather(1, segment_ids.clamp(max=seq_len - 1).unsqueeze(-1) \
+                .expand(-1, -1, concat_output.size(-1))) * in_segment.unsqueeze(-1)
+        return input_embs + condition
+
+    def project(self, input_embs):
+        '''
+        Project the WenLan embeddings to the input space of GPT2.
+        '''
+        out1 = self.projector_layer1(input_embs)
+        out1 = self.tanh(out1)
+        return self.projector_layer2(out1)
+
+    def inference_type_ids(self, input_ids, start_pos=0):
+        '''
+        Type ids of the generated ids at target positions start_pos ... start_pos + n - 1.
+        [#START#], [#EOS#] and [PAD] slots get 0, the i-th sentence gets i + 1 and the last one calls back to 1.
+        '''
+        sent_len = self.data_config['max_sent_length'] + 2
+        max_sent_num = self.data_config['max_seq_length'] // sent_len + 1
+        type_ids_list = torch.tensor(list(range(1, max_sent_num)) + [1], dtype=torch.long, device=input_ids.device)
+        positions = torch.arange(start_pos, start_pos + input_ids.size(1), device=input_ids.device)
+        type_ids = type_ids_list[(positions // sent_len).clamp(max=len(type_ids_list) - 1)]
+        is_special = (positions % sent_len == 0) | (positions % sent_len == sent_len - 1)
+        type_ids = type_ids.masked_fill(is_special, 0).unsqueeze(0).repeat(input_ids.size(0), 1)
+        return type_ids.masked_fill(input_ids == 0, 0)
+
+    def set_shortlist(self, ids=None):
+        '''
+        Restrict the LM head of generation to the vocabulary ids given by ids (a 1-d LongTensor): the logits of prefill(),
+        step() and the inference forward() become [..., len(ids)], column i being the logit of ids[i].
+        The rows of the head are copied once, so the matmul of each step only reads them. None restores the full head.
+        '''
+        if ids is None:
+            self.shortlist_weight = None
+        else:
+            weight = self.gpt2.lm_head.weight.detach()
+            self.shortlist_weight = weight[ids.to(weight.device)].clone()
+
+    def lm_logits(self, hidden_states):
+        '''
+        The LM head on the last hidden states of GPT2, over the shortlist if one is set.
+        '''
+        if self.shortlist_weight is None:
+            return self.gpt2.lm_head(hidden_states)
+        return torch.nn.functional.linear(hidden_states, self.shortlist_weight)
 
     def forward(
         self,
@@ -231,7 +396,8 @@ class GPT2_Decoder(nn.Module):
         tpw_type_ids,
         attention_mask=None,
         type_ids=None,
-        is_train=False
+        is_train=False,
+        return_hidden=False
     ):
         '''
         Params:
@@ -242,90 +408,195 @@ class GPT2_Decoder(nn.Module):
             tpw_type_ids: [batch_size, topic_prompt_length]
             attention_mask: [batch_size, seq_len * _sent_length * 2]
             type_ids: [batch_size, seq_len * _sent_length * 2]
+            return_hidden: return the last hidden states of GPT2 ('last_hidden_state') without the LM head and the loss
         '''
-        # process labels
-        prompt_length = topic_ids.size(1)
-        batch_size = concat_output.size(0)
-        seq_len = concat_output.size(1)
-        two_sents_length = (self.data_config['max_sent_length'] + 2) * 2 # 2 for [#START#] and [#EOS#]
-        labels = torch.cat([topic_ids, input_ids], dim=1)
-
-        # process topic ids
-        topic_ids_np = topic_ids.cpu().tolist()
-        topic_ids_wenlan = torch.zeros(batch_size, prompt_length, self.data_config['wenlan_emb_size'], dtype=torch.float32).to(topic_ids.device)
-        for i in range(batch_size):
-            for j in range(prompt_length):
-                topic_ids_wenlan[i][j] = torch.tensor(self.token_id2emb[topic_ids_np[i][j]], dtype=torch.float32)
-
-        # process input ids
-        input_ids_np = input_ids.cpu().tolist()
-        input_ids_wenlan = torch.zeros(batch_size, input_ids.size(1), self.data_config['wenlan_emb_size'], dtype=torch.float32).to(input_ids.device)
-        for i in range(batch_size):
-            for j in range(input_ids.size(1)):
-                _id = input_ids_np[i][j]
-                input_ids_wenlan[i][j] = torch.tensor(self.token_id2emb[_id], dtype=torch.float32).to(input_ids.device)
-            for k in range(seq_len):
-                input_ids_wenlan[i,two_sents_length*k:two_sents_length*(k+1)] = input_ids_wenlan[i,two_sents_length*k:two_sents_length*(k+1)] + concat_output[i,k]
+        topic_ids = topic_ids.long()
 
-        if is_train:
-            # process final input embs
-            input_embs = torch.cat([topic_ids_wenlan, input_ids_wenlan], dim=1)
+        # process final input embs
+        input_embs = torch.cat([self.token_id2emb[topic_ids], self.embed_targets(concat_output, input_ids)], dim=1)
+        gpt_input_embs = self.project(input_embs)
 
+        if is_train:
             type_ids = torch.cat([tpw_type_ids, type_ids], dim=1).to(input_ids.device)
-            
             # process attention mask
             attention_mask = torch.cat([tpw_att_mask, attention_mask], dim=1)
-        
-            out1 = self.projector_layer1(input_embs)
-            out1 = self.tanh(out1)
-            gpt_input_embs = self.projector_layer2(out1)
-            res = self.gpt2(
-                inputs_embeds=gpt_input_embs,
-                token_type_ids=type_ids,
-                attention_mask=attention_mask,
-                labels=labels,
-                return_dict=True
-            )
+            labels = None if return_hidden else torch.cat([topic_ids, input_ids], dim=1)
         
         # inference
         else:
-            # process final input embs
-            input_embs = torch.cat([topic_ids_wenlan, input_ids_wenlan], dim=1)
-
-            _type_ids = tpw_type_ids
-            max_sent_num = self.data_config['max_seq_length'] // (self.data_config['max_sent_length'] + 2) + 1
-            _type_ids_list = list(range(1,max_sent_num))+[1]
-                        
-            # add type_ids
-            sent_len = self.data_config['max_sent_length'] + 2
-            for i in range(input_ids.size(1)):
-                if (i + 1) % sent_len == 0 or (i + 1) % sent_len == 1:
-                    _type_ids = torch.cat([_type_ids, torch.zeros(1, dtype=torch.long).unsqueeze(0).repeat(type_ids.size(0),1).to(type_ids.device)], dim=1)
-                else:
-                    cat_type_id = torch.zeros(1, dtype=torch.long) if input_ids[0][i] == 0 else torch.tensor(_type_ids_list[i//sent_len], dtype=torch.long)
-                    _type_ids = torch.cat([_type_ids, cat_type_id.unsqueeze(0).repeat(type_ids.size(0),1).to(type_ids.device)], dim=1)
-                    
-            # add attention mask
-            _attention_mask = tpw_att_mask
-            for i in range(input_ids.size(1)):
-                cat_att_mask = torch.zeros(1, dtype=torch.long) if input_ids[0][i] == 0 else torch.ones(1, dtype=torch.long)
-                _attention_mask = torch.cat([_attention_mask, cat_att_mask.unsqueeze(0).repeat(concat_output.size(0),1).to(attention_mask.device)], dim=1)
-            
-            _labels = torch.zeros(input_embs.size(1), dtype=torch.long).unsqueeze(0).repeat(concat_output.size(0),1).to(input_ids.device)
-
-            out1 = self.projector_layer1(input_embs)
-            out1 = self.tanh(out1)
-            gpt_input_embs = self.projector_layer2(out1)
-
-            res = self.gpt2(
-                inputs_embeds=gpt_input_embs,
-                token_type_ids = _type_ids.clone().detach().long(),
-                attention_mask = _attention_mask.clone().detach().long(),
-                labels=_labels,
-                return_dict=True
-            )
+            type_ids = torch.cat([tpw_type_ids.long(), self.inference_type_ids(input_ids)], dim=1)
+            attention_mask = torch.cat([tpw_att_mask.long(), (input_ids != 0).long()], dim=1)
+            labels = None # the loss of the generated ids is not used
+        use_shortlist = not is_train and not return_hidden and self.shortlist_weight is not None
+        # StageProfiler hooks self.gpt2.transformer, which both paths run
+        gpt2 = self.gpt2.transformer if return_hidden or use_shortlist else self.gpt2
+        kwargs = {} if labels is None else {'labels': labels}
+        res = gpt2(
+            inputs_embeds=gpt_input_embs,
+            token_type_ids=type_ids,
+            attention_mask=attention_mask,
+            return_dict=True,
+            **kwargs
+        )
+        if use_shortlist:
+            return {'logits': self.lm_logits(res['last_hidden_state'])}
         return res
 
+    def forward_packed(
+        self,
+        concat_output,
+        input_ids,
+        positions,
+        segment_ids,
+        type_ids,
+        attention_mask,
+        topic_ids,
+        tpw_att_mask,
+        tpw_type_ids,
+        return_hidden=False
+    ):
+        '''
+        The decoder on the packed layout of MyDataset.pack_batch(), without the pad slots of the fixed layout.
+        GPT2 gets the positions of the fixed layout, so the logits of the real tokens are the same as in forward().
+        Params:
+            input_ids, positions, segment_ids, type_ids, attention_mask: [batch_size, packed_length]
+            return_hidden: return the last hidden states of GPT2 ('last_hidden_state') instead of the logits
+        Returns:
+            GPT2 outputs with logits: [batch_size, topic_prompt_length + packed_length, vocab_size], without loss
+        '''
+        topic_ids = topic_ids.long()
+        topic_length = topic_ids.size(1)
+        input_embs = torch.cat([self.token_id2emb[topic_ids], \
+            self.embed_targets(concat_output, input_ids, segment_ids=segment_ids)], dim=1)
+        position_ids = torch.cat([torch.arange(topic_length, device=positions.device).expand(positions.size(0), -1), \
+                                  positions + topic_length], dim=1)
+        gpt2 = self.gpt2.transformer if return_hidden else self.gpt2
+        return gpt2(
+            inputs_embeds=self.project(input_embs),
+            token_type_ids=torch.cat([tpw_type_ids.long(), type_ids], dim=1),
+            attention_mask=torch.cat([tpw_att_mask.long(), attention_mask], dim=1),
+            position_ids=position_ids,
+            return_dict=True
+        )
+
+    def prefill(self, concat_output, input_ids, topic_ids, tpw_att_mask, tpw_type_ids):
+        '''
+        Run the topic prompt and the given target ids through GPT2 once and keep the key/value cache,
+        so that the following ids can be decoded with step().
+        Returns:
+            logits: [batch_size, topic_prompt_length + n, vocab_size] (shortlist size if set_shortlist() was called)
+            past_key_values, attention_mask: to be passed to step()
+        '''
+        topic_ids = topic_ids.long()
+        input_embs = torch.cat([self.token_id2emb[topic_ids], self.embed_targets(concat_output, input_ids)], dim=1)
+        type_ids = torch.cat([tpw_type_ids.long(), self.inference_type_ids(input_ids)], dim=1)
+        attention_mask = torch.cat([tpw_att_mask.long(), (input_ids != 0).long()], dim=1)
+        res = self.gpt2.transformer(
+            inputs_embeds=self.project(input_embs),
+            token_type_ids=type_ids,
+            attention_mask=attention_mask,
+            use_cache=True,
+            return_dict=True
+        )
+        return self.lm_logits(res['last_hidden_state']), res['past_key_values'], attention_mask
+
+    def prefill_prompt(self, topic_ids, tpw_att_mask, tpw_type_ids):
+        '''
+        The key/value cache of the topic prompt alone. Only the target ids are conditioned on concat_output,
+        so the cache only depends on the topic ids and can be shared by the samples of every experience with the same topic.
+        Returns:
+            past_key_values, attention_mask: to be passed to step() with start_pos 0
+        '''
+        attention_mask = tpw_att_mask.long()
+        res = self.gpt2.transformer(
+            inputs_embeds=self.project(self.token_id2emb[topic_ids.long()]),
+            token_type_ids=tpw_type_ids.long(),
+            attention_mask=attention_mask,
+            use_cache=True,
+            return_dict=True
+        )
+        return res['past_key_values'], attention_mask
+
+    def step(self, concat_output, input_ids, start_pos, attention_mask, past_key_values):
+        '''
+        Decode the target ids at positions start_pos ... start_pos + n - 1 on top of the key/value cache.
+        Args:
+            input_ids: [batch_size, n]
+            attention_mask: [batch_size, past_length], returned by prefill() or the last step()
+        Returns:
+            logits: [batch_size, n, vocab_size], past_key_values, attention_mask
+        '''
+        attention_mask = torch.cat([attention_mask, (input_ids != 0).long()], dim=1)
+        res = self.gpt2.transformer(
+            inputs_embeds=self.project(self.embed_targets(concat_output, input_ids, start_pos)),
+            token_type_ids=self.inference_type_ids(input_ids, start_pos),
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True
+        )
+        return self.lm_logits(res['last_hidden_state']), res['past_key_values'], attention_mask
+
+    @staticmethod
+    def reorder_cache(past_key_values, beam_idx):
+        '''
+        Select (and copy) the rows of the key/value cache given by beam_idx.
+        '''
+        return tuple(
+            tuple(past_state.index_select(0, beam_idx.to(past_state.device)) for past_state in layer_past)
+            for layer_past in past_key_values
+        )
+
+    @staticmethod
+    def expand_cache(past_key_values, n):
+        '''
+        The key/value cache of one row as n rows, as views of the same memory. It saves the n copies of the prefill,
+        not the memory of the decode: the first step() concatenates the prefix with the new position into new tensors,
+        which copies the prefix into every row.
+        '''
+        return tuple(
+            tuple(past_state.expand(n, -1, -1, -1) for past_state in layer_past)
+            for layer_past in past_key_values
+        )
+
+    @staticmethod
+    def truncate_cache(past_key_values, length):
+        '''
+        Keep the first length positions of the key/value cache.
+        '''
+        return tuple(
+            tuple(past_state[:, :, :length] for past_state in layer_past)
+            for layer_past in past_key_values
+        )
+
+
+class GPT2_DraftDecoder(GPT2_Decoder):
+    def __init__(self, decoder, n_layer=2):
+        '''
+        A shallow GPT2 that proposes tokens for speculative decoding.
+        It shares the token embedding table and the projector layers with the full decoder,
+        and is initialized with its embeddings, its first n_layer blocks and its final layer norm.
+        Args:
+            decoder: GPT2_Decoder, the full decoder
+            n_layer: int, number of GPT2 blocks of the draft
+        '''
+        nn.Module.__init__(self)
+        self.data_config = decoder.data_config
+        self.config = copy.deepcopy(decoder.gpt2.config)
+        self.config.n_layer = n_layer
+        self.config.pruned_heads = {layer: heads for layer, heads in self.config.pruned_heads.items() if layer < n_layer}
+        self.register_buffer("token_id2emb", decoder.token_id2emb, persistent=False)
+        self.projector_layer1 = decoder.projector_layer1
+        self.tanh = decoder.tanh
+        self.projector_layer2 = decoder.projector_layer2
+        self.gpt2 = GPT2LMHeadModel(self.config)
+        self.register_buffer("shortlist_weight", None, persistent=False)
+        state_dict = {
+            key: value for key, value in decoder.gpt2.state_dict().items()
+            if not key.startswith('transformer.h.') or int(key.split('.')[2]) < n_layer
+        }
+        self.gpt2.load_state_dict(state_dict)
+
 
 class MMTG(nn.Module):
     def __init__(self, model_cfgs, data_config, vocab_size, train_flag=False):
@@ -340,9 +611,13 @@ class MMTG(nn.Module):
         self.img_inner_atten_layer = InnerModalAttentionLayer(model_cfgs)
         self.text_inner_atten_layer = InnerModalAttentionLayer(model_cfgs)
         self.mm_atten_layer = MultiModalAttentionLayer(model_cfgs)
-        self.decoder = GPT2_Decoder(data_config)
+        self.decoder = GPT2_Decoder(data_config, \
+            model_name=model_cfgs.get('GPT2_NAME', "uer/gpt2-chinese-cluecorpussmall"), \
+            config_path=model_cfgs.get('GPT2_CONFIG', "config/model_config.json"), \
+            token_emb_path=model_cfgs.get('TOKEN_EMB_PATH', "./vocab/token_id2emb_dict.pkl"), \
+            vocab_size=model_cfgs.get('GPT2_VOCAB_SIZE'))
         self.train_flag = train_flag
-        if train_flag:
+        if train_flag and model_cfgs['GPT2_PATH']:
             # Load pre-trained GPT2 model
             print("Loading pre-trained GPT2 model...")
             state_dict = torch.load(model_cfgs['GPT2_PATH'], map_location="cpu")
@@ -353,20 +628,14 @@ class MMTG(nn.Module):
             self.decoder.load_state_dict(state_dict)
             print("Pre-trained GPT2 model loaded.")
             
-    def forward(self, batch):
+    def encode(self, batch, return_attentions=False):
         '''
-        Args:
-            batch: {
-                'topic_ids': [batch_size, topic_prompt_length],
-                'tpw_attention_mask': [batch_size, topic_prompt_length],
-                'tpw_type_ids': [batch_size, topic_prompt_length],
-                'topic_emb': [batch_size, input_dim],
-                'img_embs': [batch_size, seq_len, input_dim],
-                'r_embs': [batch_size, seq_len, input_dim],
-                'targets': [batch_size, seq_len * _max_sent_length * 2],
-                'attention_mask': [batch_size, seq_len * _max_sent_length * 2],
-                'type_ids': [batch_size, seq_len * _max_sent_length * 2],
-            }
+        Run the multi-modal encoder, the alpha and the beta attention.
+        Returns:
+            concat_output: [batch_size, seq_len, 2048], the condition of every two sentences
+            kl_loss: the KLDivLoss of the alpha attention
+            attentions (if return_attentions): {'alpha_image', 'alpha_text': [batch_size, attention_heads, seq_len, seq_len],
+                                                'beta': [batch_size, seq_len, 3], the weights of the topic, the image and the text}
         '''
         encoder_batch = {'topic': batch['topic_emb'].float(), \
                          'image': batch['img_embs'].transpose(0, 1).float(), \
@@ -382,21 +651,57 @@ class MMTG(nn.Module):
         text_output = self.ln_layer3(text_output)
         
         # ===== Inner-modal (Alpha) Attention Layer =====
-        img_inner_attention_output, img_kl_loss = self.img_inner_atten_layer(image_output.transpose(0, 1))
-        text_inner_attention_output, text_kl_loss = self.text_inner_atten_layer(text_output.transpose(0, 1))
+        img_inner_attention_output, img_kl_loss, *img_probs = self.img_inner_atten_layer(image_output.transpose(0, 1), \
+            return_attentions)
+        text_inner_attention_output, text_kl_loss, *text_probs = self.text_inner_atten_layer(text_output.transpose(0, 1), \
+            return_attentions)
 
         # ===== Multi-modal (Beta) Attention Layer =====
         mm_attention_output = self.mm_atten_layer(topic_output, \
-            img_inner_attention_output.transpose(0,1), text_inner_attention_output.transpose(0,1))        
+            img_inner_attention_output.transpose(0,1), text_inner_attention_output.transpose(0,1), return_attentions)
+
+        if return_attentions:
+            mm_attention_output, beta = mm_attention_output
+            attentions = {'alpha_image': img_probs[0], 'alpha_text': text_probs[0], 'beta': beta}
+            return mm_attention_output.transpose(0, 1), (img_kl_loss + text_kl_loss).mean(), attentions
+        return mm_attention_output.transpose(0, 1), (img_kl_loss + text_kl_loss).mean()
+
+    def forward(self, batch, return_hidden=False):
+        '''
+        Args:
+            batch: {
+                'topic_ids': [batch_size, topic_prompt_length],
+                'tpw_attention_mask': [batch_size, topic_prompt_length],
+                'tpw_type_ids': [batch_size, topic_prompt_length],
+                'topic_emb': [batch_size, input_dim],
+                'img_embs': [batch_size, seq_len, input_dim],
+                'r_embs': [batch_size, seq_len, input_dim],
+                'targets': [batch_size, seq_len * _max_sent_length * 2],
+                'attention_mask': [batch_size, seq_len * _max_sent_length * 2],
+                'type_ids': [batch_size, seq_len * _max_sent_length * 2],
+            }
+            With the packed layout of MyDataset.pack_batch(), the decoder only runs on the 'packed_*' tensors,
+            outputs are the logits of the topic prompt and the packed targets and loss is None.
+            With return_hidden, outputs are the last hidden states of GPT2 for loss.FusedLoss and loss is None.
+        '''
+        concat_output, kl_loss = self.encode(batch)
+
+        if 'packed_ids' in batch:
+            res = self.decoder.forward_packed(concat_output, batch['packed_ids'], batch['packed_positions'], \
+                            batch['packed_segment_ids'], batch['packed_type_ids'], batch['packed_attention_mask'], \
+                            batch['topic_ids'], batch['tpw_attention_mask'], batch['tpw_type_ids'], return_hidden)
+            return None, kl_loss, res['last_hidden_state' if return_hidden else 'logits']
 
         # ===== Decoder =====
         decoder_input = batch['targets']
 
-        res = self.decoder(mm_attention_output.transpose(0, 1), decoder_input, \
+        res = self.decoder(concat_output, decoder_input, \
                         batch['topic_ids'], batch['tpw_attention_mask'], batch['tpw_type_ids'], \
-                        batch['attention_mask'], batch['type_ids'], self.train_flag)
-        loss, outputs = res['loss'], res['logits']
+                        batch['attention_mask'], batch['type_ids'], self.train_flag, return_hidden)
+        if return_hidden:
+            return None, kl_loss, res['last_hidden_state']
+        loss, outputs = res.get('loss'), res['logits']
 
-        return loss, (img_kl_loss + text_kl_loss).mean(), outputs
+        return loss, kl_loss, outputs
 
 
@@ -8,22 +8,25 @@ LastEditTime: 2022-08-10 18:32:58
 
 
 import argparse
+import itertools
+import json
 import math
 import os
-import pdb
 import time as t
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from tqdm import tqdm, trange
 from transformers import BertTokenizer
 
 from configs import data_config, model_cfgs
-from model import EXPTeller
 from MyDataset import MyDataset
+from adapters import load_model
+from generate import shared_prefix_sample, ids_to_lyrics
+from scoring import target_logprobs, layout_token_ids, scored_mask
 from utils import *
 
 
@@ -144,6 +147,92 @@ def sample_sequence(
 
 
 
+def permute_batch(batch, perms):
+    '''
+    Every experience of batch under every order of its image/text steps, as one batch of
+    batch_size * n_perms rows (row e * n_perms + p is experience e under perms[p]).
+    Args:
+        batch: a collated batch of MyDataset
+        perms: [n_perms, seq_len], LongTensor of the orders
+    '''
+    n_perms = perms.size(0)
+    rows = {k: v.repeat_interleave(n_perms, dim=0) for k, v in batch.items() if k not in ('img_embs', 'r_embs')}
+    for k in ('img_embs', 'r_embs'):
+        rows[k] = batch[k][:, perms].flatten(0, 1) # [batch_size, n_perms, seq_len, input_dim] -> rows
+    return rows
+
+
+def teacher_forced_nll(mmtg, concat_output, batch, layout_ids):
+    '''
+    Mean negative log-likelihood of the reference targets of each row given the condition concat_output,
+    over the targets that score_targets() scores.
+    Returns:
+        [batch_size]
+    '''
+    mask = scored_mask(batch['targets'], layout_ids).float()
+    return -(target_logprobs(mmtg, concat_output, batch) * mask).sum(1) / mask.sum(1).clamp(min=1)
+
+
+def permutation_analysis(mmtg, data_loader, perms, layout_ids, device, chunk_size=128):
+    '''
+    Run every experience of data_loader under every order of perms through the encoder, the attention layers
+    and the teacher-forced decoder, chunk_size rows at a time.
+    The shifts are against the first order of perms (the identity for all the orders) at the same positions.
+    Returns:
+        {'nll', 'alpha_shift', 'beta_shift': [n_experiences, n_perms], 'beta': [n_experiences, n_perms, seq_len, 3]}
+    '''
+    perms = perms.to(device)
+    results = {'nll': [], 'alpha_shift': [], 'beta_shift': [], 'beta': []}
+    with torch.no_grad():
+        for batch in tqdm(data_loader):
+            rows = permute_batch({k: v.to(device) for k, v in batch.items()}, perms)
+            n_rows = rows['targets'].size(0)
+            nll, alpha, beta = [], [], []
+            for start in range(0, n_rows, chunk_size):
+                chunk = {k: v[start:start + chunk_size] for k, v in rows.items()}
+                concat_output, _, attentions = mmtg.encode(chunk, return_attentions=True)
+                nll.append(teacher_forced_nll(mmtg, concat_output, chunk, layout_ids))
+                alpha.append(torch.stack([attentions['alpha_image'], attentions['alpha_text']], dim=1))
+                beta.append(attentions['beta'])
+            nll = torch.cat(nll).view(-1, perms.size(0))
+            alpha = torch.cat(alpha).view(nll.size(0), perms.size(0), *alpha[0].shape[1:])
+            beta = torch.cat(beta).view(nll.size(0), perms.size(0), *beta[0].shape[1:])
+            results['nll'].append(nll.cpu())
+            results['alpha_shift'].append((alpha - alpha[:, :1]).abs().flatten(2).mean(-1).cpu())
+            results['beta_shift'].append((beta - beta[:, :1]).abs().flatten(2).mean(-1).cpu())
+            results['beta'].append(beta.cpu())
+    return {k: torch.cat(v) for k, v in results.items()}
+
+
+def inversions(perm):
+    '''
+    Number of pairs of steps in reverse order (the Kendall tau distance to the identity).
+    '''
+    return sum(perm[i] > perm[j] for i in range(len(perm)) for j in range(i + 1, len(perm)))
+
+
+def report_permutations(perms, results, top=10):
+    '''
+    Print the orders that shift the likelihood of the references most and least, and the shifts by number of inversions.
+    '''
+    delta = results['nll'] - results['nll'][:, :1]
+    names = [''.join(str(i) for i in perm) for perm in perms.tolist()]
+    order = delta.mean(0).argsort(descending=True).tolist()
+    print("%-8s %5s %10s %10s %8s %12s %12s %8s %8s %8s" % ("order", "inv", "dNLL mean", "dNLL std", "worse %", \
+        "alpha shift", "beta shift", "topic", "image", "text"))
+    for p in order[:top] + (order[-top:] if len(order) > 2 * top else order[top:]):
+        beta = results['beta'][:, p].mean((0, 1)).tolist()
+        print("%-8s %5d %10.4f %10.4f %8.1f %12.4f %12.4f %8.3f %8.3f %8.3f" % (names[p], inversions(perms[p].tolist()), \
+            delta[:, p].mean(), delta[:, p].std() if delta.size(0) > 1 else 0.0, (delta[:, p] > 0).float().mean() * 100, \
+            results['alpha_shift'][:, p].mean(), results['beta_shift'][:, p].mean(), *beta))
+    print("\n%5s %6s %10s %12s %12s" % ("inv", "orders", "dNLL mean", "alpha shift", "beta shift"))
+    n_inv = torch.tensor([inversions(perm) for perm in perms.tolist()])
+    for k in n_inv.unique().tolist():
+        selected = n_inv == k
+        print("%5d %6d %10.4f %12.4f %12.4f" % (k, selected.sum(), delta[:, selected].mean(), \
+            results['alpha_shift'][:, selected].mean(), results['beta_shift'][:, selected].mean()))
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--device_ids", default="0,1,2,3", type=str, help="GPU device ids")
@@ -161,6 +250,15 @@ def main():
     parser.add_argument("--save_samples", action="store_true", help="保存产生的样本")
     parser.add_argument("--save_samples_path", default=".", type=str, required=False, help="保存样本的路径")
     parser.add_argument("--n_samples", default=5, type=int, required=False, help="生成的样本数量")
+    parser.add_argument("--permutation_analysis", action="store_true", \
+                        help="Score every experience under the orders of its image/text steps instead of the interactive display")
+    parser.add_argument("--permutations", default="", type=str, required=False, \
+                        help="Comma separated orders to analyse, e.g. 01234,10234, all the orders if empty")
+    parser.add_argument("--n_experiences", default=0, type=int, required=False, help="Analyse the first n experiences, all if 0")
+    parser.add_argument("--chunk_size", default=128, type=int, required=False, help="Rows of the batched passes of the analysis")
+    parser.add_argument("--generate_top", default=0, type=int, required=False, \
+                        help="Also generate n_samples for the identity and the generate_top orders that shift the likelihood most")
+    parser.add_argument("--output", default="", type=str, required=False, help="Write the per-experience results to this json file")
     
 
     # global args
@@ -189,26 +287,67 @@ def main():
     print("vocab_size: ", len(tokenizer.vocab))
     
     # load model
-    checkpoint = torch.load(args.model_path)
-    model = EXPTeller(model_cfgs, len(tokenizer.vocab), False) # predicting mode
+    model, _ = load_model(args.model_path, tokenizer, data_config) # predicting mode
     model.to(device)
-    model = nn.DataParallel(model, device_ids=device_ids)
-    model.load_state_dict(checkpoint['model'])
+    model.eval()
     print("Loaded model from {}".format(args.model_path))
 
 
     print("Loading data...")
     test_data_file = args.data_path
     test_data = MyDataset(test_data_file, tokenizer, data_config, False)
+    if args.n_experiences > 0:
+        test_data = Subset(test_data, range(min(args.n_experiences, len(test_data))))
     test_dataset = DataLoader(test_data, batch_size=batch_size, shuffle=False, num_workers=num_workers)
     print("Data test loaded.")
 
-
-    def swap(item, m, n):
-        item[[m,n], :] = item[[n,m], :]
-        # print(item)
-        # item[:,:] = 9
-        return item
+    if args.permutation_analysis:
+        seq_len = model.model_cfgs['seq_len']
+        if args.permutations:
+            perms = [[int(i) for i in order] for order in args.permutations.split(",")]
+            perms = [list(range(seq_len))] + [perm for perm in perms if perm != list(range(seq_len))]
+        else:
+            perms = list(itertools.permutations(range(seq_len))) # the identity first
+        perms = torch.tensor(perms, dtype=torch.long)
+        # each batch of the loader becomes batch_size * n_perms rows
+        data_loader = DataLoader(test_data, batch_size=max(args.chunk_size // len(perms), 1), \
+                                 shuffle=False, num_workers=num_workers)
+        print("Scoring %d experiences under %d orders..." % (len(test_data), len(perms)))
+        results = permutation_analysis(model, data_loader, perms, layout_token_ids(tokenizer, device), device, args.chunk_size)
+        report_permutations(perms, results)
+
+        generated = {}
+        if args.generate_top > 0:
+            delta = results['nll'] - results['nll'][:, :1]
+            for idx in trange(len(test_data)):
+                generated[idx] = {}
+                for p in [0] + delta[idx].argsort(descending=True)[:args.generate_top].tolist():
+                    perm = perms[p].numpy()
+                    start_input = test_data[idx]
+                    start_input['img_embs'] = start_input['img_embs'][perm]
+                    start_input['r_embs'] = start_input['r_embs'][perm]
+                    start_input['targets'] = np.asarray([tokenizer.convert_tokens_to_ids('[#START#]')])
+                    all_preds = shared_prefix_sample(model, start_input, length=length, tokenizer=tokenizer, \
+                        num_samples=args.n_samples, temperature=temperature, top_k=topk, top_p=topp, \
+                        repitition_penalty=repetition_penalty, device=device)
+                    name = ''.join(str(i) for i in perm)
+                    generated[idx][name] = [ids_to_lyrics(tokenizer, preds) for preds in all_preds]
+                    print("%d %s (dNLL %+.4f): %s" % (idx, name, delta[idx, p], generated[idx][name][0]))
+
+        if args.output:
+            output = {
+                'permutations': [''.join(str(i) for i in perm) for perm in perms.tolist()],
+                'nll': results['nll'].tolist(),
+                'alpha_shift': results['alpha_shift'].tolist(),
+                'beta_shift': results['beta_shift'].tolist(),
+                'beta': results['beta'].tolist(),
+                'generated': generated
+            }
+            os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(output, f, ensure_ascii=False)
+            print("Results saved to {}".format(args.output))
+        return
 
 
     print("Now displaying any instance of the test data. 0 <= idx < %d" % (len(test_data)))
@@ -241,33 +380,6 @@ def main():
             print(''.join(preds[:-1]).replace('[PAD]', '').replace('[#START#]', '').replace('[#EOS#]', '，'))
             print("-"*80)
         
-        while 0:
-            try:
-                start_input = test_dataset.dataset[idx]
-                start_input['targets'] = np.asarray(encoded)
-                # print(start_input['img_embs'])
-                m, n = input("Swap: ").split()
-                swap_input = start_input
-                swap_input['img_embs'] = swap(swap_input['img_embs'], int(m), int(n))
-                swap_input['r_embs'] = swap(swap_input['r_embs'], int(m), int(n))
-                # print(swap_input['img_embs'])
-                preds = sample_sequence(
-                    model,
-                    swap_input,
-                    length=length,
-                    tokenizer=tokenizer,
-                    temperature=temperature,
-                    top_k=topk,
-                    top_p=topp,
-                    repitition_penalty=repetition_penalty,
-                    device=device,
-                )
-                preds = [tokenizer.convert_ids_to_tokens(line) for line in preds]
-                print(''.join(preds[:-1]).replace('[PAD]', '').replace('[#START#]', '').replace('[#EOS#]', '，'))
-            except:
-                break
-        
-        
         print("="*100)
     
 
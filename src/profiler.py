@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+import time
+
+import torch
+import torch.nn as nn
+
+from utils import rss_mb
+
+
+class StageProfiler(object):
+    def __init__(self, max_events=200000):
+        '''
+        Opt-in timing and memory of the named stages of MMTG, recorded by forward hooks.
+        Nothing is registered until attach() is called, so a run without profiling has no overhead.
+        Stages: encoder, layer_norm, alpha_attention, beta_attention, decoder_embedding, gpt2 and loss.
+        gpt2 is the transformer of GPT2 without the LM head, which every decoding path runs (forward() and
+        the prefill() / step() of beam search, speculative sampling and --share_prefix).
+        Args:
+            max_events: int, number of events kept for the chrome trace, the summary counts all of them
+        '''
+        self.max_events = max_events
+        self.events = []
+        self.stats = {}
+        self._open = {}
+        self._handles = []
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+        self._cuda = torch.cuda.is_available()
+
+    def _snapshot(self):
+        if self._cuda:
+            torch.cuda.synchronize()
+        cuda_mb = torch.cuda.memory_allocated() / 1024 ** 2 if self._cuda else 0.0
+        return time.perf_counter(), rss_mb(), cuda_mb
+
+    def begin(self, name):
+        key = (name, threading.get_ident())
+        self._open[key] = self._snapshot()
+
+    def end(self, name):
+        key = (name, threading.get_ident())
+        if key not in self._open:
+            return
+        t1, rss1, cuda1 = self._open.pop(key)
+        t2, rss2, cuda2 = self._snapshot()
+        dur_ms = (t2 - t1) * 1000
+        with self._lock:
+            stat = self.stats.setdefault(name, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, \
+                'max_rss_mb': 0.0, 'max_rss_delta_mb': 0.0, 'max_cuda_mb': 0.0, 'max_cuda_delta_mb': 0.0})
+            stat['count'] += 1
+            stat['total_ms'] += dur_ms
+            stat['max_ms'] = max(stat['max_ms'], dur_ms)
+            stat['max_rss_mb'] = max(stat['max_rss_mb'], rss2)
+            stat['max_rss_delta_mb'] = max(stat['max_rss_delta_mb'], rss2 - rss1)
+            stat['max_cuda_mb'] = max(stat['max_cuda_mb'], cuda2)
+            stat['max_cuda_delta_mb'] = max(stat['max_cuda_delta_mb'], cuda2 - cuda1)
+            if len(self.events) < self.max_events:
+                self.events.append({
+                    'name': name, 'cat': 'mmtg', 'ph': 'X', 'pid': os.getpid(), 'tid': key[1],
+                    'ts': (t1 - self._t0) * 1e6, 'dur': (t2 - t1) * 1e6,
+                    'args': {'rss_mb': rss2, 'rss_delta_mb': rss2 - rss1, 'cuda_mb': cuda2, 'cuda_delta_mb': cuda2 - cuda1}
+                })
+
+    def _hook(self, module, begin=None, end=None, when="pre"):
+        def hook(*_):
+            if end is not None:
+                self.end(end)
+            if begin is not None:
+                self.begin(begin)
+        if when == "pre":
+            self._handles.append(module.register_forward_pre_hook(hook))
+        else:
+            self._handles.append(module.register_forward_hook(hook))
+
+    def attach(self, model, criterion=None):
+        '''
+        Register the hooks on an MMTG (or nn.DataParallel of it) and optionally on the loss module.
+        '''
+        if isinstance(model, nn.DataParallel):
+            model = model.module
+        stages = [
+            (model.encoder, 'encoder'),
+            (model.ln_layer1, 'layer_norm'),
+            (model.ln_layer2, 'layer_norm'),
+            (model.ln_layer3, 'layer_norm'),
+            (model.img_inner_atten_layer, 'alpha_attention'),
+            (model.text_inner_atten_layer, 'alpha_attention'),
+            (model.mm_atten_layer, 'beta_attention'),
+            (model.decoder.gpt2.transformer, 'gpt2'),
+        ]
+        if criterion is not None:
+            stages.append((criterion, 'loss'))
+        for module, name in stages:
+            self._hook(module, begin=name, when="pre")
+            self._hook(module, end=name, when="post")
+        # the decoder embedding is built between entering the decoder and entering the transformer of GPT2
+        self._hook(model.decoder, begin='decoder_embedding', when="pre")
+        self._hook(model.decoder.gpt2.transformer, end='decoder_embedding', when="pre")
+        return self
+
+    def missing(self, stages=('encoder', 'gpt2')):
+        '''
+        The stages of stages that were never recorded, e.g. because a decoding path bypasses the hooked modules.
+        '''
+        return [name for name in stages if self.stats.get(name, {}).get('count', 0) == 0]
+
+    def detach(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def summary(self):
+        '''
+        Per stage count, total / mean / max time in ms and max memory in MB.
+        '''
+        summary = {}
+        for name, stat in self.stats.items():
+            summary[name] = dict(stat, mean_ms=stat['total_ms'] / stat['count'])
+        return summary
+
+    def export(self, prefix):
+        '''
+        Write prefix.trace.json (to be opened in chrome://tracing or Perfetto) and prefix.summary.json.
+        '''
+        if os.path.dirname(prefix):
+            os.makedirs(os.path.dirname(prefix), exist_ok=True)
+        with self._lock:
+            events = [dict(event) for event in self.events]
+        tids = {}
+        for event in events:
+            event['tid'] = tids.setdefault(event['tid'], len(tids))
+        with open(prefix + ".trace.json", "w", encoding="utf-8") as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        with open(prefix + ".summary.json", "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=2)
+        return prefix + ".trace.json", prefix + ".summary.json"
@@ -0,0 +1,236 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from transformers import BertTokenizer
+
+from configs import data_config as mydata_config
+from MyDataset import MyDataset, batch_to_device
+from loss import MyLoss
+from checkpoint import save_checkpoint, cpu_snapshot
+from adapters import load_model
+
+
+def original_heads(attn, n_head):
+    '''
+    The original index of each remaining head of a GPT2 attention layer.
+    '''
+    return sorted(set(range(n_head)) - attn.pruned_heads)
+
+
+def unit_flops(gpt2, context_length):
+    '''
+    Multiply-adds (x2) per generated token, at context_length positions of context, of each head and each block of GPT2.
+    Returns:
+        head_flops: FLOPs of one head (its rows of c_attn and c_proj and its attention), block_flops: FLOPs of each block
+        (its heads and its MLP), lm_head_flops
+    '''
+    config = gpt2.config
+    d, head_dim = config.n_embd, config.n_embd // config.n_head
+    head_flops = 2 * d * 3 * head_dim + 2 * head_dim * d + 4 * context_length * head_dim
+    mlp_flops = 4 * d * (config.n_inner or 4 * d)
+    block_flops = [block.attn.num_heads * head_flops + mlp_flops for block in gpt2.transformer.h]
+    return head_flops, block_flops, 2 * d * config.vocab_size
+
+
+def total_flops(gpt2, context_length):
+    _, block_flops, lm_head_flops = unit_flops(gpt2, context_length)
+    return sum(block_flops) + lm_head_flops
+
+
+def batch_loss(model, batch, criterion, stage):
+    '''
+    The MyLoss objective of train.py on a batch.
+    '''
+    _, _, outputs = model(batch)
+    return criterion(outputs.contiguous(), batch['targets'], batch['rating'], stage)
+
+
+def head_importance(model, batches, criterion, stage):
+    '''
+    First-order estimate of the loss increase of masking each head (Michel et al., 2019): |dL/dg| of a gate g = 1
+    on the output of the head, summed over batches.
+    Returns:
+        a list with a [num_heads] tensor per block
+    '''
+    blocks = model.decoder.gpt2.transformer.h
+    gates = [torch.ones(block.attn.num_heads, device=batches[0]['targets'].device, requires_grad=True) for block in blocks]
+    handles = []
+    for block, gate in zip(blocks, gates):
+        head_dim = block.attn.head_dim
+        hook = lambda module, inputs, gate=gate, head_dim=head_dim: (inputs[0] * gate.repeat_interleave(head_dim),)
+        handles.append(block.attn.c_proj.register_forward_pre_hook(hook))
+    scores = [torch.zeros_like(gate) for gate in gates]
+    try:
+        for batch in batches:
+            grads = torch.autograd.grad(batch_loss(model, batch, criterion, stage), gates)
+            for score, grad in zip(scores, grads):
+                score += grad.abs()
+    finally:
+        for handle in handles:
+            handle.remove()
+    return [score.detach().cpu() for score in scores]
+
+
+def layer_importance(model, batches, criterion, stage):
+    '''
+    Loss increase of skipping each GPT2 block, summed over batches.
+    Returns:
+        [n_layer]
+    '''
+    def loss_sum():
+        with torch.no_grad():
+            return sum(batch_loss(model, batch, criterion, stage).item() for batch in batches)
+
+    base = loss_sum()
+    scores = []
+    for block in model.decoder.gpt2.transformer.h:
+        handle = block.register_forward_hook(lambda module, inputs, output: (inputs[0],) + tuple(output[1:]))
+        try:
+            scores.append(loss_sum() - base)
+        finally:
+            handle.remove()
+    return torch.tensor(scores)
+
+
+def remove_layers(gpt2, layers):
+    '''
+    Remove the blocks of index layers from gpt2 (a GPT2LMHeadModel), renumbering config.pruned_heads.
+    '''
+    kept = [i for i in range(len(gpt2.transformer.h)) if i not in set(layers)]
+    gpt2.transformer.h = nn.ModuleList([gpt2.transformer.h[i] for i in kept])
+    gpt2.config.pruned_heads = {new: sorted(gpt2.config.pruned_heads[old]) for new, old in enumerate(kept) \
+                                if old in gpt2.config.pruned_heads}
+    gpt2.config.n_layer = len(kept)
+
+
+def select_units(heads, layers, blocks, head_flops, block_flops, target):
+    '''
+    Pick the heads and blocks of least importance per FLOP until they add up to target FLOPs.
+    The last head of a block is never pruned alone, the block is removed instead.
+    Returns:
+        {layer: [current head index]}, [layer]
+    '''
+    units = [(score.item() / head_flops, head_flops, 'head', layer, h) \
+             for layer, layer_scores in enumerate(heads) for h, score in enumerate(layer_scores)]
+    units += [(max(score.item(), 0) / flops, flops, 'layer', layer, None) \
+              for layer, (score, flops) in enumerate(zip(layers, block_flops))]
+    pruned_heads, pruned_layers, saved = {}, [], 0
+    for _, flops, kind, layer, h in sorted(units, key=lambda unit: unit[0]):
+        if saved >= target:
+            break
+        if layer in pruned_layers:
+            continue
+        if kind == 'layer':
+            if len(pruned_layers) + 1 == len(blocks):
+                continue
+            saved += block_flops[layer] - len(pruned_heads.pop(layer, [])) * head_flops
+            pruned_layers.append(layer)
+        elif len(pruned_heads.get(layer, [])) + 1 < blocks[layer].attn.num_heads:
+            pruned_heads.setdefault(layer, []).append(h)
+            saved += flops
+    return pruned_heads, pruned_layers
+
+
+def prune_decoder(model, batches, criterion, stage, flop_ratio, context_length, prune_step=0.1):
+    '''
+    Prune the heads and the blocks of the GPT2 of model (an MMTG) until it needs at most flop_ratio of its
+    FLOPs per generated token. The importances are computed again after every prune_step of the original FLOPs.
+    '''
+    gpt2 = model.decoder.gpt2
+    original = total_flops(gpt2, context_length)
+    while total_flops(gpt2, context_length) > flop_ratio * original:
+        heads = head_importance(model, batches, criterion, stage)
+        layers = layer_importance(model, batches, criterion, stage)
+        head_flops, block_flops, _ = unit_flops(gpt2, context_length)
+        target = min(prune_step * original, total_flops(gpt2, context_length) - flop_ratio * original)
+        pruned_heads, pruned_layers = select_units(heads, layers, gpt2.transformer.h, head_flops, block_flops, target)
+        if not pruned_heads and not pruned_layers:
+            print("Nothing left to prune.")
+            break
+        gpt2.prune_heads({layer: [original_heads(gpt2.transformer.h[layer].attn, gpt2.config.n_head)[h] for h in hs] \
+                          for layer, hs in pruned_heads.items()})
+        remove_layers(gpt2, pruned_layers)
+        print("Pruned %d heads and %d blocks: %d blocks with %s heads, %.1f%% of the FLOPs." % ( \
+            sum(len(hs) for hs in pruned_heads.values()), len(pruned_layers), gpt2.config.n_layer, \
+            [block.attn.num_heads for block in gpt2.transformer.h], total_flops(gpt2, context_length) / original * 100))
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", default="", type=str, help="Checkpoint to prune")
+    parser.add_argument("--val_data_path", default="", type=str, help="Val data the importances are computed on")
+    parser.add_argument("--tokenizer_path", default="./vocab/vocab.txt", type=str, help="词表路径")
+    parser.add_argument("--flop_ratio", default=0.5, type=float, help="Keep at most this fraction of the FLOPs per generated token of the decoder")
+    parser.add_argument("--prune_step", default=0.1, type=float, help="Fraction of the FLOPs pruned between two importance computations")
+    parser.add_argument("--context_length", default=0, type=int, \
+                        help="Context length of the FLOP count, the mean one of generation if 0")
+    parser.add_argument("--stage", default=3, type=int, help="Curriculum stage of the MyLoss objective")
+    parser.add_argument("--batch_size", default=8, type=int, help="Batch size of the importances")
+    parser.add_argument("--n_batches", default=16, type=int, help="Number of val batches of the importances")
+    parser.add_argument("--output", default="./models/pruned/pruned_model.safetensors", type=str, help="Pruned checkpoint")
+    parser.add_argument("--config_output", default="", type=str, \
+                        help="GPT2 config of the pruned decoder, next to the checkpoint if empty")
+    parser.add_argument("--recover_epochs", default=0, type=int, help="Epochs of recovery fine-tuning with train.py, 0 for none")
+    parser.add_argument("--train_data_path", default="", type=str, help="Train data of the recovery fine-tuning")
+    parser.add_argument("--recover_args", default="", type=str, help="More arguments of train.py for the recovery, e.g. '--lr 5e-6'")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    data_config = mydata_config()
+    tokenizer = BertTokenizer.from_pretrained(args.tokenizer_path)
+    model, ckpt_cfgs = load_model(args.model_path, tokenizer, data_config)
+    model.to(device)
+    model.eval() # no dropout, the gradients of the head gates are still computed
+    model.train_flag = True # the teacher-forced decoder of train.py
+
+    criterion = MyLoss(data_config, ckpt_cfgs)
+    val_data = MyDataset(args.val_data_path, tokenizer, data_config)
+    batches = []
+    for batch in DataLoader(val_data, batch_size=args.batch_size, shuffle=False):
+        if len(batches) == args.n_batches:
+            break
+        batches.append(batch_to_device(batch, device))
+
+    context_length = args.context_length or data_config.topic_prompt_length + (data_config.max_seq_length + 1) // 2
+    gpt2 = model.decoder.gpt2
+    print("Decoder of %d blocks of %d heads, %.1f MFLOPs per generated token." % (gpt2.config.n_layer, gpt2.config.n_head, \
+        total_flops(gpt2, context_length) / 1e6))
+    with torch.no_grad():
+        base_loss = sum(batch_loss(model, batch, criterion, args.stage).item() for batch in batches) / len(batches)
+    prune_decoder(model, batches, criterion, args.stage, args.flop_ratio, context_length, args.prune_step)
+    with torch.no_grad():
+        loss = sum(batch_loss(model, batch, criterion, args.stage).item() for batch in batches) / len(batches)
+    print("Val loss %.4f -> %.4f, %.1f MFLOPs per generated token." % (base_loss, loss, total_flops(gpt2, context_length) / 1e6))
+
+    # the GPT2 config of the pruned decoder, which GPT2LMHeadModel prunes again when it is built
+    config_output = args.config_output or os.path.splitext(args.output)[0] + "_config.json"
+    gpt2_config = json.load(open(ckpt_cfgs.get('GPT2_CONFIG', "config/model_config.json"), encoding="utf-8"))
+    gpt2_config.update({'n_layer': gpt2.config.n_layer, 'vocab_size': gpt2.config.vocab_size, \
+                        'pruned_heads': {str(layer): sorted(heads) for layer, heads in gpt2.config.pruned_heads.items()}})
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    os.makedirs(os.path.dirname(os.path.abspath(config_output)), exist_ok=True)
+    with open(config_output, "w", encoding="utf-8") as f:
+        json.dump(gpt2_config, f, indent=2)
+    ckpt_cfgs = dict(ckpt_cfgs, GPT2_CONFIG=config_output)
+    save_checkpoint(cpu_snapshot(model.state_dict()), args.output, ckpt_cfgs)
+    print("Pruned checkpoint saved to %s with the GPT2 config %s." % (args.output, config_output))
+
+    if args.recover_epochs > 0:
+        save_path = os.path.join(os.path.dirname(os.path.abspath(args.output)), "recovered")
+        command = [sys.executable, "train.py", "--init_path", args.output, "--train_data_path", args.train_data_path, \
+                   "--val_data_path", args.val_data_path, "--epochs", str(args.recover_epochs), \
+                   "--save_model", "--save_path", save_path, "--log_path", save_path + ".log"] + args.recover_args.split()
+        print("Recovery fine-tuning: %s" % " ".join(command))
+        os.makedirs(save_path, exist_ok=True)
+        subprocess.run(command, check=True)
+
+
+if __name__ == "__main__":
+    main()
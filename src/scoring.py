@@ -0,0 +1,177 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from tqdm import tqdm
+from transformers import BertTokenizer
+
+from configs import data_config as mydata_config
+from MyDataset import MyDataset
+from adapters import load_model
+
+
+def target_logprobs(mmtg, concat_output, batch):
+    '''
+    Teacher-forced log-probability of each target id given the topic prompt, the previous targets and the condition
+    concat_output, under the full LM head (a shortlist of the decoder is ignored).
+    Args:
+        batch: 'topic_ids', 'tpw_attention_mask', 'tpw_type_ids', 'targets', 'attention_mask', 'type_ids' of MyDataset
+    Returns:
+        [batch_size, target_length]
+    '''
+    targets = batch['targets'].long()
+    hidden = mmtg.decoder(concat_output, targets, batch['topic_ids'], batch['tpw_attention_mask'], batch['tpw_type_ids'], \
+                          batch['attention_mask'], batch['type_ids'], is_train=True, return_hidden=True)['last_hidden_state']
+    # the hidden state of position t - 1 predicts the target t
+    logits = F.linear(hidden[:, batch['topic_ids'].size(1) - 1:-1], mmtg.decoder.gpt2.lm_head.weight).float()
+    return F.log_softmax(logits, dim=-1).gather(-1, targets.unsqueeze(-1)).squeeze(-1)
+
+
+def layout_token_ids(tokenizer, device=None):
+    '''
+    Ids of the [#START#]/[#EOS#]/[SEP] slots of the layout and of the pads, which are not scored.
+    '''
+    return torch.tensor(tokenizer.convert_tokens_to_ids(["[#START#]", "[#EOS#]", "[SEP]", "[PAD]"]), device=device)
+
+
+def scored_mask(targets, layout_ids):
+    '''
+    True at the targets that are scored: the tokens of the sentences, not the ids of layout_token_ids().
+    '''
+    return ~torch.isin(targets, layout_ids)
+
+
+def pad_layout(targets, attention_mask, type_ids, data_config):
+    '''
+    Pad the ids of convert_lyrics2ids() with fewer than 10 sentences to max_seq_length + 1.
+    '''
+    n_pad = data_config.max_seq_length + 1 - len(targets)
+    return list(targets) + [0] * n_pad, list(attention_mask) + [0] * n_pad, list(type_ids) + [0] * n_pad
+
+
+def ids_layout(ids, tokenizer, data_config):
+    '''
+    The targets, attention mask and type ids (as convert_lyrics2ids() makes them) of generated ids,
+    which start with [#START#]; everything after the 10th sentence or a [SEP] is dropped.
+    '''
+    sent_len = data_config.max_sent_length + 2
+    sep_id = tokenizer.sep_token_id
+    ids = list(ids[:data_config.max_seq_length])
+    if sep_id in ids:
+        ids = ids[:ids.index(sep_id)]
+    targets = ids + [0] * (data_config.max_seq_length - len(ids)) + [sep_id]
+    attention_mask = [int(i != 0) for i in targets]
+    # the type id of each pair of sentences, the 5th pair calls back to the 1st; 0 for [#START#], [#EOS#] and [PAD]
+    type_ids = [0 if i == 0 or pos % sent_len in (0, sent_len - 1) or pos >= data_config.max_seq_length \
+                else (pos // sent_len // 2) % 4 + 1 for pos, i in enumerate(targets)]
+    return targets, attention_mask, type_ids
+
+
+def score_targets(model, inputs, candidates, tokenizer, data_config, device, batch_size=32):
+    '''
+    Teacher-forced log-likelihoods of many candidates per experience. Each experience is encoded once and
+    the candidates of all the experiences are scored batch_size rows at a time on the shared encoder output.
+    Only the tokens of the sentences are scored, not the [#START#]/[#EOS#]/[SEP] slots of the layout and the pads.
+    Args:
+        inputs: list of experiences featurized by MyDataset
+        candidates: for each experience, a list of (targets, attention_mask, type_ids) of max_seq_length + 1 ids
+    Returns:
+        for each experience, {'logprob', 'mean_logprob', 'n_tokens': [n_candidates],
+                              'sentence_logprobs': [n_candidates, n_sentences]}
+    '''
+    mmtg = model.module if isinstance(model, nn.DataParallel) else model
+    sent_len = data_config.max_sent_length + 2
+    n_sents = data_config.max_seq_length // sent_len
+    layout_ids = layout_token_ids(tokenizer, device)
+    prompt_keys = ('topic_ids', 'tpw_attention_mask', 'tpw_type_ids', 'topic_emb', 'img_embs', 'r_embs')
+    experiences = {k: torch.tensor(np.stack([x[k] for x in inputs]), device=device) for k in prompt_keys}
+    rows = [(e, *layout) for e, layouts in enumerate(candidates) for layout in layouts]
+    scores = []
+    with torch.no_grad():
+        concat_output = torch.cat([mmtg.encode({k: v[i:i + batch_size] for k, v in experiences.items()})[0] \
+                                   for i in range(0, len(inputs), batch_size)])
+        for start in range(0, len(rows), batch_size):
+            chunk = rows[start:start + batch_size]
+            index = torch.tensor([row[0] for row in chunk], device=device)
+            batch = {k: experiences[k][index] for k in ('topic_ids', 'tpw_attention_mask', 'tpw_type_ids')}
+            for i, k in enumerate(('targets', 'attention_mask', 'type_ids')):
+                batch[k] = torch.tensor([row[i + 1] for row in chunk], dtype=torch.long, device=device)
+            logprobs = target_logprobs(mmtg, concat_output[index], batch)
+            scored = scored_mask(batch['targets'], layout_ids)
+            logprobs = logprobs.masked_fill(~scored, 0)
+            sentences = logprobs[:, :n_sents * sent_len].view(len(chunk), n_sents, sent_len).sum(-1)
+            n_tokens = scored.sum(1)
+            scores.append(torch.cat([logprobs.sum(1, keepdim=True), n_tokens.unsqueeze(1).float(), sentences], dim=1).cpu())
+    scores = torch.cat(scores) if scores else torch.zeros(0, n_sents + 2)
+    results = []
+    for e, layouts in enumerate(candidates):
+        s, scores = scores[:len(layouts)], scores[len(layouts):]
+        results.append({'logprob': s[:, 0], 'mean_logprob': s[:, 0] / s[:, 1].clamp(min=1), \
+                        'n_tokens': s[:, 1].long(), 'sentence_logprobs': s[:, 2:]})
+    return results
+
+
+def score_lyrics(model, featurizer, items, lyrics, tokenizer, data_config, device, batch_size=32):
+    '''
+    score_targets() of candidate lyrics: lyrics[e] is a list of candidates of the experience items[e],
+    each a list of sentences as the 'lyrics' of the data.
+    '''
+    inputs = [featurizer.featurize(item) for item in items]
+    candidates = [[pad_layout(*featurizer.convert_lyrics2ids(candidate), data_config) for candidate in item_lyrics] \
+                  for item_lyrics in lyrics]
+    return score_targets(model, inputs, candidates, tokenizer, data_config, device, batch_size)
+
+
+def score_ids(model, inputs, ids, tokenizer, data_config, device, batch_size=32):
+    '''
+    score_targets() of generated ids: ids[e] is a list of the id lists sampled for the featurized experience inputs[e].
+    '''
+    candidates = [[ids_layout(preds, tokenizer, data_config) for preds in item_ids] for item_ids in ids]
+    return score_targets(model, inputs, candidates, tokenizer, data_config, device, batch_size)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_path", default="", type=str, help="Model path")
+    parser.add_argument("--data_path", default="", type=str, help="Data of the experiences")
+    parser.add_argument("--candidates_path", default="", type=str, \
+                        help="Json list with a list of candidate lyrics (lists of sentences) per experience, the reference lyrics if empty")
+    parser.add_argument("--tokenizer_path", default="./vocab/vocab.txt", type=str, help="词表路径")
+    parser.add_argument("--batch_size", default=32, type=int, help="Candidates scored at a time")
+    parser.add_argument("--output", default="", type=str, help="Write the scores to this json file")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    data_config = mydata_config()
+    tokenizer = BertTokenizer.from_pretrained(args.tokenizer_path)
+    model, _ = load_model(args.model_path, tokenizer, data_config)
+    model.to(device)
+    model.eval()
+    featurizer = MyDataset(args.data_path, tokenizer, data_config, False)
+    items = featurizer.data
+    if args.candidates_path:
+        lyrics = json.load(open(args.candidates_path, encoding="utf-8"))
+        if len(lyrics) != len(items):
+            raise ValueError("%d lists of candidates for %d experiences" % (len(lyrics), len(items)))
+    else:
+        lyrics = [[item['lyrics']] for item in items]
+    results = []
+    for start in tqdm(range(0, len(items), args.batch_size)):
+        results += score_lyrics(model, featurizer, items[start:start + args.batch_size], \
+                                lyrics[start:start + args.batch_size], tokenizer, data_config, device, args.batch_size)
+    mean_logprob = torch.cat([r['mean_logprob'] for r in results])
+    print("Scored %d candidates of %d experiences: mean log-likelihood per token %.4f (perplexity %.2f)." % \
+        (len(mean_logprob), len(items), mean_logprob.mean(), torch.exp(-mean_logprob.mean())))
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump([{k: v.tolist() for k, v in r.items()} for r in results], f)
+        print("Scores saved to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
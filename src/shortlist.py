@@ -0,0 +1,154 @@
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+from transformers import BertTokenizer
+
+from configs import data_config as mydata_config
+from MyDataset import MyDataset
+from adapters import load_model
+
+
+# the tokens of the fixed sentence layout, always in a shortlist whatever their frequency
+SPECIAL_TOKENS = ["[PAD]", "[#START#]", "[#EOS#]", "[SEP]", "[UNK]"]
+
+
+class Shortlist(object):
+    def __init__(self, ids, vocab_size):
+        '''
+        A subset of the vocabulary the LM head of generation is restricted to (see GPT2_Decoder.set_shortlist()).
+        The logits over the shortlist have one column per id, ids[i] being the id of column i.
+        Args:
+            ids: iterable of vocabulary ids
+            vocab_size: int, size of the full head
+        '''
+        self.ids = torch.tensor(sorted(set(ids)), dtype=torch.long)
+        self.index = torch.full((vocab_size,), -1, dtype=torch.long) # id -> column, -1 if not in the shortlist
+        self.index[self.ids] = torch.arange(len(self.ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def to(self, device):
+        self.ids = self.ids.to(device)
+        self.index = self.index.to(device)
+        return self
+
+
+def token_counts(data, tokenizer, data_config):
+    '''
+    Occurrences of each vocabulary id in the target ids of the lyrics of data (a list of MyDataset items).
+    '''
+    featurizer = MyDataset(None, tokenizer, data_config)
+    counts = np.zeros(len(tokenizer), dtype=np.int64)
+    for item in data:
+        counts += np.bincount(featurizer.convert_lyrics2ids(item['lyrics'])[0], minlength=len(tokenizer))
+    return counts
+
+
+def build_shortlist(counts, tokenizer, size=0, min_count=1):
+    '''
+    The ids that occur at least min_count times, at most the size most frequent ones (no limit if 0), and the special tokens.
+    '''
+    ids = [i for i in np.argsort(-counts, kind="stable") if counts[i] >= min_count]
+    if size > 0:
+        ids = ids[:size]
+    return sorted(set(int(i) for i in ids) | set(tokenizer.convert_tokens_to_ids(SPECIAL_TOKENS)))
+
+
+def load_shortlist(path, tokenizer, vocab_size):
+    '''
+    Load a shortlist written by this script, with the special tokens added if they are missing.
+    '''
+    ids = json.load(open(path, encoding="utf-8"))['ids']
+    return Shortlist(list(ids) + tokenizer.convert_tokens_to_ids(SPECIAL_TOKENS), vocab_size)
+
+
+def evaluate_shortlist(model, shortlist, data_loader, tokenizer, device):
+    '''
+    Teacher-forced comparison of the shortlisted head with the full head, on the target positions that generation samples
+    (not the [#START#]/[#EOS#]/[SEP] slots and not the pad runs).
+    Returns:
+        target_coverage: fraction of the targets that are in the shortlist
+        shortlist_mass: mean probability the full head puts on the shortlist
+        top1_agreement: fraction of positions where the most likely token of both heads is the same
+        nll_full, nll_shortlist: mean negative log-likelihood of the targets in the shortlist under both heads
+    '''
+    forced_ids = torch.tensor(tokenizer.convert_tokens_to_ids(["[#START#]", "[#EOS#]", "[SEP]"]), device=device)
+    ids, index = shortlist.ids, shortlist.index
+    totals = {'n': 0, 'n_in': 0, 'mass': 0.0, 'agree': 0, 'nll_full': 0.0, 'nll_shortlist': 0.0}
+    with torch.no_grad():
+        for batch in data_loader:
+            batch = {k: v.to(device) for k, v in batch.items()}
+            _, _, logits = model(batch)
+            targets = batch['targets'].long()
+            # the logits of position t - 1 predict the target t
+            logits = logits[:, batch['topic_ids'].size(1) - 1:-1]
+            previous = F.pad(targets[:, :-1], (1, 0), value=-1)
+            sampled = ~torch.isin(targets, forced_ids) & (previous != tokenizer.pad_token_id)
+            logits, targets = logits[sampled], targets[sampled]
+            log_probs = F.log_softmax(logits, dim=-1)
+            shortlist_log_probs = F.log_softmax(logits[:, ids], dim=-1)
+            columns = index[targets]
+            in_shortlist = columns >= 0
+            totals['n'] += targets.numel()
+            totals['n_in'] += in_shortlist.sum().item()
+            totals['mass'] += log_probs[:, ids].exp().sum().item()
+            totals['agree'] += (ids[shortlist_log_probs.argmax(-1)] == log_probs.argmax(-1)).sum().item()
+            totals['nll_full'] -= log_probs[in_shortlist].gather(1, targets[in_shortlist, None]).sum().item()
+            totals['nll_shortlist'] -= shortlist_log_probs[in_shortlist].gather(1, columns[in_shortlist, None]).sum().item()
+    n, n_in = max(totals['n'], 1), max(totals['n_in'], 1)
+    return {
+        'target_coverage': totals['n_in'] / n,
+        'shortlist_mass': totals['mass'] / n,
+        'top1_agreement': totals['agree'] / n,
+        'nll_full': totals['nll_full'] / n_in,
+        'nll_shortlist': totals['nll_shortlist'] / n_in
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_path", default="", type=str, help="Training data pickle the token frequencies are counted on")
+    parser.add_argument("--tokenizer_path", default="./vocab/vocab.txt", type=str, help="词表路径")
+    parser.add_argument("--output", default="./vocab/shortlist.json", type=str, help="Shortlist file, read back if data_path is empty")
+    parser.add_argument("--size", default=0, type=int, help="Keep at most the size most frequent tokens, 0 for no limit")
+    parser.add_argument("--min_count", default=1, type=int, help="Keep the tokens that occur at least min_count times")
+    parser.add_argument("--model_path", default="", type=str, help="Optional checkpoint to compare the shortlisted head with the full head")
+    parser.add_argument("--eval_data_path", default="", type=str, help="Data the heads are compared on")
+    parser.add_argument("--batch_size", default=32, type=int, help="Batch size of the comparison")
+    args = parser.parse_args()
+
+    data_config = mydata_config()
+    tokenizer = BertTokenizer.from_pretrained(args.tokenizer_path)
+    if args.data_path:
+        counts = token_counts(MyDataset(args.data_path, tokenizer, data_config).data, tokenizer, data_config)
+        ids = build_shortlist(counts, tokenizer, args.size, args.min_count)
+        coverage = counts[ids].sum() / max(counts.sum(), 1)
+        if os.path.dirname(args.output):
+            os.makedirs(os.path.dirname(args.output), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({'ids': ids, 'size': args.size, 'min_count': args.min_count, 'train_coverage': float(coverage)}, f)
+        print("Shortlist of %d / %d tokens covering %.2f%% of the training targets saved to %s." % \
+            (len(ids), len(tokenizer), coverage * 100, args.output))
+
+    if args.model_path:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        model, ckpt_cfgs = load_model(args.model_path, tokenizer, data_config)
+        model.to(device)
+        model.eval()
+        shortlist = load_shortlist(args.output, tokenizer, ckpt_cfgs['GPT2_VOCAB_SIZE']).to(device)
+        data_loader = DataLoader(MyDataset(args.eval_data_path, tokenizer, data_config, False), batch_size=args.batch_size)
+        metrics = evaluate_shortlist(model, shortlist, data_loader, tokenizer, device)
+        print("Shortlist of %d tokens against the full head: target coverage %.2f%%, shortlist mass %.4f, " \
+              "top-1 agreement %.2f%%, NLL %.4f (full) / %.4f (shortlist)" % (len(shortlist), \
+              metrics['target_coverage'] * 100, metrics['shortlist_mass'], metrics['top1_agreement'] * 100, \
+              metrics['nll_full'], metrics['nll_shortlist']))
+
+
+if __name__ == "__main__":
+    main()
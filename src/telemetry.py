@@ -0,0 +1,241 @@
+import json
+import os
+import time
+
+import numpy as np
+import torch
+
+from utils import rss_mb, reset_peak_rss
+
+
+class TrainingTelemetry(object):
+    def __init__(self, metrics_path=""):
+        '''
+        Throughput and time breakdown of the training loop over an interval of steps.
+        tick(name) charges the time since the previous tick to name, e.g. 'data' for the time blocked
+        on the DataLoader and 'forward', 'backward', 'optimizer' for the compute.
+        Args:
+            metrics_path: str, a jsonl file the reports are appended to, none if empty
+        '''
+        self.metrics_path = metrics_path
+        if metrics_path and os.path.dirname(metrics_path):
+            os.makedirs(os.path.dirname(metrics_path), exist_ok=True)
+        self._cuda = torch.cuda.is_available()
+        self.reset()
+
+    def reset(self):
+        self.times = {'data': 0.0, 'forward': 0.0, 'backward': 0.0, 'optimizer': 0.0, 'eval': 0.0, 'other': 0.0}
+        self.n_steps = 0
+        self.n_loaded = 0
+        self.n_samples = 0
+        self.n_tokens = 0
+        self._start = time.perf_counter()
+        self._last = self._start
+        reset_peak_rss()
+        if self._cuda:
+            torch.cuda.reset_peak_memory_stats()
+
+    def tick(self, name, sync=False):
+        if sync and self._cuda:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.times[name] = self.times.get(name, 0.0) + now - self._last
+        self._last = now
+
+    def add_batch(self, n_loaded, n_samples, n_tokens):
+        '''
+        n_loaded samples came from the DataLoader, n_samples with n_tokens non-pad tokens were kept by the curriculum.
+        '''
+        self.n_loaded += n_loaded
+        self.n_samples += n_samples
+        self.n_tokens += n_tokens
+        if n_samples > 0:
+            self.n_steps += 1
+
+    def report(self, logger, **info):
+        '''
+        Log the metrics of the interval since the last report, append them to the metrics file and start a new interval.
+        '''
+        elapsed = max(time.perf_counter() - self._start, 1e-9)
+        record = dict(info)
+        record.update({
+            'steps': self.n_steps,
+            'elapsed_sec': elapsed,
+            'samples_per_sec': self.n_samples / elapsed,
+            'tokens_per_sec': self.n_tokens / elapsed,
+            'dropped_fraction': 1 - self.n_samples / self.n_loaded if self.n_loaded > 0 else 0.0,
+            'time_sec': dict(self.times),
+            'data_wait_fraction': self.times['data'] / elapsed,
+            'peak_rss_mb': rss_mb("VmHWM"),
+        })
+        if self._cuda:
+            record['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 1024 ** 2
+        logger.info("Telemetry: %.1f samples/s, %.1f tokens/s, dropped %.1f%%, data wait %.1f%%, " \
+                    "forward %.2fs, backward %.2fs, optimizer %.2fs, eval %.2fs, peak RSS %.1f MB" % \
+                    (record['samples_per_sec'], record['tokens_per_sec'], record['dropped_fraction'] * 100, \
+                     record['data_wait_fraction'] * 100, self.times['forward'], self.times['backward'], \
+                     self.times['optimizer'], self.times['eval'], record['peak_rss_mb']))
+        if self.metrics_path:
+            with open(self.metrics_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+        self.reset()
+        return record
+
+
+def sampled_tokens(preds, n_given=1, sent_len=22, skip_ids=(0, 102)):
+    '''
+    Number of sampled ids of preds (lists of ids from target position 0, the first n_given of each were given):
+    the forced [#START#]/[#EOS#] slots of each sentence and the skip_ids ([PAD] and [SEP]) are not counted.
+    '''
+    skip_ids = set(skip_ids)
+    return sum(1 for ids in preds for pos, i in enumerate(ids) if pos >= n_given \
+               and pos % sent_len not in (0, sent_len - 1) and int(i) not in skip_ids)
+
+
+class GenerationTelemetry(object):
+    def __init__(self, path, params=None, sent_len=22, skip_ids=(0, 102)):
+        '''
+        Per-call cost of the decoding functions of generate.py, recorded by forward hooks and appended to a jsonl
+        file: the time in the encoder and the alpha/beta attention, in the first pass of GPT2 (prefill), in the
+        following ones (decode steps) and in the draft decoder of speculative sampling, the sampled tokens and the
+        prompt cache hits. Beam search, speculative sampling and --share_prefix decode one position per step on
+        the key/value cache; the sequential sampling of sample_sequence() runs GPT2 on the whole sequence at
+        every step. close() appends the percentiles of the run. Nothing is registered until attach() is called.
+        Args:
+            path: str, the jsonl file, overwritten
+            params: dict, the sampling parameters written with every record
+            sent_len: int, slots per sentence, whose first ([#START#]) and last ([#EOS#]) are forced, not sampled
+            skip_ids: ids not counted as sampled tokens ([PAD] and [SEP])
+        '''
+        self.params = params or {}
+        self.sent_len = sent_len
+        self.skip_ids = set(skip_ids)
+        self.records = []
+        self._handles = []
+        self._cuda = torch.cuda.is_available()
+        self._active = False
+        self._open = {}
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, "w", encoding="utf-8")
+
+    def _now(self):
+        if self._cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def attach(self, model, draft=None):
+        '''
+        Register the hooks on an MMTG (or nn.DataParallel of it) and on the GPT2_DraftDecoder of speculative sampling.
+        '''
+        if isinstance(model, torch.nn.DataParallel):
+            model = model.module
+
+        def begin(name):
+            def hook(*_):
+                if self._active:
+                    self._open[name] = self._now()
+            return hook
+
+        def end_encode(*_):
+            if self._active and 'encode' in self._open:
+                self.times['encode'] += self._now() - self._open.pop('encode')
+
+        def end_gpt2(module, inputs, output):
+            if not self._active or 'gpt2' not in self._open:
+                return
+            elapsed = self._now() - self._open.pop('gpt2')
+            if self.counts['prefill_passes'] + self.counts['decode_steps'] == 0:
+                self.times['prefill'] += elapsed
+                self.counts['prefill_passes'] += 1
+            else:
+                self.times['decode'] += elapsed
+                self.counts['decode_steps'] += 1
+
+        def end_draft(*_):
+            if self._active and 'draft' in self._open:
+                self.times['draft'] += self._now() - self._open.pop('draft')
+                self.counts['draft_passes'] += 1
+
+        self._handles.append(model.encoder.register_forward_pre_hook(begin('encode')))
+        self._handles.append(model.mm_atten_layer.register_forward_hook(end_encode))
+        self._handles.append(model.decoder.gpt2.transformer.register_forward_pre_hook(begin('gpt2')))
+        self._handles.append(model.decoder.gpt2.transformer.register_forward_hook(end_gpt2))
+        if draft is not None:
+            self._handles.append(draft.gpt2.transformer.register_forward_pre_hook(begin('draft')))
+            self._handles.append(draft.gpt2.transformer.register_forward_hook(end_draft))
+        return self
+
+    def detach(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def begin(self, prompt_cache=None, **info):
+        '''
+        Start the record of a decoding call, info (e.g. the index of the experience and the strategy) is written with it.
+        '''
+        self.info = info
+        self._cache_counts = (prompt_cache.hits, prompt_cache.misses) if prompt_cache is not None else None
+        self.times = {'encode': 0.0, 'prefill': 0.0, 'decode': 0.0, 'draft': 0.0}
+        self.counts = {'prefill_passes': 0, 'decode_steps': 0, 'draft_passes': 0}
+        self._open = {}
+        self._active = True
+        self._start = self._now()
+
+    def end(self, preds, n_given=1, prompt_cache=None):
+        '''
+        Close the record of a decoding call that returned preds (lists of ids from target position 0, the first
+        n_given of each were given). Only the sampled ids count as tokens, not the forced [#START#]/[#EOS#] slots
+        and the skip_ids.
+        '''
+        total = self._now() - self._start
+        self._active = False
+        n_tokens = sampled_tokens(preds, n_given, self.sent_len, self.skip_ids)
+        record = dict(self.info)
+        record.update({
+            'n_samples': len(preds),
+            'total_ms': total * 1000,
+            'encode_ms': self.times['encode'] * 1000,
+            'prefill_ms': self.times['prefill'] * 1000,
+            'decode_ms': self.times['decode'] * 1000,
+            'draft_ms': self.times['draft'] * 1000,
+            'other_ms': (total - sum(self.times.values())) * 1000, # sampling and the logits processing
+            'prefill_passes': self.counts['prefill_passes'],
+            'decode_steps': self.counts['decode_steps'],
+            'draft_passes': self.counts['draft_passes'],
+            'tokens': n_tokens,
+            'tokens_per_sec': n_tokens / max(total, 1e-9),
+            'params': self.params
+        })
+        if prompt_cache is not None and self._cache_counts is not None:
+            record['prompt_cache_hits'] = prompt_cache.hits - self._cache_counts[0]
+            record['prompt_cache_misses'] = prompt_cache.misses - self._cache_counts[1]
+        self.records.append(record)
+        self._file.write(json.dumps(record) + "\n")
+        return record
+
+    def summary(self):
+        '''
+        Percentiles of the costs over the records of the run, and the throughput of the whole run.
+        '''
+        summary = {'calls': len(self.records), 'samples': sum(r['n_samples'] for r in self.records), \
+                   'tokens': sum(r['tokens'] for r in self.records)}
+        total_sec = sum(r['total_ms'] for r in self.records) / 1000
+        summary['run_tokens_per_sec'] = summary['tokens'] / max(total_sec, 1e-9)
+        for key in ['total_ms', 'encode_ms', 'prefill_ms', 'decode_ms', 'draft_ms', 'other_ms', 'decode_steps', 'tokens_per_sec']:
+            values = [r[key] for r in self.records]
+            if values:
+                summary[key] = {'p50': float(np.percentile(values, 50)), 'p90': float(np.percentile(values, 90)), \
+                                'p99': float(np.percentile(values, 99)), 'mean': float(np.mean(values))}
+        return summary
+
+    def close(self):
+        '''
+        Append the summary of the run, close the file and remove the hooks.
+        '''
+        summary = self.summary()
+        self._file.write(json.dumps({'summary': summary}) + "\n")
+        self._file.close()
+        self.detach()
+        return summary
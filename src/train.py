@@ -17,15 +17,20 @@ import time
 import numpy as np
 import torch
 import torch.nn as nn
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from tqdm import tqdm
 from transformers import AdamW, BertTokenizer, get_linear_schedule_with_warmup
 
 from configs import model_cfgs, data_config
 from model import MMTG
-from MyDataset import MyDataset
+from MyDataset import MyDataset, ShardedDataset, Collator, batch_to_device, pack_batch, in_curriculum
+from training import curriculum_stage, stage_indices, stage_loaders, n_batches, training_steps, compute_loss, evaluate
 from utils import *
-from loss import MyLoss
+from loss import MyLoss, PackedLoss, FusedLoss
+from profiler import StageProfiler
+from telemetry import TrainingTelemetry
+from checkpoint import AsyncCheckpointer
+from adapters import freeze_decoder, load_model
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "1,0"
 
@@ -39,21 +44,65 @@ parser.add_argument("--lr", default=1e-05, type=float, help="Learning rate")
 parser.add_argument("--curriculums", default="[1,3]", type=str, help="Curriculum rate")
 parser.add_argument("--seed", default=42, type=int, help="Random seed")
 parser.add_argument("--num_workers", default=0, type=int, help="Number of workers")
+parser.add_argument("--emb_dtype", default="float32", choices=["float32", "float16"], help="dtype of the WenLan embeddings in the batches")
+parser.add_argument("--pin_memory", action='store_true', help="Collate the batches in pinned memory for asynchronous copies to the GPU")
+parser.add_argument("--persistent_workers", action='store_true', help="Keep the DataLoader workers alive between epochs")
 parser.add_argument("--log_interval", default=100, type=int, help="Log interval")
 parser.add_argument("--val_interval_ratio", default=0.2, type=float, help="Eval once every interval ratio of training data")
+parser.add_argument("--val_subset_size", default=0, type=int, \
+                    help="Size of the fixed, rating-stratified val subset of the mid-epoch evals, 0 for the full val set. The end of epoch eval always uses the full val set")
+parser.add_argument("--val_subset_batch_size", default=128, type=int, help="Eval batch size on the val subset")
 parser.add_argument("--train_data_path", default="", type=str, help="Train data path")
 parser.add_argument("--val_data_path", default="", type=str, help="Val data path")
+parser.add_argument("--train_shards", default="", type=str, \
+                    help="Directory of train data shards streamed by ShardedDataset (see make_shards.py), instead of --train_data_path")
+parser.add_argument("--shuffle_buffer", default=1000, type=int, help="Number of samples of the shuffle buffer of --train_shards")
 parser.add_argument("--save_model", action='store_true', help="Save model")
 parser.add_argument("--save_path", default="", type=str, help="Save directory")
+parser.add_argument("--ckpt_format", default="safetensors", choices=["safetensors", "pth"], \
+                    help="safetensors: prefix-free tensors that generate.py memory-maps, pth: the torch.save format")
+parser.add_argument("--ckpt_fp16", action='store_true', help="Store the float32 weights of the checkpoints as float16")
 parser.add_argument("--log_path", default="", type=str, help="Log directory")
 parser.add_argument("--alpha", default=0, type=float, help="Factor of KLDivLoss.")
+parser.add_argument("--packed", action='store_true', \
+                    help="Train and eval on the packed layout without the pad slots of the sentences, the loss is averaged over the real tokens")
+parser.add_argument("--fused_loss", action='store_true', \
+                    help="Compute the LM head and the loss only at the target positions, in chunks, without the full logits")
+parser.add_argument("--loss_chunk_size", default=1024, type=int, help="Number of positions per chunk of --fused_loss")
+parser.add_argument("--freeze_decoder", action='store_true', \
+                    help="Freeze GPT2 and only train the encoder, the attention layers and the projectors; checkpoints only hold the trained weights")
+parser.add_argument("--lora_r", default=0, type=int, help="Rank of the low-rank adapters in GPT2 with --freeze_decoder, 0 for none")
+parser.add_argument("--lora_alpha", default=16, type=float, help="Scaling numerator of the low-rank adapters")
+parser.add_argument("--lora_dropout", default=0.0, type=float, help="Dropout on the input of the low-rank adapters")
+parser.add_argument("--lora_targets", default="attn.c_attn", type=str, help="Comma separated layers of each GPT2 block that get adapters")
+parser.add_argument("--encoder_type", default="", type=str, \
+                    help="RNN, LSTM, GRU or TRM image and text encoders instead of the type of configs.py")
+parser.add_argument("--init_path", default="", type=str, \
+                    help="Start from this full checkpoint (e.g. of prune.py) and its model configs instead of the pre-trained GPT2")
+parser.add_argument("--metrics_path", default="", type=str, help="Append the training telemetry of every log interval to this jsonl file")
+parser.add_argument("--profile", default=os.environ.get("MMTG_PROFILE", ""), type=str, \
+                    help="Record the time and memory of each model stage to PROFILE.trace.json and PROFILE.summary.json")
 
 args = parser.parse_args()
 batch_size = args.batch_size
 val_batch_size = args.val_batch_size
 curriculums = eval(args.curriculums)
 model_cfgs = model_cfgs
+if args.freeze_decoder: # saved with the checkpoints, see adapters.build_from_delta()
+    model_cfgs = dict(model_cfgs, PEFT={'lora_r': args.lora_r, 'lora_alpha': args.lora_alpha, \
+                      'lora_dropout': args.lora_dropout, 'lora_targets': args.lora_targets.split(",")})
 data_config = data_config()
+tokenizer = BertTokenizer.from_pretrained("./vocab/vocab.txt")
+init_model = None
+if args.init_path:
+    if args.freeze_decoder:
+        raise ValueError("--freeze_decoder needs the base decoder of GPT2_PATH, it cannot start from --init_path")
+    init_model, model_cfgs = load_model(args.init_path, tokenizer, data_config)
+    init_model.train_flag = True
+if args.encoder_type:
+    if args.init_path:
+        raise ValueError("--encoder_type cannot change the encoders of the checkpoint of --init_path")
+    model_cfgs = dict(model_cfgs, **{name: dict(model_cfgs[name], type=args.encoder_type) for name in ('image', 'text')})
 print(args, model_cfgs)
 logging.basicConfig(filename=args.log_path,
                     level=logging.INFO,
@@ -61,8 +110,6 @@ logging.basicConfig(filename=args.log_path,
                     datefmt="%Y-%m-%d %H:%M:%S")
 logger = logging.getLogger(__name__)
 logger.info(args)
-import pdb; pdb.set_trace()
-tokenizer = BertTokenizer.from_pretrained("./vocab/vocab.txt")
 
 devices = eval('['+args.device_ids+']')
 multi_gpu = False
@@ -99,11 +146,19 @@ def main():
     print("Loading data...")
     train_data_file = args.train_data_path
     val_data_file = args.val_data_path
-    train_data = MyDataset(train_data_file, tokenizer, data_config)
-    valid_data = MyDataset(val_data_file, tokenizer, data_config)
+    if args.train_shards: # streamed by train()
+        train_data = None
+    else:
+        train_data = MyDataset(train_data_file, tokenizer, data_config, emb_dtype=args.emb_dtype)
+    valid_data = MyDataset(val_data_file, tokenizer, data_config, emb_dtype=args.emb_dtype)
     print("Data loaded.")
 
-    model = MMTG(model_cfgs, data_config, len(tokenizer.vocab), train_flag=True)
+    if init_model is not None:
+        model = init_model
+    else:
+        model = MMTG(model_cfgs, data_config, len(tokenizer.vocab), train_flag=True)
+    if args.freeze_decoder:
+        freeze_decoder(model, **model_cfgs['PEFT'])
     
     n_params = sum([p.numel() for p in model.parameters() if p.requires_grad])
     print('* number of parameters: %d' % n_params)
@@ -127,27 +182,39 @@ def train(model, train_data, valid_data):
     
     ### This is for the different numbers of samples in different curriculum stages
     ### The following is a simple but inefficient way to solve this. You can definitely change it in your own way to save more memeory resource.
-    train_dataset_1 = DataLoader(train_data, batch_size=2*batch_size, shuffle=True, num_workers=args.num_workers)
-    valid_dataset_1 = DataLoader(valid_data, batch_size=2*val_batch_size, shuffle=True, num_workers=args.num_workers)
-    train_dataset_2 = DataLoader(train_data, batch_size=batch_size, shuffle=True, num_workers=args.num_workers)
-    valid_dataset_2 = DataLoader(valid_data, batch_size=val_batch_size, shuffle=True, num_workers=args.num_workers)
-    train_datasets = [train_dataset_1, train_dataset_2, train_dataset_2]
-    valid_datasets = [valid_dataset_1, valid_dataset_2, valid_dataset_2]
-
-    optimizer = AdamW(model.parameters(), lr=args.lr)
-    training_steps = int(len(train_dataset_1) * curriculums[0] + \
-                         len(train_dataset_2) * (curriculums[1] - curriculums[0]) + \
-                         len(train_dataset_2) * (args.epochs - curriculums[1]))
-    print('Total training steps:', training_steps)
-    logger.info('* number of training steps: %d' % training_steps) # number of training steps
-    one_epoch_steps = len(train_dataset_1)
+    if train_data is not None:
+        train_datasets = stage_loaders(train_data, batch_size, **loader_kwargs())
+    else:
+        # the samples of each stage are filtered when streamed, so the batches are not halved by the curriculum
+        train_datasets = [DataLoader(ShardedDataset(args.train_shards, tokenizer, data_config, emb_dtype=args.emb_dtype, \
+                            stage=stage, shuffle_buffer=args.shuffle_buffer, seed=args.seed, num_workers=args.num_workers), \
+                            batch_size=batch_size, **loader_kwargs()) for stage in (1, 2, 3)]
+    valid_datasets = stage_loaders(valid_data, val_batch_size, **loader_kwargs())
+    if args.val_subset_size > 0: # cheaper mid-epoch evals
+        subset_valid_datasets = [val_subset(valid_data, stage) for stage in (1, 2, 3)]
+    else:
+        subset_valid_datasets = valid_datasets
+
+    optimizer = AdamW([p for p in model.parameters() if p.requires_grad], lr=args.lr)
+    n_training_steps = training_steps(train_datasets, curriculums, args.epochs)
+    print('Total training steps:', n_training_steps)
+    logger.info('* number of training steps: %d' % n_training_steps) # number of training steps
+    one_epoch_steps = n_batches(train_datasets[0], 0)
 
     # warmup and decay the learning rate
     scheduler = get_linear_schedule_with_warmup(optimizer, 
                                                 num_warmup_steps = int(one_epoch_steps * 0.1), 
-                                                num_training_steps = training_steps)
+                                                num_training_steps = n_training_steps)
                                                 
-    criterion = MyLoss(data_config, model_cfgs)
+    if args.fused_loss:
+        criterion = FusedLoss(data_config, model_cfgs, args.loss_chunk_size, packed=args.packed)
+    elif args.packed:
+        criterion = PackedLoss(data_config, model_cfgs)
+    else:
+        criterion = MyLoss(data_config, model_cfgs)
+    profiler = StageProfiler().attach(model, criterion) if args.profile else None
+    telemetry = TrainingTelemetry(args.metrics_path)
+    checkpointer = AsyncCheckpointer(fp16=args.ckpt_fp16, trainable_only=args.freeze_decoder) # writes in the background while training goes on
     best_val_loss = float("inf")
     global_steps = 0
     stage = 0 # curriculum stage
@@ -156,117 +223,115 @@ def train(model, train_data, valid_data):
         torch.cuda.empty_cache()
         print("\nEpoch ", epoch + 1, "/", args.epochs)
         logger.info("Epoch " + str(epoch + 1) + "/" + str(args.epochs))
-        if epoch < curriculums[0]: # very positive and negative first
-            stage = 1
-            epoch_iterator = tqdm(enumerate(train_dataset_1),
-                                    desc="%s: %d/%d Epochs >> Steps" % ("Train", epoch + 1, args.epochs),
-                                    total=len(train_dataset_1),
-                                    bar_format="{l_bar}{r_bar}")
-        else:
-            if epoch < curriculums[1]: # then positive and negative
-                stage = 2
-            else:
-                stage = 3
-            epoch_iterator = tqdm(enumerate(train_dataset_2),
-                                    desc="%s: %d/%d Epochs >> Steps" % ("Train", epoch + 1, args.epochs),
-                                    total=len(train_dataset_2),
-                                    bar_format="{l_bar}{r_bar}")
+        stage = curriculum_stage(epoch, curriculums)
+        if isinstance(train_datasets[stage-1].dataset, ShardedDataset):
+            train_datasets[stage-1].dataset.set_epoch(epoch)
+        n_steps = n_batches(train_datasets[stage-1], epoch)
+        epoch_iterator = tqdm(enumerate(train_datasets[stage-1]),
+                                desc="%s: %d/%d Epochs >> Steps" % ("Train", epoch + 1, args.epochs),
+                                total=n_steps,
+                                bar_format="{l_bar}{r_bar}")
 
         avg_loss = 0.0
         model.train()
+        telemetry.tick('other')
         for step, batch in epoch_iterator:
-            if stage == 1:
-                idxs = torch.cat([torch.where(batch['rating']<2)[0], torch.where(batch['rating']>4)[0]])
-            elif stage == 2:
-                idxs = torch.cat([torch.where(batch['rating']<3)[0], torch.where(batch['rating']>3)[0]])
-            else:
-                idxs = torch.arange(len(batch['rating']))
+            telemetry.tick('data') # blocked on the DataLoader
+            idxs = stage_indices(batch['rating'], stage)
+            n_tokens = int(batch['attention_mask'][idxs].sum() + batch['tpw_attention_mask'][idxs].sum())
+            telemetry.add_batch(len(batch['rating']), len(idxs), n_tokens)
             if len(idxs) == 0:
                 continue
-            batch = {k: v[idxs].to(device) for k, v in batch.items()}
+            batch = batch_to_device(batch, device, idxs)
             ratings = batch['rating'].to(device)
-            _loss, kl_loss, outputs = model.forward(batch)
-            outputs = outputs.contiguous()
-            targets = batch['targets'].contiguous()
-            loss = criterion(outputs, targets, ratings, stage)
+            if args.packed:
+                batch = pack_batch(batch, data_config)
+            telemetry.tick('data', sync=True)
+            loss, kl_loss, _ = compute_loss(model, batch, ratings, stage, criterion, args.packed, args.fused_loss)
             total_loss = loss.mean() + args.alpha * kl_loss.mean()
+            telemetry.tick('forward', sync=True)
             total_loss.backward()
+            telemetry.tick('backward', sync=True)
             nn.utils.clip_grad_norm_(model.parameters(), 1.0)  # clip gradient
             optimizer.step()
             scheduler.step()
             model.zero_grad()
+            telemetry.tick('optimizer', sync=True)
             for param_group in optimizer.param_groups:
                 args.lr = param_group['lr']
             epoch_iterator.set_postfix(lr=args.lr, loss=total_loss.item())  # show the learning rate and loss on the progress bar
             global_steps += 1
-            if step > 0 and (step + 1) % int(len(train_datasets[stage-1]) * args.val_interval_ratio) == 0:
-                val_loss, _ = evaluate(model, valid_datasets[stage-1], stage, criterion)
-                logger.info("Epoch: %d, Step: %d/%d, Val. Loss: %.4f" % (epoch + 1, step + 1, len(train_datasets[stage-1]), val_loss))
-                print(" Epoch: %d, Step: %d/%d, Val. Loss: %.4f" % (epoch + 1, step + 1, len(train_datasets[stage-1]), val_loss))
+            if step > 0 and (step + 1) % int(n_steps * args.val_interval_ratio) == 0:
+                val_loss, _, _ = evaluate(model, subset_valid_datasets[stage-1], stage, criterion, device, \
+                                          args.alpha, data_config, args.packed, args.fused_loss)
+                logger.info("Epoch: %d, Step: %d/%d, Val. Loss: %.4f" % (epoch + 1, step + 1, n_steps, val_loss))
+                print(" Epoch: %d, Step: %d/%d, Val. Loss: %.4f" % (epoch + 1, step + 1, n_steps, val_loss))
                 # Save model
                 if val_loss < best_val_loss:
                     best_val_loss = val_loss
                     if args.save_model:
-                        if not os.path.exists(args.save_path):
-                            os.makedirs(args.save_path)
-                        state = {'model': model.state_dict(), 'args': args, 'model_cfgs': model_cfgs}
-                        torch.save(state, args.save_path + f"/best_val_model.pth")
+                        checkpointer.save(model, args.save_path + f"/best_val_model.{args.ckpt_format}", model_cfgs, args)
                         logger.info("Epoch: %d, Step: %d, Saving Model to \'%s\'." % (epoch + 1, step, args.save_path))
                         print("Epoch: %d, Step: %d, Saving Model to \'%s\'." % (epoch + 1, step, args.save_path))
                 model.train()
+                telemetry.tick('eval')
             avg_loss += loss.item()
             if step > 0 and (step + 1) % args.log_interval == 0:
-                logger.info("Epoch: %d, Step: %d/%d, Average loss: %.6f" % (epoch + 1, step + 1, len(train_datasets[stage-1]), avg_loss / (step + 1)))
+                logger.info("Epoch: %d, Step: %d/%d, Average loss: %.6f" % (epoch + 1, step + 1, n_steps, avg_loss / (step + 1)))
+                telemetry.report(logger, epoch=epoch + 1, step=step + 1, global_step=global_steps, stage=stage, \
+                                 lr=args.lr, avg_loss=avg_loss / (step + 1))
+            telemetry.tick('other')
+        if telemetry.n_loaded > 0:
+            telemetry.report(logger, epoch=epoch + 1, step=step + 1, global_step=global_steps, stage=stage, \
+                             lr=args.lr, avg_loss=avg_loss / (step + 1))
         # End of epoch
-        val_loss, _ = evaluate(model, valid_datasets[stage-1], stage, criterion)
+        val_loss, _, _ = evaluate(model, valid_datasets[stage-1], stage, criterion, device, \
+                                  args.alpha, data_config, args.packed, args.fused_loss)
         logger.info("End eval of epoch %d. Val. Loss: %.4f" % (epoch + 1, val_loss))
         print("End eval of epoch %d. Val. Loss: %.4f" % (epoch + 1, val_loss))
         model.train()
-        logger.info("Average loss: %.4f  Elapsed time: %s" % (avg_loss / (len(train_datasets[stage-1]) + 1), format_time(time.time()-t1)))
-        print("Average loss: %.4f  Elapsed time: %s" % (avg_loss / (len(train_datasets[stage-1]) + 1), format_time(time.time()-t1)))
+        logger.info("Average loss: %.4f  Elapsed time: %s" % (avg_loss / (n_steps + 1), format_time(time.time()-t1)))
+        print("Average loss: %.4f  Elapsed time: %s" % (avg_loss / (n_steps + 1), format_time(time.time()-t1)))
         if args.save_model:
-            if not os.path.exists(args.save_path):
-                os.makedirs(args.save_path)
-            state = {'model': model.state_dict(), 'args': args, 'model_cfgs': model_cfgs}
-            torch.save(state, args.save_path + f"/epoch_{epoch + 1}.pth")
+            checkpointer.save(model, args.save_path + f"/epoch_{epoch + 1}.{args.ckpt_format}", model_cfgs, args)
             logger.info("Epoch: %d, Step: %d, Saving Model to \'%s\'." % (epoch + 1, step, args.save_path))
             print("Epoch: %d, Step: %d, Saving Model to \'%s\'." % (epoch + 1, step, args.save_path))
-    
+        if profiler is not None:
+            trace_path, summary_path = profiler.export(args.profile)
+            logger.info("Profile saved to %s and %s." % (trace_path, summary_path))
+            if profiler.missing(('encoder', 'gpt2', 'loss')):
+                logger.warning("No time recorded for the stages %s." % ", ".join(profiler.missing(('encoder', 'gpt2', 'loss'))))
+    checkpointer.wait()
     logger.info("Training finished.")
     print("Training finished.")
 
     return val_loss
 
 
-def evaluate(model, valid_dataset, stage, criterion):
-    model.eval()
-    valid_loss = 0.0
-    kldiv_loss = 0.0
-    with torch.no_grad():
-        epoch_iterator = tqdm(valid_dataset, ncols=100, leave=False)
-        for i, batch in enumerate(epoch_iterator):
-            if stage == 1:
-                idxs = torch.cat([torch.where(batch['rating']<2)[0], torch.where(batch['rating']>4)[0]])
-            elif stage == 2:
-                idxs = torch.cat([torch.where(batch['rating']<3)[0], torch.where(batch['rating']>3)[0]])
-            else:
-                idxs = torch.arange(len(batch['rating']))
-            if len(idxs) == 0:
-                continue
-            batch = {k: v[idxs].to(device) for k, v in batch.items()}
-            ratings = batch['rating'].to(device)
-            _loss, kl_loss, outputs = model.forward(batch)
-            outputs = outputs.contiguous()
-            targets = batch['targets'].contiguous()
-            loss = criterion(outputs, targets, ratings, stage)          
-            total_loss = loss.mean() + args.alpha * kl_loss.mean()
-            valid_loss += total_loss.item()
-            kldiv_loss += args.alpha * kl_loss.mean().item()
-    valid_loss /= len(valid_dataset)
-    kldiv_loss /= len(valid_dataset)
-
-    return valid_loss, kldiv_loss
-
+def loader_kwargs():
+    '''
+    DataLoader options shared by the train and val loaders.
+    '''
+    id_dtype = torch.int16 if len(tokenizer.vocab) < 2 ** 15 else torch.int32
+    return {
+        'num_workers': args.num_workers,
+        'collate_fn': Collator(getattr(torch, args.emb_dtype), id_dtype),
+        'pin_memory': args.pin_memory and torch.cuda.is_available(),
+        'persistent_workers': args.persistent_workers and args.num_workers > 0
+    }
+
+
+def val_subset(valid_data, stage):
+    '''
+    A DataLoader of args.val_subset_size samples of valid_data, kept by the curriculum of stage
+    and stratified by rating. The subset is the same at every eval, so that the val losses are comparable.
+    '''
+    ratings = np.asarray([item['rating'] for item in valid_data.data])
+    candidates = np.where(in_curriculum(ratings, stage))[0]
+    idxs = candidates[stratified_indices(ratings[candidates], args.val_subset_size, args.seed)]
+    logger.info("Val subset of stage %d: %d samples." % (stage, len(idxs)))
+    return DataLoader(Subset(valid_data, idxs.tolist()), batch_size=args.val_subset_batch_size, \
+                      shuffle=False, **loader_kwargs())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,112 @@
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from MyDataset import ShardedDataset, batch_to_device, pack_batch
+
+
+def curriculum_stage(epoch, curriculums):
+    '''
+    The curriculum stage of an epoch: the very positive and negative samples first (1),
+    then the positive and negative ones (2) from epoch curriculums[0] and all of them (3) from epoch curriculums[1].
+    '''
+    if epoch < curriculums[0]:
+        return 1
+    elif epoch < curriculums[1]:
+        return 2
+    return 3
+
+
+def stage_indices(ratings, stage):
+    '''
+    Indices of the samples of a batch that the curriculum stage trains on.
+    '''
+    if stage == 1:
+        return torch.cat([torch.where(ratings<2)[0], torch.where(ratings>4)[0]])
+    elif stage == 2:
+        return torch.cat([torch.where(ratings<3)[0], torch.where(ratings>3)[0]])
+    return torch.arange(len(ratings))
+
+
+def stage_loaders(data, batch_size, **kwargs):
+    '''
+    The shuffled DataLoaders of the 3 curriculum stages. Stage 1 keeps the fewest samples of a batch, so its batches are twice as large.
+    '''
+    loader_1 = DataLoader(data, batch_size=2*batch_size, shuffle=True, **kwargs)
+    loader_2 = DataLoader(data, batch_size=batch_size, shuffle=True, **kwargs)
+    return [loader_1, loader_2, loader_2]
+
+
+def n_batches(loader, epoch=None):
+    '''
+    Number of batches of the loader in an epoch. Every worker of a ShardedDataset ends with its own partial batch,
+    which len(loader) does not count.
+    '''
+    if isinstance(loader.dataset, ShardedDataset):
+        return loader.dataset.n_batches(loader.batch_size, epoch)
+    return len(loader)
+
+
+def training_steps(train_loaders, curriculums, epochs):
+    '''
+    Number of optimizer steps of the curriculum over the train loaders of the 3 stages.
+    '''
+    return sum(n_batches(train_loaders[curriculum_stage(epoch, curriculums) - 1], epoch) for epoch in range(epochs))
+
+
+def compute_loss(model, batch, ratings, stage, criterion, packed=False, fused_loss=False):
+    '''
+    The loss of the criterion and the KL loss of the model on a batch, and the outputs of the model:
+    the logits, or the hidden states with fused_loss, from which the criterion computes the LM head.
+    '''
+    targets = batch['packed_labels' if packed else 'targets'].contiguous()
+    if fused_loss:
+        _loss, kl_loss, hidden_states = model.forward(batch, return_hidden=True)
+        mmtg = model.module if isinstance(model, nn.DataParallel) else model
+        return criterion(hidden_states, mmtg.decoder.gpt2.lm_head.weight, targets, ratings, stage), kl_loss, hidden_states
+    _loss, kl_loss, outputs = model.forward(batch)
+    outputs = outputs.contiguous()
+    return criterion(outputs, targets, ratings, stage), kl_loss, outputs
+
+
+def teacher_logits(teacher, batch):
+    '''
+    The logits of a frozen teacher on the training layout of the batch, without the LM loss of its labels.
+    '''
+    mmtg = teacher.module if isinstance(teacher, nn.DataParallel) else teacher
+    _, _, hidden_states = teacher.forward(batch, return_hidden=True)
+    return mmtg.decoder.gpt2.lm_head(hidden_states)
+
+
+def evaluate(model, valid_dataset, stage, criterion, device, alpha=0, data_config=None, packed=False, fused_loss=False, \
+             teacher=None, kd_criterion=None):
+    '''
+    Returns the val loss (criterion + alpha * KL loss), its KL part and the distillation loss of kd_criterion
+    against teacher (0 if teacher is None), averaged over the batches of valid_dataset.
+    '''
+    model.eval()
+    valid_loss = 0.0
+    kldiv_loss = 0.0
+    kd_loss = 0.0
+    with torch.inference_mode():
+        epoch_iterator = tqdm(valid_dataset, ncols=100, leave=False)
+        for i, batch in enumerate(epoch_iterator):
+            idxs = stage_indices(batch['rating'], stage)
+            if len(idxs) == 0:
+                continue
+            batch = batch_to_device(batch, device, idxs)
+            ratings = batch['rating'].to(device)
+            if packed:
+                batch = pack_batch(batch, data_config)
+            loss, kl_loss, outputs = compute_loss(model, batch, ratings, stage, criterion, packed, fused_loss)
+            total_loss = loss.mean() + alpha * kl_loss.mean()
+            valid_loss += total_loss.item()
+            kldiv_loss += alpha * kl_loss.mean().item()
+            if teacher is not None:
+                kd_loss += kd_criterion(outputs, teacher_logits(teacher, batch), batch['attention_mask']).item()
+    valid_loss /= len(valid_dataset)
+    kldiv_loss /= len(valid_dataset)
+    kd_loss /= len(valid_dataset)
+
+    return valid_loss, kldiv_loss, kd_loss
@@ -8,6 +8,9 @@ LastEditTime: 2022-03-21 20:02:04
 
 
 import datetime
+import resource
+
+import numpy as np
 
 
 def format_time(elapsed):
@@ -17,4 +20,61 @@ def format_time(elapsed):
     # Round to the nearest second.
     elapsed_rounded = int(round((elapsed)))
     # Format as hh:mm:ss
-    return str(datetime.timedelta(seconds=elapsed_rounded))
\ No newline at end of file
+    return str(datetime.timedelta(seconds=elapsed_rounded))
+
+
+def strip_module_prefix(state_dict):
+    '''
+    Remove the 'module.' prefix that nn.DataParallel adds to the keys of a state dict.
+    '''
+    return {(k[len('module.'):] if k.startswith('module.') else k): v for k, v in state_dict.items()}
+
+
+def rss_mb(key="VmRSS"):
+    '''
+    Current (VmRSS) or peak (VmHWM) resident memory of this process in MB.
+    Falls back to the peak from getrusage if /proc is not available.
+    '''
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(key + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def reset_peak_rss():
+    '''
+    Reset the peak resident memory (VmHWM) of this process. Only works on Linux.
+    '''
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def stratified_indices(labels, size, seed=42):
+    '''
+    A fixed random subset of size indices of labels with the same proportion of each label as the whole,
+    at least one per label when size allows it. Returns all the indices if size >= len(labels).
+    '''
+    labels = np.asarray(labels)
+    if size >= len(labels):
+        return np.arange(len(labels))
+    rng = np.random.RandomState(seed)
+    values, counts = np.unique(labels, return_counts=True)
+    quotas = counts * size / len(labels)
+    n_picks = np.floor(quotas).astype(int)
+    if size >= len(values):
+        n_picks = np.maximum(n_picks, 1)
+        while n_picks.sum() > size: # the extra picks come from the largest excesses
+            n_picks[np.argmax(np.where(n_picks > 1, n_picks - quotas, -np.inf))] -= 1
+    # the remaining picks go to the largest remainders
+    for i in np.argsort(n_picks - quotas)[:max(size - n_picks.sum(), 0)]:
+        n_picks[i] += 1
+    idxs = [rng.choice(np.where(labels == value)[0], min(n, count), replace=False) \
+            for value, n, count in zip(values, n_picks, counts)]
+    return np.sort(np.concatenate(idxs))